@@ -0,0 +1,1056 @@
+"""Офлайн-бенчмарк и нагрузочный стенд для бота.
+
+Гоняет настоящие обработчики из main.py (handle_text, handle_image,
+handle_document, process_broadcast, PDF-колбэки) на синтетических апдейтах: Telegram и
+LLM-провайдеры подменяются локальными фейками с настраиваемой задержкой
+и скоростью генерации токенов. Сеть и платные API не используются.
+
+Примеры:
+    python bench.py --updates 500 --users 50 --concurrency 16
+    python bench.py --scenario mixed --latency-ms 300 --token-rate 80
+    python bench.py --replay requests.jsonl
+    python bench.py --suite semantic --entries 100000
+    python bench.py --suite split --split-kb 100 800 4000
+    python bench.py --suite batch --questions 50 --latency-ms 100
+    python bench.py --suite logging --log-kb 0.1 4 64
+    python bench.py --suite local --local-token-rate 30 --local-prefill-rate 300
+    python bench.py --suite prewarm --updates 400 --prewarm-pool 300
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# main.py читает секреты при импорте — подставляем заглушки до импорта
+os.environ.setdefault("BOT_TOKEN", "000000:BENCH")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("DEEPSEEK_API_KEY", "sk-bench")
+os.environ.setdefault("SECRETS_DIR", os.path.join(tempfile.gettempdir(), "bench-no-secrets"))
+os.environ.setdefault("USAGE_LEDGER_PATH", os.path.join(tempfile.gettempdir(), "bench-usage-ledger.jsonl"))
+
+import logging
+logging.disable(logging.CRITICAL)
+
+import main as bot  # noqa: E402
+from telegram.error import RetryAfter  # noqa: E402
+
+
+SAMPLE_QUESTIONS = [
+    "как посмотреть открытые порты",
+    "как проверить открытые порты",
+    "почему nginx отдаёт 502",
+    "как настроить iptables для ssh",
+    "что такое netflow и зачем он нужен",
+    "как посмотреть загрузку диска в linux",
+    "объясни разницу между TCP и UDP",
+    "как найти процесс, который занимает порт 8080",
+]
+
+
+# ---------------------------------------------------------------------------
+# Фейковый LLM-провайдер
+# ---------------------------------------------------------------------------
+
+class FakeProvider:
+    """Синхронный клиент с интерфейсом client.chat.completions.create.
+
+    Задержка ответа = latency_ms + completion_tokens / token_rate. С stream=True
+    отдаёт чанки по мере «генерации»; доля stall_ratio запросов зависает на stall_ms
+    до первого токена (для проверки дедлайнов и хеджирования).
+
+    Для локальной модели на CPU: prefill_rate — скорость обработки промпта (ток/с; системный
+    промпт не считается, сервер держит его в кэше префикса), slots — сколько запросов сервер
+    обрабатывает одновременно, остальные ждут очереди.
+    """
+
+    STREAM_CHUNK_TOKENS = 16
+
+    def __init__(self, name: str, latency_ms: float = 200.0, token_rate: float = 50.0,
+                 completion_tokens: int = 200, jitter: float = 0.1,
+                 stall_ratio: float = 0.0, stall_ms: float = 10_000.0,
+                 prefill_rate: float = 0.0, slots: int = 0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.jitter = jitter
+        self.stall_ratio = stall_ratio
+        self.stall_ms = stall_ms
+        self.prefill_rate = prefill_rate
+        self.slots = threading.Semaphore(slots) if slots > 0 else contextlib.nullcontext()
+        self.calls = 0
+        self.aborted = 0  # потоков, закрытых клиентом до конца генерации
+        self.batch_requests = 0  # заданий, пришедших через Batch API
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        # Минимальные Files/Batches API: batch выполняется сразу, статус меняется на первом опросе
+        self.files = SimpleNamespace(create=self._file_create, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._batch_create, retrieve=self._batch_retrieve)
+        self._files = {}
+        self._batches = {}
+
+    def _create(self, model: str, messages: list, **kwargs):
+        if not kwargs.get("batch"):
+            self.calls += 1
+        completion_tokens = int(kwargs.get("max_tokens") or self.completion_tokens)
+        completion_tokens = min(completion_tokens, self.completion_tokens)
+        ttft = self.latency_ms / 1000.0
+        if self.stall_ratio and random.random() < self.stall_ratio:
+            ttft = self.stall_ms / 1000.0
+        ttft *= 1.0 + random.uniform(-self.jitter, self.jitter)
+        if self.prefill_rate > 0:
+            ttft += sum(len(str(m.get("content", ""))) for m in messages[1:]) / 4 / self.prefill_rate
+        timeout = kwargs.get("timeout")
+        if timeout is not None and ttft > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Request timed out.")
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        seed = hashlib.md5(repr(messages[-1:]).encode("utf-8")).hexdigest()[:8]
+        words = list(itertools.islice(itertools.cycle(["ответ", "sudo", "ss", "-tulpn", "порт"]), completion_tokens))
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0),
+        )
+        if kwargs.get("stream"):
+            return FakeStream(self, f"[{self.name}:{model}:{seed}]", words, ttft, usage)
+        if kwargs.get("batch"):
+            return f"[{self.name}:{model}:{seed}] {' '.join(words)}", usage
+        delay = ttft + (completion_tokens / self.token_rate if self.token_rate > 0 else 0.0)
+        with self.slots:
+            time.sleep(max(delay, 0.0))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=f"[{self.name}:{model}:{seed}] {' '.join(words)}"))],
+            usage=usage,
+            model=model,
+        )
+
+
+    def _file_create(self, file, purpose: str):
+        _, data = file
+        file_id = f"file-{len(self._files)}"
+        self._files[file_id] = data.decode("utf-8")
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id: str):
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _batch_create(self, input_file_id: str, endpoint: str, completion_window: str):
+        rows = []
+        for line in self._files[input_file_id].splitlines():
+            req = json.loads(line)
+            self.batch_requests += 1
+            body = dict(req["body"])
+            content, usage = self._create(body.pop("model"), body.pop("messages"), batch=True, **body)
+            rows.append(json.dumps({"custom_id": req["custom_id"], "error": None, "response": {
+                "status_code": 200,
+                "body": {"choices": [{"message": {"role": "assistant", "content": content}}],
+                         "usage": {"prompt_tokens": usage.prompt_tokens,
+                                   "completion_tokens": usage.completion_tokens}},
+            }}, ensure_ascii=False))
+        output_id = f"file-{len(self._files)}"
+        self._files[output_id] = "\n".join(rows)
+        batch_id = f"batch-{len(self._batches)}"
+        self._batches[batch_id] = SimpleNamespace(id=batch_id, status="completed",
+                                                  output_file_id=output_id, error_file_id=None)
+        return SimpleNamespace(id=batch_id, status="validating", output_file_id=None, error_file_id=None)
+
+    def _batch_retrieve(self, batch_id: str):
+        return self._batches[batch_id]
+
+
+class FakeStream:
+    def __init__(self, provider: FakeProvider, header: str, words: list, ttft: float, usage):
+        self.provider = provider
+        self.header = header
+        self.words = words
+        self.ttft = ttft
+        self.usage = usage
+        self.finished = False
+
+    @staticmethod
+    def _chunk(content=None, usage=None):
+        choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+        return SimpleNamespace(choices=choices, usage=usage)
+
+    def __iter__(self):
+        # Слот занят до конца генерации; брошенный клиентом итератор закрывается и освобождает его
+        with self.provider.slots:
+            time.sleep(max(self.ttft, 0.0))
+            yield self._chunk(self.header)
+            step = FakeProvider.STREAM_CHUNK_TOKENS
+            for i in range(0, len(self.words), step):
+                if self.provider.token_rate > 0:
+                    time.sleep(len(self.words[i:i + step]) / self.provider.token_rate)
+                yield self._chunk(" " + " ".join(self.words[i:i + step]))
+            self.finished = True
+        yield self._chunk(usage=self.usage)
+
+    def close(self):
+        if not self.finished:
+            self.provider.aborted += 1
+
+
+# ---------------------------------------------------------------------------
+# Фейковый Telegram
+# ---------------------------------------------------------------------------
+
+class FakeBot:
+    """Считает вызовы Bot API, не выполняя их."""
+
+    def __init__(self, send_latency_ms: float = 0.0, flood_ratio: float = 0.0):
+        self.send_latency_ms = send_latency_ms
+        self.flood_ratio = flood_ratio
+        self.calls = 0
+        self.floods = 0
+
+    async def _api_call(self):
+        self.calls += 1
+        if self.send_latency_ms:
+            await asyncio.sleep(self.send_latency_ms / 1000.0)
+        if self.flood_ratio and random.random() < self.flood_ratio:
+            self.floods += 1
+            raise RetryAfter(1)
+        return SimpleNamespace(message_id=self.calls)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._api_call()
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self._api_call()
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, user, text: str = None, photo: list = None, document=None):
+        self._bot = bot
+        self.from_user = user
+        self.chat_id = user.id
+        self.text = text
+        self.caption = None
+        self.photo = photo or []
+        self.document = document
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot._api_call()
+
+    async def reply_document(self, document, **kwargs):
+        if hasattr(document, "read"):
+            document.read()
+        return await self._bot._api_call()
+
+
+class FakeFile:
+    def __init__(self, payload: bytes):
+        self._payload = payload
+
+    async def download_to_drive(self, custom_path):
+        with open(custom_path, "wb") as f:
+            f.write(self._payload)
+
+
+class FakePhotoSize:
+    def __init__(self, file_id: str, payload: bytes):
+        self.file_id = file_id
+        self._payload = payload
+
+    async def get_file(self):
+        return FakeFile(self._payload)
+
+
+class FakeDocument:
+    def __init__(self, file_name: str, payload: bytes):
+        self.file_name = file_name
+        self.file_unique_id = f"doc{time.monotonic_ns()}"
+        self.file_size = len(payload)
+        self._payload = payload
+
+    async def get_file(self):
+        return FakeFile(self._payload)
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot: FakeBot, user, data: str):
+        self._bot = bot
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(bot, user)
+
+    async def answer(self, *args, **kwargs):
+        return await self._bot._api_call()
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self._bot._api_call()
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot, user_data: dict):
+        self.bot = bot
+        self.user_data = user_data
+        self.chat_data = {}
+        self.bot_data = {}
+        self.error = None
+
+
+def _make_user(user_id: int):
+    return SimpleNamespace(id=user_id, first_name=f"bench{user_id}", username=None)
+
+
+def make_text_update(bot: FakeBot, user_id: int, text: str):
+    user = _make_user(user_id)
+    return SimpleNamespace(effective_user=user, message=FakeMessage(bot, user, text=text), callback_query=None)
+
+
+def make_photo_update(bot: FakeBot, user_id: int, payload: bytes):
+    user = _make_user(user_id)
+    photo = [FakePhotoSize(f"bench{user_id}_{time.monotonic_ns()}", payload)]
+    return SimpleNamespace(effective_user=user, message=FakeMessage(bot, user, photo=photo), callback_query=None)
+
+
+def make_document_update(bot: FakeBot, user_id: int, file_name: str, payload: bytes):
+    user = _make_user(user_id)
+    message = FakeMessage(bot, user, document=FakeDocument(file_name, payload))
+    return SimpleNamespace(effective_user=user, message=message, callback_query=None)
+
+
+def make_callback_update(bot: FakeBot, user_id: int, data: str):
+    user = _make_user(user_id)
+    query = FakeCallbackQuery(bot, user, data)
+    return SimpleNamespace(effective_user=user, message=None, callback_query=query)
+
+
+# ---------------------------------------------------------------------------
+# Сценарии
+# ---------------------------------------------------------------------------
+
+# kind -> (обработчик main.py, фабрика апдейта)
+HANDLERS = {
+    "text": lambda: bot.handle_text,
+    "image": lambda: bot.handle_image,
+    "document": lambda: bot.handle_document,
+    "broadcast": lambda: bot.process_broadcast,
+    "pdf": lambda: bot.save_pdf_callback,
+    "myreport": lambda: bot.my_report,
+    "report": lambda: bot.admin_report,
+}
+
+
+def synthetic_events(scenario: str, updates: int, users: int, unique_ratio: float, rnd: random.Random):
+    """Генератор событий вида {"kind", "user_id", "text"}."""
+    mixed = ["text"] * 78 + ["image"] * 8 + ["document"] * 2 + ["pdf"] * 8 + ["myreport"] * 2 + ["report"] + ["broadcast"]
+    for i in range(updates):
+        kind = rnd.choice(mixed) if scenario == "mixed" else scenario
+        user_id = 1_000_000 + rnd.randrange(max(users, 1))
+        if kind in ("broadcast", "report"):
+            user_id = bot.ADMIN_IDS[0]
+        text = rnd.choice(SAMPLE_QUESTIONS)
+        if rnd.random() < unique_ratio:
+            text = f"{text} #{i}"
+        yield {"kind": kind, "user_id": user_id, "text": text}
+
+
+def replay_events(path: str, users: int):
+    """Читает JSONL с захваченным трафиком.
+
+    Поддерживаемые поля: kind (text/image/document/broadcast/pdf/myreport/report),
+    user_id, text. Если text нет — берётся body/title (формат requests.jsonl).
+    Если user_id нет — назначается стабильный id по хэшу строки.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"{path}:{lineno}: пропущена некорректная строка", file=sys.stderr)
+                continue
+            text = rec.get("text") or rec.get("body") or rec.get("title") or ""
+            user_id = rec.get("user_id")
+            if user_id is None:
+                key = str(rec.get("request_id") or line).encode("utf-8")
+                user_id = 1_000_000 + int(hashlib.md5(key).hexdigest(), 16) % max(users, 1)
+            yield {"kind": rec.get("kind", "text"), "user_id": int(user_id), "text": text}
+
+
+def synthetic_syslog(size_kb: int, rnd: random.Random) -> bytes:
+    """Syslog-подобный файл: много повторов и редкие ошибки — типичный вход для handle_document."""
+    out = []
+    total = 0
+    i = 0
+    while total < size_kb * 1024:
+        r = rnd.random()
+        if r < 0.002:
+            line = f"Oct 19 10:{i % 60:02d}:{i % 60:02d} web01 kernel: Out of memory: Killed process {rnd.randint(1, 9999)} (java)\n"
+        elif r < 0.02:
+            line = f"Oct 19 10:{i % 60:02d}:01 web01 sshd[{rnd.randint(100, 999)}]: Failed password for root from 10.0.{rnd.randint(0, 255)}.{rnd.randint(0, 255)} port {rnd.randint(1000, 60000)} ssh2\n"
+        else:
+            line = f"Oct 19 10:{i % 60:02d}:01 web01 CRON[{rnd.randint(100, 9999)}]: (root) CMD (run-parts /etc/cron.hourly)\n"
+        out.append(line)
+        total += len(line)
+        i += 1
+    return "".join(out).encode("utf-8")
+
+
+def _rss_kb() -> int:
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception:
+        return 0
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def install_fakes(args) -> tuple:
+    """Подменяет клиентов провайдеров в main.py фейками. Возвращает (openai, deepseek)."""
+    fake_openai = FakeProvider("openai", args.latency_ms, args.token_rate, args.completion_tokens,
+                               stall_ratio=args.stall_ratio, stall_ms=args.stall_ms)
+    fake_deepseek = FakeProvider("deepseek", args.latency_ms, args.token_rate, args.completion_tokens,
+                                 stall_ratio=args.stall_ratio, stall_ms=args.stall_ms)
+    bot.PROVIDER_HEDGE_ENABLED = args.hedge
+    bot.ai_client = fake_openai
+    bot.deepseek_client = fake_deepseek
+    return fake_openai, fake_deepseek
+
+
+async def run_bench(events, args) -> dict:
+    fake_providers = install_fakes(args)
+    if not args.telegram_limits:
+        # Фейковый Telegram не ограничивает частоту — иначе замер упрётся в лимиты очереди
+        bot.SEND_GLOBAL_RATE = bot.SEND_PER_CHAT_RATE = 1e9
+        bot.SEND_GLOBAL_BURST = bot.SEND_PER_CHAT_BURST = 1e9
+    fake_bot = FakeBot(args.send_latency_ms, args.flood_ratio)
+    user_data = {}
+    latencies = {}
+    errors = 0
+    image_payload = os.urandom(args.image_kb * 1024)
+    document_payload = synthetic_syslog(args.document_kb, random.Random(args.seed))
+    sem = asyncio.Semaphore(max(args.concurrency, 1))
+    # Пользователь ждёт ответа, прежде чем спросить снова; иначе новый вопрос отменял бы предыдущий
+    user_locks = {}
+
+    async def run_one(ev):
+        nonlocal errors
+        kind = ev["kind"]
+        if kind not in HANDLERS:
+            kind = "text"
+        uid = ev["user_id"]
+        if kind == "image":
+            update = make_photo_update(fake_bot, uid, image_payload)
+        elif kind == "document":
+            update = make_document_update(fake_bot, uid, "syslog", document_payload)
+        elif kind == "pdf":
+            update = make_callback_update(fake_bot, uid, "save_pdf")
+        else:
+            update = make_text_update(fake_bot, uid, ev["text"])
+        context = FakeContext(fake_bot, user_data.setdefault(uid, {}))
+        handler = HANDLERS[kind]()
+        async with user_locks.setdefault(uid, asyncio.Lock()), sem:
+            t0 = time.perf_counter()
+            try:
+                await handler(update, context)
+            except Exception:
+                errors += 1
+            latencies.setdefault(kind, []).append(time.perf_counter() - t0)
+
+    rss_before = _rss_kb()
+    t_start = time.perf_counter()
+    tasks = [asyncio.create_task(run_one(ev)) for ev in events]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t_start
+    rss_after = _rss_kb()
+
+    total = sum(len(v) for v in latencies.values())
+    provider_calls = sum(p.calls for p in fake_providers)
+    all_lat = sorted(itertools.chain.from_iterable(latencies.values()))
+    result = {
+        "updates": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(_percentile(all_lat, 50) * 1000, 2),
+        "p99_ms": round(_percentile(all_lat, 99) * 1000, 2),
+        "provider_calls_per_update": round(provider_calls / total, 3) if total else 0.0,
+        "telegram_calls_per_update": round(fake_bot.calls / total, 3) if total else 0.0,
+        "telegram_flood_errors": fake_bot.floods,
+        "provider_streams_aborted": sum(p.aborted for p in fake_providers),
+        "hedged": bot.request_stats["hedged"],
+        "hedge_wins": bot.request_stats["hedge_wins"],
+        "provider_timeouts": bot.request_stats["timeouts"],
+        "tokens": bot._usage_summary()["tokens"],
+        "cost_usd": round(bot._usage_summary()["cost"], 4),
+        "rss_kb_before": rss_before,
+        "rss_kb_after": rss_after,
+        "by_kind": {},
+    }
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        result["by_kind"][kind] = {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50) * 1000, 2),
+            "p99_ms": round(_percentile(values, 99) * 1000, 2),
+        }
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Отдельные наборы замеров
+# ---------------------------------------------------------------------------
+
+_VOCAB_VERBS = ["посмотреть", "проверить", "настроить", "перезапустить", "отключить", "обновить", "найти"]
+_VOCAB_OBJECTS = ["открытые порты", "загрузку диска", "логи nginx", "правила iptables", "версию ядра",
+                  "таблицу маршрутизации", "статус systemd", "использование памяти", "dns резолвер",
+                  "сертификат tls", "очередь postfix", "соединения tcp"]
+_VOCAB_TERMS = ("nginx apache haproxy postgres mysql redis kafka rabbitmq docker podman kubelet etcd "
+                "coredns bind9 unbound chrony ntpd sshd fail2ban nftables iptables conntrack ipvs "
+                "wireguard openvpn ipsec strongswan bgp ospf vlan bonding lacp mtu arp ndp dhcp "
+                "netflow sflow ipfix tcpdump wireshark iperf mtr traceroute prometheus grafana "
+                "alertmanager loki zabbix ansible terraform jenkins gitlab helm ingress certbot "
+                "letsencrypt logrotate journald rsyslog auditd selinux apparmor cgroups swap inode "
+                "lvm raid zfs btrfs ext4 xfs nfs samba ceph glusterfs s3 backup cron systemctl "
+                "ulimit sysctl hugepages numa irq softirq").split()
+
+
+def _synthetic_question(rnd: random.Random) -> str:
+    terms = " ".join(rnd.sample(_VOCAB_TERMS, rnd.randint(1, 3)))
+    return f"как {rnd.choice(_VOCAB_VERBS)} {rnd.choice(_VOCAB_OBJECTS)} {terms} {rnd.choice(_VOCAB_CONTEXT)}"
+_VOCAB_CONTEXT = ["в linux", "на ubuntu", "в debian", "на centos", "в docker", "в kubernetes", "на сервере"]
+
+
+def _percentiles_us(values: list) -> tuple:
+    values = sorted(values)
+    return round(_percentile(values, 50) * 1e6, 1), round(_percentile(values, 99) * 1e6, 1)
+
+
+_PARAPHRASE_FILLERS = ["подскажите,", "пожалуйста,", "не подскажете", "срочно:", "вопрос:", "коллеги,"]
+
+
+def _paraphrase(question: str, rnd: random.Random) -> str:
+    """Тот же вопрос в другой записи: вежливые слова, порядок частей, опечатка, регистр и знаки.
+    Синонимы не подставляются — иначе замер повторял бы словарь синонимов."""
+    words = question.split()
+    for _ in range(rnd.randint(1, 3)):
+        kind = rnd.randrange(4)
+        if kind == 0:
+            words.insert(0, rnd.choice(_PARAPHRASE_FILLERS))
+        elif kind == 1 and len(words) > 4:
+            words = words[-2:] + words[:-2]  # «в docker как посмотреть ...»
+        elif kind == 2:
+            long_words = [i for i, w in enumerate(words) if len(w) > 6]
+            if long_words:
+                i = rnd.choice(long_words)
+                pos = rnd.randrange(2, len(words[i]) - 1)
+                words[i] = words[i][:pos] + words[i][pos + 1:]  # пропущенная буква
+        else:
+            words[0] = words[0].capitalize()
+            words[-1] += rnd.choice(["?", "??", " ?", "!"])
+    return " ".join(words)
+
+
+def _fill_semantic_index(entries: int, rnd: random.Random) -> tuple:
+    index = bot._SemanticIndex()
+    questions = []
+    t0 = time.perf_counter()
+    for _ in range(entries):
+        q = _synthetic_question(rnd)
+        questions.append(q)
+        index.add(bot._semantic_embed(q), tuple(bot._NUMBER_RE.findall(q)), q)
+    return index, questions, time.perf_counter() - t0
+
+
+def _semantic_index_info(index, build_s: float) -> dict:
+    return {"stored": index.size, "build_s": round(build_s, 2),
+            "index_mb": round(index.vectors.nbytes / 2**20, 1),
+            "lsh_buckets": sum(len(t) for t in index.tables)}
+
+
+def run_semantic_bench(args) -> dict:
+    """Семантический кэш одной области при штатном лимите SEMANTIC_CACHE_MAX_PER_SCOPE: задержка поиска,
+    доля попаданий на перефразировках и ложных попаданий на других вопросах той же тематики.
+    Отдельно — задержка поиска в индексе на args.scale_entries записей (лимит поднимается только на замер)."""
+    if not bot._load_semantic():
+        raise SystemExit("Для семантического кэша нужен numpy: pip install numpy")
+    rnd = random.Random(args.seed)
+    index, questions, build_s = _fill_semantic_index(args.entries, rnd)
+    # После заполнения сверх лимита в индексе остаются только последние записи
+    stored = questions[-bot.SEMANTIC_CACHE_MAX_PER_SCOPE:]
+    known = set(questions)
+    embed_t, lookup_t = [], []
+    hits = {"paraphrase": 0, "related": 0, "novel": 0}
+    probes = min(args.probes, len(stored))
+    for _ in range(probes):
+        original = rnd.choice(stored)
+        related = _synthetic_question(rnd)  # та же тематика, другой вопрос
+        while related in known:
+            related = _synthetic_question(rnd)
+        novel = f"почему {rnd.choice(_VOCAB_TERMS)} падает с ошибкой {rnd.randint(100, 599)}"
+        for kind, text in (("paraphrase", _paraphrase(original, rnd)), ("related", related), ("novel", novel)):
+            t = time.perf_counter()
+            vec = bot._semantic_embed(text)
+            t1 = time.perf_counter()
+            hit = index.lookup(vec, tuple(bot._NUMBER_RE.findall(text)), bot.SEMANTIC_CACHE_THRESHOLD)
+            lookup_t.append(time.perf_counter() - t1)
+            embed_t.append(t1 - t)
+            # Для перефразировки засчитываем только ответ на исходный вопрос
+            if hit is not None and (kind != "paraphrase" or hit == original):
+                hits[kind] += 1
+    embed_p50, embed_p99 = _percentiles_us(embed_t)
+    lookup_p50, lookup_p99 = _percentiles_us(lookup_t)
+    result = {
+        "entries": args.entries,
+        "max_per_scope": bot.SEMANTIC_CACHE_MAX_PER_SCOPE,
+        **_semantic_index_info(index, build_s),
+        "embed_us_p50_p99": (embed_p50, embed_p99),
+        "lookup_us_p50_p99": (lookup_p50, lookup_p99),
+        "paraphrase_hit_rate": round(hits["paraphrase"] / probes, 3) if probes else 0.0,
+        "related_false_hit_rate": round(hits["related"] / probes, 3) if probes else 0.0,
+        "novel_false_hit_rate": round(hits["novel"] / probes, 3) if probes else 0.0,
+        "threshold": bot.SEMANTIC_CACHE_THRESHOLD,
+        "synonyms": len(bot._semantic_synonyms),
+    }
+    if args.scale_entries:
+        saved_max = bot.SEMANTIC_CACHE_MAX_PER_SCOPE
+        bot.SEMANTIC_CACHE_MAX_PER_SCOPE = max(saved_max, args.scale_entries)
+        try:
+            index, questions, build_s = _fill_semantic_index(args.scale_entries, rnd)
+        finally:
+            bot.SEMANTIC_CACHE_MAX_PER_SCOPE = saved_max
+        lookup_t = []
+        for _ in range(args.probes):
+            text = _paraphrase(rnd.choice(questions), rnd)
+            vec = bot._semantic_embed(text)
+            t = time.perf_counter()
+            index.lookup(vec, tuple(bot._NUMBER_RE.findall(text)), bot.SEMANTIC_CACHE_THRESHOLD)
+            lookup_t.append(time.perf_counter() - t)
+        result["scale"] = {"entries": args.scale_entries, **_semantic_index_info(index, build_s),
+                           "lookup_us_p50_p99": _percentiles_us(lookup_t)}
+    return result
+
+
+def synthetic_answer(size_kb: int, rnd: random.Random) -> str:
+    """Длинный ответ модели: абзацы, списки, блоки кода (в т.ч. длиннее одной части) и эмодзи."""
+    out, size = [], 0
+    while size < size_kb * 1024:
+        first = len(out)
+        r = rnd.random()
+        if r < 0.3:
+            block = [f"```{rnd.choice(['bash', 'python', 'nginx', ''])}"]
+            for _ in range(rnd.randint(3, 400)):
+                block.append("    " + " ".join(rnd.choice(_VOCAB_TERMS) for _ in range(rnd.randint(1, 12))))
+            block.append("```")
+            out.extend(block)
+        elif r < 0.4:
+            out.extend(f"- {_synthetic_question(rnd)} ✅" for _ in range(rnd.randint(2, 10)))
+        elif r < 0.45:
+            out.append(" ".join(_synthetic_question(rnd) for _ in range(rnd.randint(50, 300))))
+        else:
+            out.append(" ".join(_synthetic_question(rnd) for _ in range(rnd.randint(1, 6))))
+            out.append("")
+        size += sum(len(line.encode()) + 1 for line in out[first:])
+    return "\n".join(out)
+
+
+def _legacy_split(text: str, max_len: int) -> list:
+    """Прежний алгоритм: срез хвоста и rfind на каждой части."""
+    parts = []
+    remaining = text
+    while remaining:
+        if len(remaining) <= max_len:
+            parts.append(remaining)
+            break
+        cut = remaining.rfind("\n", 0, max_len)
+        if cut == -1:
+            cut = remaining.rfind(" ", 0, max_len)
+            if cut == -1:
+                cut = max_len
+        parts.append(remaining[:cut])
+        remaining = remaining[cut:].lstrip("\n ")
+    return parts
+
+
+def _broken_fences(parts: list) -> int:
+    return sum(1 for p in parts if sum(1 for line in p.split("\n") if bot._FENCE_RE.match(line)) % 2)
+
+
+def run_split_bench(args) -> dict:
+    """Разбиение длинных ответов на сообщения: время, число частей и порванные блоки кода."""
+    rnd = random.Random(args.seed)
+    rows = {}
+    for size_kb in args.split_kb:
+        text = synthetic_answer(size_kb, rnd)
+        row = {"chars": len(text)}
+        for name, fn in (("legacy", _legacy_split), ("current", bot._split_text_for_telegram)):
+            t = time.perf_counter()
+            for _ in range(args.repeat):
+                parts = fn(text, bot.TELEGRAM_SAFE_SLICE_LEN)
+            row[f"{name}_ms"] = round((time.perf_counter() - t) * 1000 / args.repeat, 2)
+            row[f"{name}_parts"] = len(parts)
+            row[f"{name}_broken_fences"] = _broken_fences(parts)
+            row[f"{name}_max_utf16"] = max(bot._tg_len(p) for p in parts)
+        rows[f"{size_kb}KB"] = row
+    return {"max_len": bot.TELEGRAM_SAFE_SLICE_LEN, "repeat": args.repeat, "sizes": rows}
+
+
+def run_batch_bench(args) -> dict:
+    """Пакетный режим main.py batch на фейковых провайдерах: прямые запросы, повтор с --resume и Batch API."""
+    providers = install_fakes(args)
+    rnd = random.Random(args.seed)
+    questions = [_synthetic_question(rnd) for _ in range(args.questions)]
+    questions += rnd.sample(questions, len(questions) // 10)  # повторы — должны браться из кэша
+    workdir = tempfile.mkdtemp(prefix="bench-batch-")
+    input_path = os.path.join(workdir, "questions.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i, q in enumerate(questions):
+            f.write(json.dumps({"id": i, "question": q}, ensure_ascii=False) + "\n")
+    bot._load_prompts()
+    result = {"questions": len(questions), "prompts": len(bot.PROMPTS)}
+    for name, kwargs in (("live", {}), ("resume", {"resume": True}), ("batch_api", {"use_batch_api": True})):
+        bot.ai_response_cache.clear()
+        calls_before = sum(p.calls for p in providers)
+        output = os.path.join(workdir, "live.jsonl" if name != "batch_api" else "batch.jsonl")
+        summary = asyncio.run(bot.run_batch(input_path, output, providers=["OPEN_AI", "DEEP_SEEK"],
+                                            concurrency=args.concurrency, poll_interval=0.01, **kwargs))
+        summary["provider_calls"] = sum(p.calls for p in providers) - calls_before
+        result[name] = summary
+    result["batch_api_requests"] = sum(p.batch_requests for p in providers)
+    return result
+
+
+def _logging_pass(handler, records: int, text: str) -> list:
+    """Время вызова logger.info на стороне вызывающего (как в handle_text), с."""
+    log = logging.Logger("bench.logging")
+    log.addHandler(handler)
+    timings = []
+    for i in range(records):
+        t = time.perf_counter()
+        if isinstance(handler, bot._QueueLogHandler):
+            log.info("Сообщение пользователя", extra={"user_id": i, "chars": len(text), "text": text})
+        else:
+            log.info(f"Processing message from {i}: {text}")
+        timings.append(time.perf_counter() - t)
+    return timings
+
+
+def run_logging_bench(args) -> dict:
+    """Прежний синхронный StreamHandler против очереди с фоновой записью: стоимость вызова логгера."""
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench-logging-")
+    logging.disable(logging.NOTSET)
+    rows = {}
+    try:
+        for size_kb in args.log_kb:
+            text = synthetic_answer(max(1, int(size_kb)), rnd)[:int(size_kb * 1024)]
+            row = {}
+            legacy_path = os.path.join(workdir, f"legacy-{size_kb}.log")
+            with open(legacy_path, "w", encoding="utf-8") as stream:
+                legacy = logging.StreamHandler(stream)
+                legacy.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+                timings = _logging_pass(legacy, args.log_records, text)
+            row["legacy_p50_us"], row["legacy_p99_us"] = _percentiles_us(timings)
+            row["legacy_file_kb"] = os.path.getsize(legacy_path) // 1024
+            queued_path = os.path.join(workdir, f"queued-{size_kb}.log")
+            with open(queued_path, "w", encoding="utf-8") as stream:
+                writer = bot._LogWriter(stream)
+                handler = bot._QueueLogHandler(writer)
+                handler.setFormatter(logging.Formatter())
+                timings = _logging_pass(handler, args.log_records, text)
+                t = time.perf_counter()
+                writer.stop(timeout=60)
+                row["queued_drain_ms"] = round((time.perf_counter() - t) * 1000, 1)
+            row["queued_p50_us"], row["queued_p99_us"] = _percentiles_us(timings)
+            row["queued_file_kb"] = os.path.getsize(queued_path) // 1024
+            row["queued_dropped"] = writer.dropped
+            rows[f"{size_kb}KB"] = row
+    finally:
+        logging.disable(logging.CRITICAL)
+    return {"records": args.log_records, "max_field_chars": bot.LOG_MAX_FIELD_CHARS, "sizes": rows}
+
+
+def run_local_bench(args) -> dict:
+    """Локальная модель на CPU против удалённых провайдеров: задержка ответа на короткие вопросы
+    и на вопросы со вставленным логом при ручном выборе каждого провайдера и при автовыборе (AUTO)."""
+    rnd = random.Random(args.seed)
+    syslog = synthetic_syslog(4, rnd).decode("utf-8", "replace").splitlines()
+    classes = {
+        "short": (args.local_short_tokens,
+                  [f"{rnd.choice(SAMPLE_QUESTIONS)} #{i}" for i in range(args.local_questions)]),
+        "long": (args.completion_tokens,
+                 ["почему падает сервис? #%d\n%s" % (i, "\n".join(rnd.sample(syslog, 12)))
+                  for i in range(args.local_questions)]),
+    }
+    users = max(args.users, 1)
+    result = {}
+    for route in ("OPEN_AI", "DEEP_SEEK", "LOCAL", "AUTO"):
+        result[route] = {}
+        for cls, (tokens, questions) in classes.items():
+            run_args = SimpleNamespace(**{**vars(args), "completion_tokens": tokens})
+            local = FakeProvider("local", args.local_latency_ms, args.local_token_rate, tokens,
+                                 prefill_rate=args.local_prefill_rate, slots=args.local_slots)
+            bot.local_client = local
+            bot._local_down_until = 0.0
+            bot.ai_response_cache.clear()
+            bot.user_contexts.clear()
+            events = [{"kind": "text", "user_id": 1_000_000 + i % users, "text": q} for i, q in enumerate(questions)]
+            for ev in events:
+                bot.USER_AI_PROVIDER[ev["user_id"]] = route
+            res = asyncio.run(run_bench(events, run_args))
+            result[route][cls] = {"p50_ms": res["p50_ms"], "p99_ms": res["p99_ms"], "errors": res["errors"],
+                                  "local_calls": local.calls}
+    bot.USER_AI_PROVIDER.clear()
+    return {"questions_per_class": args.local_questions, "local_slots": args.local_slots,
+            "local_token_rate": args.local_token_rate, "remote_token_rate": args.token_rate, "routes": result}
+
+
+def run_prewarm_bench(args) -> dict:
+    """Прогрев кэша по частоте вопросов: «вчерашний» трафик обучает трекер, затем перезапуск
+    с пустым кэшем и «сегодняшний» трафик — без прогрева и после _prewarm_once."""
+    rnd = random.Random(args.seed)
+    pool = list(SAMPLE_QUESTIONS) + [_synthetic_question(rnd) for _ in range(args.prewarm_pool)]
+    rnd.shuffle(pool)
+    weights = [1 / (rank + 1) ** args.zipf for rank in range(len(pool))]
+    user_ids = itertools.count(1_000_000)
+
+    def traffic(n: int) -> list:
+        events = []
+        for q in rnd.choices(pool, weights, k=n):
+            if rnd.random() < 0.5:
+                q = q.capitalize() + "?"  # тот же вопрос в другой записи
+            # Новый пользователь на каждый вопрос — все вопросы первые в диалоге
+            events.append({"kind": "text", "user_id": next(user_ids), "text": q})
+        return events
+
+    def restart() -> None:
+        bot.ai_response_cache.clear()
+        bot.user_contexts.clear()
+        bot.semantic_cache.clear()
+
+    bot.SEMANTIC_CACHE_ENABLED = False  # меряем только точный кэш и прогрев
+    bot.PREWARM_ENABLED = True  # по умолчанию прогрев выключен
+    bot._bot().question_tracker = bot.QuestionTracker()
+    bot._prewarmed.clear()
+    bot.PREWARM_TOKEN_BUDGET = args.prewarm_budget
+    asyncio.run(run_bench(traffic(args.updates), args))
+    today = traffic(args.updates)
+    result = {"pool": len(pool), "updates": args.updates, "zipf": args.zipf, "budget_tokens": args.prewarm_budget}
+    for name in ("cold", "prewarmed"):
+        restart()
+        if name == "prewarmed":
+            providers = install_fakes(args)
+            t = time.perf_counter()
+            result["prewarm"] = asyncio.run(bot._prewarm_once())
+            result["prewarm"]["elapsed_s"] = round(time.perf_counter() - t, 2)
+            result["prewarm"]["provider_calls"] = sum(p.calls for p in providers)
+        hits_before = bot.prewarm_stats["hits"]
+        res = asyncio.run(run_bench(today, args))
+        result[name] = {"hit_rate": round(1 - res["provider_calls_per_update"], 3), "p50_ms": res["p50_ms"],
+                        "p99_ms": res["p99_ms"], "prewarm_hits": bot.prewarm_stats["hits"] - hits_before}
+    return result
+
+
+_ANSWER_BOILERPLATE = [
+    "Вот пошаговая инструкция:",
+    "Проверьте статус службы:",
+    "```bash\nsudo systemctl status {t}\n```",
+    "```bash\nsudo systemctl restart {t}\nsudo journalctl -u {t} -n 100 --no-pager\n```",
+    "Если проблема сохраняется, посмотрите журнал: `journalctl -xe` и `dmesg -T | tail -50`.",
+    "⚠️ Перед изменением конфигурации сделайте резервную копию: `cp /etc/{t}/{t}.conf{{,.bak}}`.",
+    "### Возможные причины",
+    "### Решение",
+    "### Проверка",
+    "1. Убедитесь, что у пользователя есть права sudo.",
+    "2. Проверьте, что порт не занят другим процессом: `ss -tulpn | grep :{p}`.",
+    "3. Проверьте правила firewall: `sudo nft list ruleset` или `sudo iptables -L -n -v`.",
+    "Надеюсь, это поможет! Если будут вопросы — пишите. 🙂",
+    "**Важно:** не выполняйте эти команды на production без проверки на тестовом стенде.",
+]
+
+
+def synthetic_bot_answer(rnd: random.Random) -> str:
+    """Ответ бота: типовые заголовки, команды и оговорки вокруг содержательной части."""
+    term, port = rnd.choice(_VOCAB_TERMS), rnd.choice([22, 80, 443, 3306, 5432, 6379, 8080, 9090])
+    lines = [line.format(t=term, p=port) for line in rnd.sample(_ANSWER_BOILERPLATE, rnd.randint(4, 9))]
+    body = synthetic_answer(4, rnd)[:rnd.randint(500, 4000)]
+    lines.insert(rnd.randint(1, len(lines)), body)
+    return "\n\n".join(lines)
+
+
+def run_compress_bench(args) -> dict:
+    """Сжатие ответов в кэше и холодной истории: байты в памяти против CPU на упаковку/распаковку,
+    без словаря и со словарём, обученным на первых ответах."""
+    rnd = random.Random(args.seed)
+    train = [synthetic_bot_answer(rnd).encode("utf-8") for _ in range(max(args.compress_train, 1))]
+    answers = [synthetic_bot_answer(rnd) for _ in range(args.compress_entries)]
+    str_bytes = sum(sys.getsizeof(a) for a in answers)
+    codecs = [("zlib", False)] + ([("zstd", True)] if bot.ZSTD_AVAILABLE else [])
+    saved_zstd, saved_dicts = bot.ZSTD_AVAILABLE, dict(bot._text_dicts)
+    result = {"entries": len(answers), "train_samples": len(train), "str_kb": str_bytes // 1024,
+              "utf8_kb": sum(len(a.encode("utf-8")) for a in answers) // 1024, "modes": {}}
+    try:
+        for codec, zstd in codecs:
+            bot.ZSTD_AVAILABLE = zstd
+            bot._zstd_codecs.clear()
+            for with_dict in (False, True):
+                bot._text_dicts.clear()
+                row = {}
+                if with_dict:
+                    t = time.perf_counter()
+                    bot._text_dicts[1] = bot._train_text_dict(train)
+                    row["train_ms"] = round((time.perf_counter() - t) * 1000, 1)
+                    row["dict_kb"] = len(bot._text_dicts[1]) // 1024
+                pack_t, unpack_t, blobs = [], [], []
+                for a in answers:
+                    t = time.perf_counter()
+                    blob = bot._pack_bytes(a.encode("utf-8"))
+                    pack_t.append(time.perf_counter() - t)
+                    blobs.append(blob)
+                for blob, a in zip(blobs, answers):
+                    t = time.perf_counter()
+                    text = bot._unpack_bytes(blob).decode("utf-8")
+                    unpack_t.append(time.perf_counter() - t)
+                    assert text == a
+                packed = sum(sys.getsizeof(b) for b in blobs)
+                row["packed_kb"] = packed // 1024
+                row["ratio_vs_str"] = round(str_bytes / packed, 2)
+                row["pack_p50_us"], row["pack_p99_us"] = _percentiles_us(pack_t)
+                row["unpack_p50_us"], row["unpack_p99_us"] = _percentiles_us(unpack_t)
+                result["modes"][f"{codec}{'+dict' if with_dict else ''}"] = row
+        # История одного пользователя: HISTORY_LENGTH реплик вопрос/ответ, как её замораживает бот
+        history = []
+        for a in answers[:bot.HISTORY_LENGTH // 2]:
+            history += [{"role": "user", "content": _synthetic_question(rnd)}, {"role": "assistant", "content": a}]
+        live = sys.getsizeof(history) + sum(sys.getsizeof(m) + sum(map(sys.getsizeof, m.values())) for m in history)
+        t = time.perf_counter()
+        blob = bot._pack_bytes(bot.marshal.dumps(history))
+        freeze_us = (time.perf_counter() - t) * 1e6
+        t = time.perf_counter()
+        bot.marshal.loads(bot._unpack_bytes(blob))
+        thaw_us = (time.perf_counter() - t) * 1e6
+        result["history"] = {"messages": len(history), "live_kb": live // 1024, "packed_kb": len(blob) // 1024,
+                             "freeze_us": round(freeze_us, 1), "thaw_us": round(thaw_us, 1)}
+    finally:
+        bot.ZSTD_AVAILABLE = saved_zstd
+        bot._zstd_codecs.clear()
+        bot._text_dicts.clear()
+        bot._text_dicts.update(saved_dicts)
+    return result
+
+
+SUITES = {
+    "semantic": run_semantic_bench,
+    "split": run_split_bench,
+    "batch": run_batch_bench,
+    "logging": run_logging_bench,
+    "local": run_local_bench,
+    "prewarm": run_prewarm_bench,
+    "compress": run_compress_bench,
+}
+
+
+def print_report(result: dict) -> None:
+    print(f"updates:                 {result['updates']} (ошибок: {result['errors']})")
+    print(f"время:                   {result['elapsed_s']} с")
+    print(f"updates/s:               {result['updates_per_s']}")
+    print(f"latency p50 / p99:       {result['p50_ms']} / {result['p99_ms']} мс")
+    print(f"вызовов провайдера/upd:  {result['provider_calls_per_update']}")
+    print(f"вызовов Bot API/upd:     {result['telegram_calls_per_update']} (RetryAfter: {result['telegram_flood_errors']})")
+    print(f"хедж / выиграл / прервано потоков: {result['hedged']} / {result['hedge_wins']} / "
+          f"{result['provider_streams_aborted']} (таймаутов: {result['provider_timeouts']})")
+    print(f"токенов / $:             {result['tokens']} / {result['cost_usd']}")
+    print(f"RSS до / после:          {result['rss_kb_before']} / {result['rss_kb_after']} КБ")
+    for kind, row in result["by_kind"].items():
+        print(f"  {kind:<10} n={row['count']:<6} p50={row['p50_ms']} мс  p99={row['p99_ms']} мс")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    p.add_argument("--suite", default="handlers", choices=["handlers"] + sorted(SUITES),
+                   help="handlers — нагрузка на обработчики; остальные — замеры отдельных подсистем")
+    p.add_argument("--scenario", default="text", choices=sorted(HANDLERS) + ["mixed"])
+    p.add_argument("--updates", type=int, default=200, help="число синтетических апдейтов")
+    p.add_argument("--users", type=int, default=20, help="число различных пользователей")
+    p.add_argument("--concurrency", type=int, default=16, help="одновременно обрабатываемых апдейтов")
+    p.add_argument("--unique-ratio", type=float, default=0.5, help="доля уникальных вопросов (промахи кэша)")
+    p.add_argument("--latency-ms", type=float, default=200.0, help="базовая задержка провайдера")
+    p.add_argument("--token-rate", type=float, default=100.0, help="токенов/с у фейкового провайдера (0 — мгновенно)")
+    p.add_argument("--completion-tokens", type=int, default=200)
+    p.add_argument("--send-latency-ms", type=float, default=0.0, help="задержка фейкового Bot API")
+    p.add_argument("--telegram-limits", action="store_true",
+                   help="соблюдать лимиты Telegram в исходящей очереди (по умолчанию сняты)")
+    p.add_argument("--flood-ratio", type=float, default=0.0, help="доля вызовов Bot API, отвечающих RetryAfter")
+    p.add_argument("--stall-ratio", type=float, default=0.0, help="доля запросов, зависающих до первого токена")
+    p.add_argument("--stall-ms", type=float, default=10_000.0, help="сколько висит зависший запрос")
+    p.add_argument("--hedge", action="store_true", help="дублировать медленные запросы ко второму провайдеру")
+    p.add_argument("--image-kb", type=int, default=64)
+    p.add_argument("--document-kb", type=int, default=1024, help="размер синтетического лога для handle_document")
+    p.add_argument("--replay", help="JSONL с захваченным трафиком (например requests.jsonl)")
+    p.add_argument("--entries", type=int, default=20_000, help="semantic: записей, добавляемых в индекс")
+    p.add_argument("--probes", type=int, default=1000, help="semantic: число поисковых запросов")
+    p.add_argument("--scale-entries", type=int, default=100_000,
+                   help="semantic: размер индекса для замера задержки сверх штатного лимита (0 — не мерить)")
+    p.add_argument("--split-kb", type=int, nargs="+", default=[100, 800, 4000], help="split: размеры ответов, КБ")
+    p.add_argument("--repeat", type=int, default=5, help="split: повторов на размер")
+    p.add_argument("--questions", type=int, default=50, help="batch: число вопросов")
+    p.add_argument("--log-kb", type=float, nargs="+", default=[0.1, 4, 64], help="logging: размеры сообщений, КБ")
+    p.add_argument("--log-records", type=int, default=5000, help="logging: записей на размер")
+    p.add_argument("--local-latency-ms", type=float, default=20.0, help="local: задержка локального сервера")
+    p.add_argument("--local-token-rate", type=float, default=30.0, help="local: токенов/с генерации на CPU")
+    p.add_argument("--local-prefill-rate", type=float, default=300.0, help="local: токенов/с обработки промпта")
+    p.add_argument("--local-slots", type=int, default=2, help="local: одновременных запросов у сервера")
+    p.add_argument("--local-short-tokens", type=int, default=60, help="local: длина ответа на короткий вопрос")
+    p.add_argument("--local-questions", type=int, default=40, help="local: вопросов каждого вида")
+    p.add_argument("--prewarm-pool", type=int, default=300, help="prewarm: различных вопросов в трафике")
+    p.add_argument("--zipf", type=float, default=1.1, help="prewarm: показатель распределения Ципфа")
+    p.add_argument("--prewarm-budget", type=int, default=200_000, help="prewarm: бюджет токенов на прогон")
+    p.add_argument("--compress-entries", type=int, default=2000, help="compress: ответов в кэше")
+    p.add_argument("--compress-train", type=int, default=64, help="compress: ответов для обучения словаря")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    return p
+
+
+def main(argv=None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    rnd = random.Random(args.seed)
+    random.seed(args.seed)
+    if args.suite in SUITES:
+        print(json.dumps(SUITES[args.suite](args), ensure_ascii=False, indent=2))
+        return 0
+    bot._load_prompts()
+    if args.replay:
+        events = list(replay_events(args.replay, args.users))
+    else:
+        events = list(synthetic_events(args.scenario, args.updates, args.users, args.unique_ratio, rnd))
+    result = asyncio.run(run_bench(events, args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
+import time
+_STARTUP_T0 = time.perf_counter()
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -7,15 +10,33 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler,
+    ApplicationHandlerStop
 )
-from openai import OpenAI
 from datetime import datetime
 import os
 import asyncio
+import atexit
+import contextvars
 import json
+import gzip
+import marshal
+import hashlib
+import heapq
+import itertools
+import math
+import queue
 import re
+import signal
+import sys
+import tempfile
+import threading
+import tracemalloc
+import zlib
+from collections import Counter, OrderedDict, deque
 from contextlib import suppress
+from types import SimpleNamespace
 
 # Перед запуском установите переменные окружения BOT_TOKEN (токен Telegram) и OPENAI_API_KEY (ключ OpenAI)
 """Чтение секретов из файлов проекта и/или переменных окружения."""
@@ -46,11 +67,34 @@ def _read_secret_file(filename):
         logging.getLogger(__name__).warning(f"Не удалось прочитать {filename}: {e}")
     return None
 
+# Секреты читаются лениво (_load_secrets) — импорт модуля не трогает диск
+BOT_TOKEN = None
+OPENAI_API_KEY = None
+OPENAI_PROJECT = None
+OPENAI_ORG = None
+DEEPSEEK_API_KEY = None
+_secrets_loaded = False
+
+def _load_secrets(require_bot_token: bool = True) -> None:
+    """Прочитать токены и ключи из файлов/окружения (один раз). Без токена или ключа OpenAI — ошибка.
+    Пакетному режиму токен Telegram не нужен: require_bot_token=False."""
+    global BOT_TOKEN, OPENAI_API_KEY, OPENAI_PROJECT, OPENAI_ORG, DEEPSEEK_API_KEY, _secrets_loaded
+    if _secrets_loaded:
+        return
+    BOT_TOKEN = _read_secret_file("tg_API") or os.environ.get("BOT_TOKEN")
+    if not BOT_TOKEN and require_bot_token:
+        raise RuntimeError("Токен Telegram не найден: задайте файл tg_API или переменную окружения BOT_TOKEN.")
+    OPENAI_API_KEY = _read_secret_file("OpenAI_API") or os.environ.get("OPENAI_API_KEY")
+    if not OPENAI_API_KEY:
+        raise RuntimeError("Ключ OpenAI не найден: задайте файл OpenAI_API или переменную окружения OPENAI_API_KEY.")
+    # Дополнительно: поддержка project/organization для project-ключей (sk-proj-...)
+    OPENAI_PROJECT = _read_secret_file("OpenAI_PROJECT") or os.environ.get("OPENAI_PROJECT")
+    OPENAI_ORG = _read_secret_file("OpenAI_ORG") or os.environ.get("OPENAI_ORG")
+    # DeepSeek (опционально)
+    DEEPSEEK_API_KEY = _read_secret_file("DeepSeek_API") or os.environ.get("DEEPSEEK_API_KEY")
+    _secrets_loaded = True
+
 # Настройки
-_bot_token_from_file = _read_secret_file("tg_API")
-BOT_TOKEN = _bot_token_from_file or os.environ.get("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("Токен Telegram не найден: задайте файл tg_API или переменную окружения BOT_TOKEN.")
 ADMIN_IDS = [8345462682]  # Замените на ваш ID администратора
 SYSTEM_PROMPT = """
 Вы - полезный ассистент в Telegram боте. Отвечайте дружелюбно и информативно.
@@ -59,6 +103,10 @@ SYSTEM_PROMPT = """
 """
 CACHE_SIZE = 1000  # Количество кэшированных ответов
 HISTORY_LENGTH = 5  # Количество сообщений для контекста
+# Дневная квота токенов на пользователя (0 — без ограничений, админы не ограничены)
+USER_DAILY_TOKEN_QUOTA = int(os.environ.get("USER_DAILY_TOKEN_QUOTA", "0"))
+USAGE_FLUSH_INTERVAL = 30  # секунд между сбросами журнала расхода на диск
+USAGE_FLUSH_BATCH = 200  # сбросить раньше, если накопилось столько записей
 
 # Состояния для админ-панели
 ADMIN_MENU, VIEW_STATS, BROADCAST = range(3)
@@ -67,37 +115,296 @@ PROMPT_ADD_TITLE, PROMPT_ADD_CONTENT = range(100, 102)
 # Состояние для пользовательского промпта (без шаблонов)
 CUSTOM_PROMPT = 200
 
-# Настройка логгирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+# Несколько ботов в одном процессе (BOTS_CONFIG): клиенты провайдеров, кэш ответов и метрики общие,
+# а промпты, админы, диалоги и снимок — у каждого бота свои. Состояние текущего бота берётся из
+# contextvar: его выставляет запуск бота, и все задачи бота (апдейты, фон) наследуют значение.
+BOTS_CONFIG = os.environ.get("BOTS_CONFIG", "")  # JSON со списком ботов; пусто — один бот, как раньше
+
+class _BotState:
+    """Всё, что принадлежит одному боту: при нескольких ботах на одного пользователя у каждого свой диалог."""
+
+    def __init__(self, name: str, admins: list, prompts_path: str = "promt_list",
+                 snapshot_path: str = None, token: str = None, owns_shared_stats: bool = True):
+        self.name = name
+        self.token = token
+        self.admins = admins
+        self.prompts_path = prompts_path
+        self.snapshot_path = snapshot_path or os.environ.get("STATE_SNAPSHOT_PATH", "bot_state.snapshot")
+        self.owns_shared_stats = owns_shared_stats  # общие метрики процесса пишутся в снимок одного бота
+        self.audience = set()  # все, кто писал этому боту: получатели его рассылки
+        self.prompts = []  # список словарей: {id, title, content, hash, tokens}
+        self.prompt_by_id = {}
+        self.prompts_version = 0  # растёт при каждом изменении набора промптов
+        self.prompts_stat = None  # (mtime_ns, size) последней загруженной версии файла
+        self.prompt_kb_cache = {"version": None, "lists": OrderedDict()}
+        self.selected_prompt = {}  # user_id -> prompt_id
+        self.ai_provider = {}  # user_id -> 'OPEN_AI' | 'DEEP_SEEK' | 'LOCAL' | 'AUTO'
+        self.contexts = {}
+        self.cold_contexts = {}  # user_id -> сжатый marshal списка реплик
+        self.summaries = {}  # user_id -> {"text": резюме, "pending": вытесненные и ещё не свёрнутые реплики}
+        self.summary_tasks = {}  # user_id -> отложенная задача сжатия
+        self.user_requests = {}  # user_id -> _RequestHandle текущего вопроса
+        self.question_tracker = QuestionTracker()
+        self.prewarmed = {}  # (модель, хэш промпта, норм. вопрос) -> (ответ, время расчёта)
+        self.broadcasts = []  # {"text", "admin_chat_id", "remaining": set(user_id), "delivered", "total"}
+        self.broadcast_tasks = set()
+        self.interrupted = {}  # user_id -> вопрос, ответ на который прервал перезапуск
+        self.dispatcher = None  # исходящая очередь: лимиты Telegram считаются на токен бота
+        self.draining = False
+        self.snapshot_ready = None  # asyncio.Event: снимок загружен (или его нет)
+        self.stop = None  # остановка при нескольких ботах; None — Application.stop_running
+
+_current_bot = contextvars.ContextVar("current_bot", default=None)
+
+def _bot() -> _BotState:
+    return _current_bot.get() or _default_bot
+
+def _is_admin(user_id: int) -> bool:
+    return user_id in _bot().admins
+
+class _PerBot:
+    """Модульное имя (user_contexts, PROMPTS, ...) для поля состояния текущего бота —
+    обработчики обращаются к нему как к обычному dict/list/set."""
+    __slots__ = ("_field",)
+
+    def __init__(self, field: str):
+        self._field = field
+
+    def _target(self):
+        return getattr(_bot(), self._field)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __contains__(self, item) -> bool:
+        return item in self._target()
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value) -> None:
+        self._target()[key] = value
+
+    def __delitem__(self, key) -> None:
+        del self._target()[key]
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self) -> int:
+        return len(self._target())
 
-# Инициализация AI клиентов с системным промтом
-_openai_key_from_file = _read_secret_file("OpenAI_API")
-OPENAI_API_KEY = _openai_key_from_file or os.environ.get("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("Ключ OpenAI не найден: задайте файл OpenAI_API или переменную окружения OPENAI_API_KEY.")
+    def __bool__(self) -> bool:
+        return bool(self._target())
 
-# Дополнительно: поддержка project/organization для project-ключей (sk-proj-...)
-_openai_project_from_file = _read_secret_file("OpenAI_PROJECT")
-OPENAI_PROJECT = _openai_project_from_file or os.environ.get("OPENAI_PROJECT")
+    def __repr__(self) -> str:
+        return repr(self._target())
 
-_openai_org_from_file = _read_secret_file("OpenAI_ORG")
-OPENAI_ORG = _openai_org_from_file or os.environ.get("OPENAI_ORG")
+# Настройка логгирования: вызов логгера только обрезает сообщение и кладёт запись в очередь,
+# JSON и запись на диск — в отдельном потоке пачками, цикл событий на записи не блокируется
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json | text
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Уровни отдельных логгеров: "httpx=WARNING,telegram.ext=DEBUG" (httpx на INFO пишет каждый getUpdates)
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "httpx=WARNING")
+# Доли сохраняемых записей ниже WARNING по ключу extra={"sample": ...}: "user_message=0.1"
+LOG_SAMPLE = os.environ.get("LOG_SAMPLE", "")
+LOG_FILE = os.environ.get("LOG_FILE")  # по умолчанию stderr
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "500"))
+LOG_QUEUE_SIZE = 10_000  # при переполнении записи отбрасываются, отброшенные считаются
+LOG_BATCH = 512  # записей на одну запись в поток и flush
+_LOG_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
 
-ai_client = OpenAI(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT, organization=OPENAI_ORG)  # ✅
+def _truncate(value: str, limit: int = None) -> str:
+    limit = LOG_MAX_FIELD_CHARS if limit is None else limit
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}…[+{len(value) - limit}]"
 
-# DeepSeek (опционально)
-_deepseek_key_from_file = _read_secret_file("DeepSeek_API")
-DEEPSEEK_API_KEY = _deepseek_key_from_file or os.environ.get("DEEPSEEK_API_KEY")
+def _parse_log_spec(spec: str) -> dict:
+    """"a=1,b=2" -> {"a": "1", "b": "2"}; некорректные элементы пропускаются."""
+    result = {}
+    for item in spec.split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip() and value.strip():
+            result[name.strip()] = value.strip()
+    return result
+
+class _LogSampler(logging.Filter):
+    """Оставляет каждую N-ю запись с ключом sample (N = 1/доля). WARNING и выше не сэмплируются."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.every = {}
+        for key, rate in rates.items():
+            with suppress(ValueError):
+                self.every[key] = round(1 / float(rate)) if float(rate) > 0 else 0
+        self.seen = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        every = self.every.get(key, 1)
+        if every <= 1:
+            return every == 1
+        self.seen[key] += 1
+        return self.seen[key] % every == 1
+
+class _LogWriter:
+    """Фоновый поток: забирает из очереди всё накопившееся и пишет одной операцией с одним flush."""
+
+    def __init__(self, stream, json_format: bool = True):
+        self.stream = stream
+        self.json_format = json_format
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, item: tuple) -> None:
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _format(self, item: tuple) -> str:
+        created, level, name, msg, extra, exc = item
+        if self.json_format:
+            record = {"ts": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+                      "level": level, "logger": name, "msg": msg}
+            record.update(extra)
+            if exc:
+                record["exc"] = exc
+            return json.dumps(record, ensure_ascii=False, default=str)
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created))
+        line = f"{ts},{int(created * 1000) % 1000:03d} - {name} - {level} - {msg}"
+        if extra:
+            line += " " + " ".join(f"{k}={v}" for k, v in extra.items())
+        return f"{line}\n{exc}" if exc else line
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            lines = [self._format(item) for item in batch if item is not None]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self._format((time.time(), "WARNING", __name__,
+                                           f"Очередь логов переполнена: отброшено {dropped} записей", {}, None)))
+            try:
+                self.stream.write("\n".join(lines) + "\n" if lines else "")
+                self.stream.flush()
+            except Exception:
+                pass  # логирование не должно ронять бот
+            if stop:
+                return
+
+    def stop(self, timeout: float = 2.0) -> None:
+        """Дописать очередь и остановить поток (atexit)."""
+        with suppress(queue.Full):
+            self.queue.put(None, timeout=timeout)
+        self.thread.join(timeout)
+
+class _QueueLogHandler(logging.Handler):
+    def __init__(self, writer: _LogWriter):
+        super().__init__()
+        self.writer = writer
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            extra = {k: _truncate(v) if isinstance(v, str) else v
+                     for k, v in vars(record).items() if k not in _LOG_RECORD_ATTRS and k != "sample"}
+            bot = _current_bot.get()  # при нескольких ботах — чей это апдейт
+            if bot is not None:
+                extra.setdefault("bot", bot.name)
+            # Трассировку форматируем сразу: в очереди не держим ссылки на кадры стека
+            exc = self.formatter.formatException(record.exc_info) if record.exc_info else None
+            self.writer.put((record.created, record.levelname, record.name,
+                             _truncate(record.getMessage()), extra, exc))
+        except Exception:
+            self.handleError(record)
+
+def _setup_logging() -> _LogWriter:
+    stream = open(LOG_FILE, "a", encoding="utf-8") if LOG_FILE else sys.stderr
+    writer = _LogWriter(stream, json_format=LOG_FORMAT != "text")
+    handler = _QueueLogHandler(writer)
+    handler.setFormatter(logging.Formatter())
+    handler.addFilter(_LogSampler(_parse_log_spec(LOG_SAMPLE)))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_log_spec(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+    atexit.register(writer.stop)
+    return writer
+
+_log_writer = _setup_logging()
+logger = logging.getLogger(__name__)
+
+# AI клиенты создаются при первом обращении или фоновым прогревом после старта:
+# импорт openai занимает сотни миллисекунд и не должен задерживать готовность бота
+ai_client = None
 deepseek_client = None
-if DEEPSEEK_API_KEY:
-    try:
-        deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com/v1")
-    except Exception as e:
-        logger.warning(f"Не удалось инициализировать DeepSeek клиент: {e}")
+_deepseek_init_failed = False
+_clients_lock = threading.Lock()
+
+def _get_openai_client():
+    global ai_client
+    if ai_client is None:
+        with _clients_lock:
+            if ai_client is None:
+                _load_secrets()
+                from openai import OpenAI
+                ai_client = OpenAI(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT, organization=OPENAI_ORG)  # ✅
+    return ai_client
+
+def _get_deepseek_client():
+    """Клиент DeepSeek или None, если ключ не задан или инициализация не удалась."""
+    global deepseek_client, _deepseek_init_failed
+    if deepseek_client is None and not _deepseek_init_failed:
+        with _clients_lock:
+            _load_secrets()
+            if deepseek_client is None and DEEPSEEK_API_KEY and not _deepseek_init_failed:
+                try:
+                    from openai import OpenAI
+                    deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com/v1")
+                except Exception as e:
+                    _deepseek_init_failed = True
+                    logger.warning(f"Не удалось инициализировать DeepSeek клиент: {e}")
+    return deepseek_client
+
+def _deepseek_configured() -> bool:
+    if deepseek_client is not None:
+        return True
+    _load_secrets()
+    return bool(DEEPSEEK_API_KEY) and not _deepseek_init_failed
+
+# Локальная модель: любой OpenAI-совместимый сервер на этой машине (llama.cpp server, Ollama, vLLM)
+LOCAL_LLM_URL = os.environ.get("LOCAL_LLM_URL", "")  # например http://127.0.0.1:8080/v1
+LOCAL_LLM_MODEL = os.environ.get("LOCAL_LLM_MODEL", "local")
+LOCAL_LLM_API_KEY = os.environ.get("LOCAL_LLM_API_KEY", "sk-no-key")  # llama.cpp ключ не проверяет
+local_client = None
+
+def _get_local_client():
+    """Клиент локальной модели или None, если LOCAL_LLM_URL не задан."""
+    global local_client
+    if local_client is None and LOCAL_LLM_URL:
+        with _clients_lock:
+            if local_client is None:
+                from openai import OpenAI
+                # Без повторов: упавший локальный сервер должен сразу уступить удалённому провайдеру
+                local_client = OpenAI(api_key=LOCAL_LLM_API_KEY, base_url=LOCAL_LLM_URL, max_retries=0)
+    return local_client
+
+def _local_configured() -> bool:
+    return local_client is not None or bool(LOCAL_LLM_URL)
 
 default_system_prompt = """Ты — senior-админ и преподаватель с экспертизой в Linux, TCP/IP и Netflow. Твои ответы должны быть:
 
@@ -120,11 +427,13 @@ default_system_prompt = """Ты — senior-админ и преподавате
 - Для общих вопросов уточнять: "На каком дистрибутиве?", "Пришлите вывод `ip a`"
 """
 
-# Загрузка списка промптов из файла promt_list (JSON)
-PROMPTS = []  # список словарей: {id, title, content}
-PROMPT_BY_ID = {}
-USER_SELECTED_PROMPT = {}  # user_id -> prompt_id
-USER_AI_PROVIDER = {}  # user_id -> 'OPEN_AI' | 'DEEP_SEEK'
+# Загрузка списка промптов из файла promt_list (JSON); у каждого бота свой набор
+PROMPTS = _PerBot("prompts")
+PROMPT_BY_ID = _PerBot("prompt_by_id")
+USER_SELECTED_PROMPT = _PerBot("selected_prompt")
+USER_AI_PROVIDER = _PerBot("ai_provider")
+AI_PROVIDER_TITLES = {"OPEN_AI": "OpenAI", "DEEP_SEEK": "DeepSeek", "LOCAL": "Локальная модель",
+                      "AUTO": "Авто: короткие вопросы — локально"}
 
 # Совместимость для старых Python без asyncio.to_thread
 try:
@@ -136,26 +445,345 @@ except AttributeError:  # Python < 3.9
         loop = asyncio.get_event_loop()
         return await loop.run_in_executor(_compat_executor, lambda: func(*args, **kwargs))
 
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks = set()
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 TELEGRAM_MAX_MESSAGE_LEN = 4096
 TELEGRAM_SAFE_SLICE_LEN = 3800
 
+# Исходящая очередь: лимиты Telegram (token bucket на чат и глобально), RetryAfter, приоритеты.
+# Сообщения одного чата уходят строго по порядку; интерактивные ответы обгоняют рассылку.
+SEND_PRIORITY_INTERACTIVE = 0
+SEND_PRIORITY_BULK = 1
+SEND_GLOBAL_RATE = 30.0  # сообщений/с на бота (лимит Bot API)
+SEND_GLOBAL_BURST = 30
+SEND_PER_CHAT_RATE = 1.0  # сообщений/с в один чат
+SEND_PER_CHAT_BURST = 3  # короткая пачка (части длинного ответа) допустима
+SEND_WORKERS = 8  # одновременных запросов к Bot API
+SEND_MAX_RETRIES = 3  # повторы при сетевых ошибках и flood control
+SEND_MAX_TRACKED_CHATS = 10000  # после этого простаивающие бакеты чатов удаляются
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Взять токен. Возвращает 0, если удалось, иначе сколько секунд подождать."""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд (flood control от Telegram)."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+def _retry_after_seconds(err) -> float:
+    value = err.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+def _settle(future: asyncio.Future, result=None, error: Exception = None) -> None:
+    if future.done():  # ожидающий мог быть отменён
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class _OutboundDispatcher:
+    """Очередь исходящих вызовов Bot API. Задания — фабрики корутин, чтобы их можно было повторить."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.global_bucket = _TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.chat_jobs = {}  # chat_id -> deque[(priority, factory, future, attempt)]
+        self.ready = []  # куча (priority, seq, chat_id); у чата не больше одной записи
+        self.scheduled = set()  # чаты в куче или ожидающие таймера
+        self.in_flight = set()  # futures заданий, которые прямо сейчас отправляются
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.workers = [self.loop.create_task(self._worker()) for _ in range(SEND_WORKERS)]
+
+    def submit(self, chat_id, factory, priority: int) -> asyncio.Future:
+        future = self.loop.create_future()
+        self.chat_jobs.setdefault(chat_id, deque()).append((priority, factory, future, 0))
+        if chat_id not in self.scheduled:
+            self._schedule(chat_id)
+        return future
+
+    def _schedule(self, chat_id, delay: float = 0.0) -> None:
+        self.scheduled.add(chat_id)
+        if delay > 0:
+            self.loop.call_later(delay, self._push_ready, chat_id)
+        else:
+            self._push_ready(chat_id)
+
+    def _push_ready(self, chat_id) -> None:
+        jobs = self.chat_jobs.get(chat_id)
+        if not jobs:
+            self.scheduled.discard(chat_id)
+            return
+        heapq.heappush(self.ready, (jobs[0][0], next(self.seq), chat_id))
+        self.wakeup.set()
+
+    def _chat_bucket(self, chat_id) -> _TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= SEND_MAX_TRACKED_CHATS:
+                for cid in [c for c, b in self.chat_buckets.items() if c not in self.chat_jobs and b.is_full()]:
+                    del self.chat_buckets[cid]
+            bucket = self.chat_buckets[chat_id] = _TokenBucket(SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            while not self.ready:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            # Сначала глобальный токен, потом выбор чата: пока ждём, в кучу может прийти
+            # более приоритетное задание, и оно уйдёт первым
+            wait = self.global_bucket.take()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if not self.ready:
+                self.global_bucket.refund()
+                continue
+            _, _, chat_id = heapq.heappop(self.ready)
+            jobs = self.chat_jobs[chat_id]
+            while jobs and jobs[0][2].done():
+                # Ожидающий отказался от отправки (отмена, остановка бота) — не отправляем
+                jobs.popleft()
+            if not jobs:
+                self.global_bucket.refund()
+                del self.chat_jobs[chat_id]
+                self.scheduled.discard(chat_id)
+                continue
+            wait = self._chat_bucket(chat_id).take()
+            if wait > 0:
+                # Чат упёрся в свой лимит — другие чаты тем временем обслуживаются
+                self.global_bucket.refund()
+                self._schedule(chat_id, wait)
+                continue
+            priority, factory, future, attempt = jobs[0]
+            delay = None  # None — задание завершено, иначе пауза перед повтором
+            self.in_flight.add(future)
+            try:
+                result = await factory()
+            except RetryAfter as e:
+                logger.warning(f"Flood control для чата {chat_id}: пауза {_retry_after_seconds(e)} с")
+                # Ограничение действует на весь бот: до истечения retry_after не уходит ничего
+                self.global_bucket.pause(_retry_after_seconds(e))
+                if attempt + 1 < SEND_MAX_RETRIES:
+                    delay = _retry_after_seconds(e)
+                else:
+                    _settle(future, error=e)
+            except NetworkError as e:
+                # TimedOut и BadRequest — наследники NetworkError; BadRequest повторять бессмысленно
+                if attempt + 1 < SEND_MAX_RETRIES and not isinstance(e, BadRequest):
+                    delay = float(2 ** attempt)
+                else:
+                    _settle(future, error=e)
+            except Exception as e:
+                _settle(future, error=e)
+            else:
+                _settle(future, result=result)
+            finally:
+                self.in_flight.discard(future)
+            if delay is None:
+                jobs.popleft()
+            else:
+                jobs[0] = (priority, factory, future, attempt + 1)
+            if jobs:
+                self._schedule(chat_id, delay or 0.0)
+            else:
+                del self.chat_jobs[chat_id]
+                self.scheduled.discard(chat_id)
+
+    def pending(self, priority: int = None) -> int:
+        return sum(1 for jobs in self.chat_jobs.values() for job in jobs
+                   if not job[2].done() and (priority is None or job[0] == priority))
+
+    def abort(self, priority: int, error: Exception) -> int:
+        """Отказаться от неотправленных заданий приоритета priority: ожидающие получат error,
+        воркеры пропустят их. Уже отправляемое сообщение дойдёт."""
+        aborted = 0
+        for jobs in self.chat_jobs.values():
+            for job in jobs:
+                if job[0] == priority and not job[2].done() and job[2] not in self.in_flight:
+                    _settle(job[2], error=error)
+                    aborted += 1
+        return aborted
+
+    async def close(self) -> None:
+        for task in self.workers:
+            task.cancel()
+        for task in self.workers:
+            with suppress(asyncio.CancelledError):
+                await task
+
+def _get_dispatcher() -> _OutboundDispatcher:
+    bot = _bot()
+    if bot.dispatcher is None or bot.dispatcher.loop is not asyncio.get_running_loop():
+        bot.dispatcher = _OutboundDispatcher()
+    return bot.dispatcher
+
+async def _send(chat_id, factory, priority: int = SEND_PRIORITY_INTERACTIVE):
+    """Отправить через общую очередь; factory() создаёт корутину вызова Bot API."""
+    return await _get_dispatcher().submit(chat_id, factory, priority)
+
+# Все сообщения и их правки идут через очередь. Исключение — query.answer(): это не сообщение,
+# лимиты на отправку к нему не относятся, а задержка оставила бы кнопку «крутиться».
+async def _queued_reply_text(message, text: str, **kwargs):
+    return await _send(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+async def _queued_edit_text(query, text: str, **kwargs):
+    return await _send(query.message.chat_id, lambda: query.edit_message_text(text, **kwargs))
+
+async def _queued_reply_document(message, file_path: str):
+    async def factory():
+        # Файл открывается заново при каждой попытке
+        with open(file_path, "rb") as f:
+            return await message.reply_document(document=f, filename=os.path.basename(file_path))
+    return await _send(message.chat_id, factory)
+
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_FENCE_MAX_LEN = 64  # длиннее ограда в частях повторяется обрезанной до стольких символов
+
+def _tg_len(text: str) -> int:
+    """Длина так, как её считает Telegram: в UTF-16 (эмодзи — две единицы)."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
 def _split_text_for_telegram(text: str, max_len: int = TELEGRAM_SAFE_SLICE_LEN) -> list:
+    """Разбивает ответ на части не длиннее max_len (в UTF-16) за один проход по строкам.
+
+    Режет по границам строк, слишком длинные строки — по пробелу. Блок кода
+    (``` или ~~~) не разрывается молча: часть закрывает его, а следующая открывает
+    заново той же строкой (с языком), так что каждая часть остаётся корректным Markdown.
+    """
     if not text:
         return [""]
+    if _tg_len(text) <= max_len:
+        return [text]
     parts = []
-    remaining = text
-    while remaining:
-        if len(remaining) <= max_len:
-            parts.append(remaining)
-            break
-        cut = remaining.rfind("\n", 0, max_len)
-        if cut == -1:
-            cut = remaining.rfind(" ", 0, max_len)
-            if cut == -1:
-                cut = max_len
-        parts.append(remaining[:cut])
-        remaining = remaining[cut:].lstrip("\n ")
-    return parts
+    buf = []       # строки текущей части
+    used = 0       # её длина с переводами строк
+    fence = ""     # строка, открывшая текущий блок кода
+    mark = ""      # её ``` / ~~~ для закрытия (не длиннее _FENCE_MAX_LEN)
+    need = 0       # сколько символов ограды закрывает блок в исходном тексте
+    body = 0       # строк кода в текущей части
+
+    def flush(close: str = "", carry: str = "") -> None:
+        nonlocal buf, used, body
+        chunk = "\n".join(buf).strip("\n")
+        if chunk.strip():
+            parts.append(f"{chunk}\n{close}" if close else chunk)
+        buf = [carry] if carry else []
+        used = _tg_len(carry)
+        body = 0
+
+    pos, n = 0, len(text)
+    while pos <= n:
+        end = text.find("\n", pos)
+        if end == -1:
+            end = n
+        line = text[pos:end]
+        pos = end + 1
+        head = line[:4]
+        m = _FENCE_RE.match(line) if ("`" in head or "~" in head) else None
+        opens = closes = False
+        if m is not None:
+            stripped = line.strip()
+            opens = not fence
+            closes = bool(fence) and stripped.strip(mark[0]) == "" and len(stripped) >= need
+        if opens:
+            new_mark = m.group(1)[:_FENCE_MAX_LEN]
+            new_fence = line if len(line) <= _FENCE_MAX_LEN else new_mark
+            # Открывающая строка с закрытием не влезает в часть или продолжению не остаётся места —
+            # режем блок как обычный текст
+            opens = (_tg_len(line) + len(new_mark) + 1 <= max_len
+                     and _tg_len(new_fence) + len(new_mark) + 4 < max_len)
+        if opens:
+            reserve = len(new_mark) + 1
+        elif fence and not closes:
+            reserve = len(mark) + 1
+        else:
+            reserve = 0
+        size = _tg_len(line)
+        if used + (1 if buf else 0) + size + reserve > max_len and buf and not (fence and len(buf) == 1):
+            if fence and not body:
+                # Открывающая строка оказалась последней — переносим её целиком
+                buf.pop()
+                flush(carry=fence)
+            elif fence:
+                flush(close=mark, carry=fence)
+            else:
+                flush()
+        # Строка длиннее целой части — режем по пробелам, окнами по индексам
+        start = 0
+        while used + (1 if buf else 0) + size + reserve > max_len:
+            room = max(1, max_len - used - (1 if buf else 0) - reserve)
+            window = line[start:start + room]
+            if _tg_len(window) > room:
+                window = window[:room // 2]  # символ — не больше двух единиц UTF-16
+                if not window and buf and buf != [fence]:
+                    # Суррогатная пара не влезает в остаток части — переносим её в следующую
+                    if fence and not closes:
+                        flush(close=mark, carry=fence)
+                    else:
+                        flush()
+                    continue
+                window = window or line[start:start + 1]
+            cut = window.rfind(" ")
+            if cut < len(window) // 2:
+                cut = len(window)
+            buf.append(window[:cut])
+            body += 1 if fence else 0
+            skip = 1 if cut < len(window) else 0
+            size -= _tg_len(window[:cut]) + skip
+            start += cut + skip
+            if fence and not closes:
+                flush(close=mark, carry=fence)
+            else:
+                flush()
+        buf.append(line[start:] if start else line)
+        used += (1 if len(buf) > 1 else 0) + size
+        if opens:
+            # Повторяется в начале каждой части — слишком длинную строку заменяем голыми ```
+            fence, mark, need, body = new_fence, new_mark, len(m.group(1)), 0
+        elif closes:
+            fence = mark = ""
+            need = 0
+        elif fence:
+            body += 1
+    flush(close=mark)
+    return parts or [""]
 
 def _is_region_block_error(err: Exception) -> bool:
     text = str(err).lower()
@@ -173,6 +801,12 @@ def _is_auth_error(err: Exception) -> bool:
     text = str(err).lower()
     return ("401" in text) or ("unauthorized" in text) or ("authentication" in text and "invalid" in text)
 
+class QuotaExceededError(RuntimeError):
+    """Пользователь исчерпал дневную квоту токенов."""
+
+def _is_quota_error(err: Exception) -> bool:
+    return isinstance(err, QuotaExceededError)
+
 def _fix_json_multiline_strings(text: str) -> str:
     """Грубая попытка исправить многострочные строки в JSON для ключей title/content.
     Заменяет реальные переводы строк внутри кавычек на символы \n.
@@ -189,65 +823,167 @@ def _fix_json_multiline_strings(text: str) -> str:
     text = _replace_in_field(text, 'title')
     return text
 
+# Хранилище промптов: атомарная запись, перечитывание файла только при изменении
+PROMPTS_WATCH_INTERVAL = 2.0  # секунд между проверками mtime файла promt_list
+_prompt_tokens_cache = {}  # хэш содержимого -> оценка числа токенов
+
+def _prompts_path() -> str:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, _bot().prompts_path)
+
+def _estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: ~4 байта UTF-8 на токен (кириллица — ~2 символа)."""
+    return max(1, len(text.encode("utf-8")) // 4) if text else 0
+
+def _make_prompt(pid: str, title: str, content: str) -> dict:
+    content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+    tokens = _prompt_tokens_cache.get(content_hash)
+    if tokens is None:
+        tokens = _prompt_tokens_cache[content_hash] = _estimate_tokens(content)
+    return {"id": pid, "title": title, "content": content, "hash": content_hash, "tokens": tokens}
+
+def _default_prompts() -> list:
+    return [_make_prompt("default", "Стандартный промпт", default_system_prompt)]
+
+def _file_stat(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _parse_prompts(text: str) -> list:
+    text = text.strip()
+    if not text:
+        raise ValueError("Файл promt_list пуст")
+    try:
+        data = json.loads(text)
+    except Exception:
+        # Попробуем поправить многострочные строки и распарсить снова
+        fixed_text = _fix_json_multiline_strings(text)
+        data = json.loads(fixed_text)
+    prompts = []
+    # Поддерживаем два формата: список объектов или объект-словарь
+    if isinstance(data, dict):
+        # {"Title": "content", ...}
+        for idx, (title, content) in enumerate(data.items()):
+            prompts.append(_make_prompt(f"p{idx+1}", str(title), str(content)))
+    elif isinstance(data, list):
+        # [{"title": ..., "content": ..., "id": optional}, ...]
+        for idx, item in enumerate(data):
+            title = item.get("title") or f"Prompt {idx+1}"
+            content = item.get("content") or ""
+            pid = item.get("id") or f"p{idx+1}"
+            prompts.append(_make_prompt(str(pid), str(title), str(content)))
+    else:
+        raise ValueError("Неподдерживаемый формат promt_list")
+    return prompts
+
+def _read_prompts_file() -> tuple:
+    """Прочитать и распарсить promt_list. Возвращает (промпты, stat); файла нет — дефолтный промпт."""
+    path = _prompts_path()
+    stat = _file_stat(path)
+    if stat is None:
+        # Файл отсутствует — используем дефолтный промпт
+        return _default_prompts(), None
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    return _parse_prompts(text) or _default_prompts(), stat
+
+def _apply_prompts(prompts: list, stat) -> None:
+    bot = _bot()
+    bot.prompts = prompts
+    bot.prompt_by_id = {p["id"]: p for p in prompts}
+    bot.prompts_version += 1
+    bot.prompts_stat = stat
+
 def _load_prompts():
-    global PROMPTS, PROMPT_BY_ID
-    PROMPTS = []
-    PROMPT_BY_ID = {}
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        path = os.path.join(base_dir, "promt_list")
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                text = f.read().strip()
-            if not text:
-                raise ValueError("Файл promt_list пуст")
-            try:
-                data = json.loads(text)
-            except Exception:
-                # Попробуем поправить многострочные строки и распарсить снова
-                fixed_text = _fix_json_multiline_strings(text)
-                data = json.loads(fixed_text)
-            # Поддерживаем два формата: список объектов или объект-словарь
-            if isinstance(data, dict):
-                # {"Title": "content", ...}
-                for idx, (title, content) in enumerate(data.items()):
-                    pid = f"p{idx+1}"
-                    PROMPTS.append({"id": pid, "title": str(title), "content": str(content)})
-            elif isinstance(data, list):
-                # [{"title": ..., "content": ..., "id": optional}, ...]
-                for idx, item in enumerate(data):
-                    title = item.get("title") or f"Prompt {idx+1}"
-                    content = item.get("content") or ""
-                    pid = item.get("id") or f"p{idx+1}"
-                    PROMPTS.append({"id": str(pid), "title": str(title), "content": str(content)})
-            else:
-                raise ValueError("Неподдерживаемый формат promt_list")
-        else:
-            # Файл отсутствует — используем дефолтный промпт
-            PROMPTS = [{"id": "default", "title": "Стандартный промпт", "content": default_system_prompt}]
-        # Построить индекс
-        PROMPT_BY_ID = {p["id"]: p for p in PROMPTS}
-        if not PROMPTS:
-            PROMPTS = [{"id": "default", "title": "Стандартный промпт", "content": default_system_prompt}]
-            PROMPT_BY_ID = {"default": PROMPTS[0]}
+        prompts, stat = _read_prompts_file()
+        _apply_prompts(prompts, stat)
         logger.info(f"Загружено промптов: {len(PROMPTS)}")
     except Exception as e:
         logger.warning(f"Ошибка загрузки promt_list: {e}. Использую дефолтный промпт.")
-        PROMPTS = [{"id": "default", "title": "Стандартный промпт", "content": default_system_prompt}]
-        PROMPT_BY_ID = {"default": PROMPTS[0]}
+        _apply_prompts(_default_prompts(), _file_stat(_prompts_path()))
 
-def _save_prompts() -> None:
+async def _reload_prompts_if_changed() -> bool:
+    """Перечитать promt_list, если изменились mtime/размер. Разбор — вне цикла событий.
+    При ошибке разбора (например, файл правят прямо сейчас) оставляем текущие промпты.
+    """
+    bot = _bot()
+    current = _file_stat(_prompts_path())
+    if current == bot.prompts_stat:
+        return False
+    try:
+        prompts, stat = await _to_thread(_read_prompts_file)
+    except Exception as e:
+        logger.warning(f"promt_list изменён, но не разобран: {e}")
+        bot.prompts_stat = current  # не повторяем разбор, пока файл снова не изменится
+        return False
+    _apply_prompts(prompts, stat)
+    logger.info(f"promt_list перезагружен: {len(PROMPTS)} промптов")
+    return True
+
+async def _prompts_watch_loop() -> None:
+    while True:
+        await asyncio.sleep(PROMPTS_WATCH_INTERVAL)
+        await _reload_prompts_if_changed()
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Запись во временный файл и os.replace — читатели не увидят файл наполовину.
+    Имя временного файла уникально, поэтому параллельные записи не портят друг друга."""
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+    try:
+        with suppress(FileNotFoundError):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)  # mkstemp создаёт файл с правами 0600
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+
+def _write_prompts_atomic(data: list):
+    path = _prompts_path()
+    _atomic_write(path, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+    return _file_stat(path)
+
+async def _save_prompts() -> None:
     """Сохранить текущие PROMPTS в файл promt_list в формате JSON-списка."""
+    bot = _bot()
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        path = os.path.join(base_dir, "promt_list")
         data = [{"id": p["id"], "title": p["title"], "content": p["content"]} for p in PROMPTS]
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Запоминаем stat своей записи, чтобы наблюдатель не перечитывал файл повторно
+        bot.prompts_stat = await _to_thread(_write_prompts_atomic, data)
         logger.info("Промпты сохранены в promt_list")
     except Exception as e:
         logger.error(f"Не удалось сохранить promt_list: {e}")
 
+def _add_prompt(title: str, content: str) -> dict:
+    """Добавить промпт с уникальным id, производным от заголовка."""
+    new_id_base = re.sub(r"[^a-zA-Z0-9_]", "_", title) or "prompt"
+    new_id = new_id_base
+    suffix = 1
+    while new_id in PROMPT_BY_ID:
+        suffix += 1
+        new_id = f"{new_id_base}_{suffix}"
+    prompt = _make_prompt(new_id, title, content)
+    PROMPTS.append(prompt)
+    PROMPT_BY_ID[new_id] = prompt
+    _bot().prompts_version += 1
+    return prompt
+
+def _delete_prompt(pid: str) -> bool:
+    prompt = PROMPT_BY_ID.pop(pid, None)
+    if prompt is None:
+        return False
+    PROMPTS.remove(prompt)
+    _bot().prompts_version += 1
+    return True
+
 def _get_user_system_prompt(user_id: int, context: ContextTypes.DEFAULT_TYPE = None) -> str:
     pid = USER_SELECTED_PROMPT.get(user_id)
     
@@ -262,48 +998,111 @@ def _get_user_system_prompt(user_id: int, context: ContextTypes.DEFAULT_TYPE = N
     # По умолчанию возвращаем дефолтный промпт
     return default_system_prompt
 
-def _get_user_ai_provider(user_id: int) -> str:
+# Автовыбор (AUTO): короткие простые вопросы — локальной модели, остальное — OpenAI
+LOCAL_AUTO_DEFAULT = os.environ.get("LOCAL_LLM_AUTO", "0") == "1"  # AUTO для тех, кто не выбирал провайдера
+LOCAL_ROUTE_MAX_CHARS = int(os.environ.get("LOCAL_ROUTE_MAX_CHARS", "300"))
+LOCAL_ROUTE_MAX_LINES = 3  # многострочный вопрос — обычно вставленный лог или конфиг
+LOCAL_ROUTE_MAX_CONTEXT_CHARS = 4000  # prefill на CPU медленный: с длинной историей быстрее облако
+# Сколько вопросов AUTO держит у локальной модели одновременно (= слоты сервера, --parallel у llama.cpp):
+# на CPU лишний запрос ждёт в очереди дольше, чем ответ из облака
+LOCAL_MAX_INFLIGHT = int(os.environ.get("LOCAL_MAX_INFLIGHT", "2"))
+LOCAL_RETRY_AFTER = 60.0  # сек: после ошибки соединения AUTO не отправляет вопросы локальной модели
+_local_down_until = 0.0
+_local_inflight = 0
+
+def _user_provider_choice(user_id: int) -> str:
+    """Выбор пользователя, включая AUTO."""
     provider = USER_AI_PROVIDER.get(user_id)
-    if provider in ("OPEN_AI", "DEEP_SEEK"):
+    if provider in AI_PROVIDER_TITLES:
         return provider
+    return "AUTO" if LOCAL_AUTO_DEFAULT and _local_configured() else "OPEN_AI"
+
+def _get_user_ai_provider(user_id: int) -> str:
+    """Провайдер для вызова. При AUTO — OpenAI: локальную модель выбирает только _route_provider."""
+    provider = _user_provider_choice(user_id)
+    return "OPEN_AI" if provider == "AUTO" else provider
+
+def _provider_configured(provider: str) -> bool:
+    if provider == "DEEP_SEEK":
+        return _deepseek_configured()
+    if provider in ("LOCAL", "AUTO"):
+        return _local_configured()
+    return provider == "OPEN_AI"
+
+def _is_simple_question(messages: list) -> bool:
+    question = messages[-1]["content"]
+    if not isinstance(question, str) or len(question) > LOCAL_ROUTE_MAX_CHARS:
+        return False
+    if question.count("\n") >= LOCAL_ROUTE_MAX_LINES or "```" in question:
+        return False
+    # Системный промпт не считаем: он одинаковый и остаётся в кэше префикса локального сервера
+    history = sum(len(m["content"]) for m in messages[1:-1] if isinstance(m["content"], str))
+    return history <= LOCAL_ROUTE_MAX_CONTEXT_CHARS
+
+def _route_provider(user_id: int, messages: list) -> str:
+    if _user_provider_choice(user_id) != "AUTO":
+        return _get_user_ai_provider(user_id)
+    if (_local_configured() and _local_inflight < LOCAL_MAX_INFLIGHT and time.monotonic() >= _local_down_until
+            and _is_simple_question(messages)):
+        return "LOCAL"
     return "OPEN_AI"
 
 def _get_client_and_model(user_id: int, vision: bool = False):
-    provider = _get_user_ai_provider(user_id)
+    return _provider_client_and_model(_get_user_ai_provider(user_id), vision)
+
+def _provider_client_and_model(provider: str, vision: bool = False):
+    if provider == "LOCAL":
+        client = _get_local_client()
+        if not client:
+            raise RuntimeError("Локальная модель не настроена: задайте адрес сервера в LOCAL_LLM_URL")
+        # Vision у локальных моделей обычно не поддерживается
+        return client, LOCAL_LLM_MODEL, not vision
     if provider == "DEEP_SEEK":
-        if not deepseek_client:
+        client = _get_deepseek_client()
+        if not client:
             raise RuntimeError("DeepSeek не настроен: задайте ключ в файле DeepSeek_API или переменной DEEPSEEK_API_KEY")
         model = "deepseek-chat"  # базовая модель чата DeepSeek
         if vision:
             # На текущий момент Vision может быть недоступен у DeepSeek
-            return deepseek_client, model, False
-        return deepseek_client, model, True
+            return client, model, False
+        return client, model, True
     # OPEN_AI по умолчанию
     if vision:
-        return ai_client, "gpt-4-vision-preview", True
-    return ai_client, "gpt-4-turbo", True
+        return _get_openai_client(), "gpt-4-vision-preview", True
+    return _get_openai_client(), "gpt-4-turbo", True
 
-# PDF отчёты (опционально, через reportlab)
-try:
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
-    # Совместимость: устраняем ошибку 'usedforsecurity' для openssl_md5
-    try:
-        from reportlab.lib import utils as rl_utils  # type: ignore
-        import hashlib as _hashlib
-        def _rl_safe_md5(data=b""):
+# PDF отчёты (опционально, через reportlab) — импорт откладывается до первого отчёта или прогрева
+REPORTLAB_AVAILABLE = None  # None — ещё не проверяли
+A4 = canvas = pdfmetrics = TTFont = None
+_reportlab_lock = threading.Lock()
+
+def _load_reportlab() -> bool:
+    global REPORTLAB_AVAILABLE, A4, canvas, pdfmetrics, TTFont
+    if REPORTLAB_AVAILABLE is not None:
+        return REPORTLAB_AVAILABLE
+    with _reportlab_lock:
+        if REPORTLAB_AVAILABLE is not None:
+            return REPORTLAB_AVAILABLE
+        try:
+            from reportlab.lib.pagesizes import A4
+            from reportlab.pdfgen import canvas
+            from reportlab.pdfbase import pdfmetrics
+            from reportlab.pdfbase.ttfonts import TTFont
+            # Совместимость: устраняем ошибку 'usedforsecurity' для openssl_md5
             try:
-                return _hashlib.md5(data, usedforsecurity=False)
-            except TypeError:
-                return _hashlib.md5(data)
-        rl_utils.rl_md5 = _rl_safe_md5  # type: ignore[attr-defined]
-    except Exception:
-        pass
-    REPORTLAB_AVAILABLE = True
-except Exception:
-    REPORTLAB_AVAILABLE = False
+                from reportlab.lib import utils as rl_utils  # type: ignore
+                def _rl_safe_md5(data=b""):
+                    try:
+                        return hashlib.md5(data, usedforsecurity=False)
+                    except TypeError:
+                        return hashlib.md5(data)
+                rl_utils.rl_md5 = _rl_safe_md5  # type: ignore[attr-defined]
+            except Exception:
+                pass
+            REPORTLAB_AVAILABLE = True
+        except Exception:
+            REPORTLAB_AVAILABLE = False
+    return REPORTLAB_AVAILABLE
 
 def _ensure_reports_dir() -> str:
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -315,10 +1114,13 @@ def _ensure_reports_dir() -> str:
 CYR_FONT = "Helvetica"
 CYR_FONT_BOLD = "Helvetica-Bold"
 
+_fonts_registered = False
+
 def _register_cyrillic_fonts():
-    global CYR_FONT, CYR_FONT_BOLD
-    if not REPORTLAB_AVAILABLE:
+    global CYR_FONT, CYR_FONT_BOLD, _fonts_registered
+    if _fonts_registered or not _load_reportlab():
         return
+    _fonts_registered = True
     candidates = [
         ("DejaVuSans", [
             "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
@@ -368,7 +1170,7 @@ def _register_cyrillic_fonts():
             break
 
 def _generate_user_report_pdf(user_id: int) -> str:
-    if not REPORTLAB_AVAILABLE:
+    if not _load_reportlab():
         raise RuntimeError("reportlab не установлен. Установите: pip install reportlab")
     reports_dir = _ensure_reports_dir()
     _register_cyrillic_fonts()
@@ -381,14 +1183,14 @@ def _generate_user_report_pdf(user_id: int) -> str:
     c.setFont(CYR_FONT, 12)
     c.drawString(40, height - 90, f"User ID: {user_id}")
     # Немного данных статистики
-    total_msgs = bot_stats.get("total_messages", 0)
-    active_users = len(bot_stats.get("active_users", []))
+    total_msgs = bot_stats.total_messages
+    active_users = bot_stats.unique_users()
     c.drawString(40, height - 120, f"Всего сообщений в боте: {total_msgs}")
     c.drawString(40, height - 140, f"Уникальных пользователей: {active_users}")
     # Последние сообщения пользователя
     c.drawString(40, height - 180, "Последние сообщения (до 5):")
     y = height - 200
-    ctx = user_contexts.get(user_id, [])[-5:]
+    ctx = (_user_history(user_id) or [])[-5:]
     for msg in ctx:
         line = f"{msg.get('role')}: {msg.get('content')[:90]}"  # обрезаем для простоты
         c.drawString(50, y, line)
@@ -402,7 +1204,7 @@ def _generate_user_report_pdf(user_id: int) -> str:
     return file_path
 
 def _generate_admin_report_pdf() -> str:
-    if not REPORTLAB_AVAILABLE:
+    if not _load_reportlab():
         raise RuntimeError("reportlab не установлен. Установите: pip install reportlab")
     reports_dir = _ensure_reports_dir()
     _register_cyrillic_fonts()
@@ -413,65 +1215,1366 @@ def _generate_admin_report_pdf() -> str:
     c.setFont(CYR_FONT_BOLD, 16)
     c.drawString(40, height - 50, "Сводный отчет по боту")
     c.setFont(CYR_FONT, 12)
-    c.drawString(40, height - 90, f"Всего сообщений: {bot_stats.get('total_messages', 0)}")
-    c.drawString(40, height - 110, f"Уникальных пользователей: {len(bot_stats.get('active_users', []))}")
-    last_active = max(bot_stats.get('last_active', {}).values(), default='нет данных')
-    c.drawString(40, height - 130, f"Последняя активность: {last_active}")
+    c.drawString(40, height - 90, f"Всего сообщений: {bot_stats.total_messages}")
+    c.drawString(40, height - 110, f"Уникальных пользователей: ~{bot_stats.unique_users()}")
+    c.drawString(40, height - 130, f"Последняя активность: {bot_stats.last_active_at()}")
+    c.drawString(40, height - 150, f"DAU / WAU / MAU: ~{bot_stats.distinct_users(1)} / "
+                                   f"~{bot_stats.distinct_users(7)} / ~{bot_stats.distinct_users(30)}")
+    c.drawString(40, height - 170, f"Сообщений за час / сутки: {bot_stats.per_minute.total()} / "
+                                   f"{bot_stats.per_hour.total()}")
+    usage = _usage_summary()
+    c.drawString(40, height - 200, f"Запросов к провайдерам: {usage['calls']}, токенов: {usage['tokens']}")
+    c.drawString(40, height - 220, f"Оценка расходов: ${usage['cost']:.4f}")
+    y = height - 250
+    for dimension, caption in (("provider", "По провайдерам"), ("prompt", "По промптам"), ("source", "По источникам"),
+                               ("user", "По пользователям (топ-5)")):
+        c.setFont(CYR_FONT_BOLD, 12)
+        c.drawString(40, y, f"{caption}:")
+        c.setFont(CYR_FONT, 12)
+        y -= 20
+        for key, row in _top_usage(dimension):
+            if dimension == "prompt" and key in PROMPT_BY_ID:
+                key = PROMPT_BY_ID[key]["title"]
+            elif dimension == "source":
+                key = USAGE_SOURCE_TITLES.get(key, key)
+            tokens = row["prompt_tokens"] + row["completion_tokens"]
+            c.drawString(50, y, f"{key}: {row['calls']} запросов, {tokens} токенов "
+                                f"(кэш {row['cached_tokens']}), ${row['cost']:.4f}")
+            y -= 20
+            if y < 60:
+                c.showPage()
+                c.setFont(CYR_FONT, 12)
+                y = height - 60
+        y -= 10
     c.showPage()
     c.save()
     return file_path
 
-async def get_ai_response(messages: list) -> str:
-    # Выбор клиента/модели на основе первого сообщения system, далее по user_id будет корректнее
-    # Здесь уточнение идёт в вызывающих местах — мы туда передадим user_id для маршрутизации.
-    raise RuntimeError("get_ai_response используется через get_ai_response_for_user")
-    return response.choices[0].message.content
+async def get_ai_response(messages: list) -> str:
+    # Выбор клиента/модели на основе первого сообщения system, далее по user_id будет корректнее
+    # Здесь уточнение идёт в вызывающих местах — мы туда передадим user_id для маршрутизации.
+    raise RuntimeError("get_ai_response используется через get_ai_response_for_user")
+    return response.choices[0].message.content
+
+
+
+
+# А системный промт передавайте в messages через _get_user_system_prompt
+
+
+# Сжатое хранение длинных текстов: ответы в кэше и история молчащих пользователей.
+# Кириллица в str занимает 2 байта на символ, с эмодзи — 4; сжатый UTF-8 — в разы меньше
+TEXT_COMPRESS_MIN_CHARS = 256  # короче — выигрыш меньше заголовков
+TEXT_DICT_SIZE = 32 * 1024  # zlib использует не больше 32 КБ словаря
+TEXT_DICT_MIN_SAMPLES = 64  # ответов, после которых обучается словарь
+TEXT_ZLIB_LEVEL = 6
+try:
+    import zstandard  # опционально: быстрее zlib и умеет обучать словарь
+    ZSTD_AVAILABLE = True
+except Exception:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+_TEXT_CODEC_ZLIB, _TEXT_CODEC_ZSTD = 0, 1
+_text_dicts = {}  # id словаря -> байты; id 0 — без словаря. Старые словари нужны для распаковки
+_text_dict_samples = []  # первые ответы в UTF-8 — материал для обучения словаря
+_zstd_codecs = {}  # id словаря -> (компрессор, декомпрессор)
+
+def _zstd_codec(dict_id: int) -> tuple:
+    codec = _zstd_codecs.get(dict_id)
+    if codec is None:
+        zdict = zstandard.ZstdCompressionDict(_text_dicts[dict_id]) if dict_id else None
+        codec = _zstd_codecs[dict_id] = (zstandard.ZstdCompressor(level=3, dict_data=zdict),
+                                         zstandard.ZstdDecompressor(dict_data=zdict))
+    return codec
+
+def _pack_bytes(raw: bytes) -> bytes:
+    """2 байта заголовка (кодек, id словаря) + сжатые данные. Сжимает последним обученным словарём."""
+    dict_id = max(_text_dicts, default=0)
+    if ZSTD_AVAILABLE:
+        return bytes((_TEXT_CODEC_ZSTD, dict_id)) + _zstd_codec(dict_id)[0].compress(raw)
+    # Сырой deflate (wbits < 0): без zlib-заголовка и контрольной суммы — ещё 6 байт на запись
+    zdict = _text_dicts.get(dict_id)
+    co = zlib.compressobj(TEXT_ZLIB_LEVEL, zlib.DEFLATED, -15, zdict=zdict) if zdict else \
+        zlib.compressobj(TEXT_ZLIB_LEVEL, zlib.DEFLATED, -15)
+    return bytes((_TEXT_CODEC_ZLIB, dict_id)) + co.compress(raw) + co.flush()
+
+def _unpack_bytes(blob: bytes, dicts: dict = None) -> bytes:
+    """dicts — словари другого процесса (снимок бота, обученный отдельно); по умолчанию свои."""
+    codec, dict_id = blob[0], blob[1]
+    if codec == _TEXT_CODEC_ZSTD:
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("данные сжаты zstd, а модуль zstandard не установлен")
+        if dicts is not None and dict_id:
+            return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dicts[dict_id])) \
+                .decompress(blob[2:])
+        return _zstd_codec(dict_id)[1].decompress(blob[2:])
+    zdict = (_text_dicts if dicts is None else dicts).get(dict_id)
+    do = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+    return do.decompress(blob[2:]) + do.flush()
+
+def _build_text_dict(samples: list, size: int = TEXT_DICT_SIZE) -> bytes:
+    """Словарь из готовых фрагментов: строки, повторяющиеся в разных ответах (команды, заголовки,
+    оговорки). Самые частые — в конце: deflate дешевле ссылается на ближние байты."""
+    counts = Counter(line for sample in samples for line in set(sample.split(b"\n")) if len(line) >= 8)
+    common = [line for line, n in counts.most_common() if n >= 2]
+    parts, total = [], 0
+    for line in common:
+        if total + len(line) + 1 > size:
+            break
+        parts.append(line)
+        total += len(line) + 1
+    return b"\n".join(reversed(parts))
+
+def _train_text_dict(samples: list) -> bytes:
+    if ZSTD_AVAILABLE:
+        with suppress(Exception):  # обучению zstd нужно много образцов — иначе словарь из частых строк
+            return zstandard.train_dictionary(TEXT_DICT_SIZE, samples).as_bytes()
+    return _build_text_dict(samples)
+
+async def _maybe_train_text_dict() -> None:
+    """Один раз за жизнь состояния: словарь сохраняется в снимке вместе со сжатыми данными."""
+    if _text_dicts or len(_text_dict_samples) < TEXT_DICT_MIN_SAMPLES:
+        return
+    zdict = await _to_thread(_train_text_dict, list(_text_dict_samples))
+    _text_dict_samples.clear()
+    if zdict:
+        _text_dicts[1] = zdict
+        logger.info(f"Обучен словарь сжатия текстов: {len(zdict)} байт")
+
+class _PackedTextCache:
+    """Кэш ответов: длинные значения хранятся сжатыми и распаковываются при чтении.
+    Не больше max_size записей: при переполнении вытесняется давно не читанная (LRU)."""
+
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, key) -> str:
+        value = self.data[key]
+        self.data.move_to_end(key)
+        return value if isinstance(value, str) else _unpack_bytes(value).decode("utf-8")
+
+    def get(self, key, default=None):
+        return self[key] if key in self.data else default
+
+    def __setitem__(self, key, value: str) -> None:
+        if len(value) >= TEXT_COMPRESS_MIN_CHARS:
+            raw = value.encode("utf-8")
+            if not _text_dicts and len(_text_dict_samples) < TEXT_DICT_MIN_SAMPLES:
+                _text_dict_samples.append(raw)
+            value = _pack_bytes(raw)
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def memory(self) -> tuple:
+        """(сжатых значений, байт в памяти у всех значений) — без распаковки."""
+        packed = sum(1 for value in self.data.values() if isinstance(value, bytes))
+        return packed, sum(sys.getsizeof(value) for value in self.data.values())
+
+def _cache_key(model: str, messages: list) -> tuple:
+    """Ключ кэша — модель и хэш сообщений: кортеж самих сообщений держал бы в памяти всю историю."""
+    digest = hashlib.blake2b(repr([(m["role"], m["content"]) for m in messages]).encode("utf-8"),
+                             digest_size=16).digest()
+    return model, digest
+
+# Кэш для ответов (по модели и хэшу сообщений)
+ai_response_cache = _PackedTextCache()
+
+# Учёт расхода токенов и стоимости
+# Цены в USD за 1M токенов: (вход, вход из кэша провайдера, выход)
+MODEL_PRICING = {
+    "gpt-4-turbo": (10.0, 10.0, 30.0),
+    "gpt-4-vision-preview": (10.0, 10.0, 30.0),
+    "deepseek-chat": (0.27, 0.07, 1.10),
+}
+
+def _usage_path() -> str:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.environ.get("USAGE_LEDGER_PATH", os.path.join(base_dir, "usage_ledger.jsonl"))
+
+def _empty_usage() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost": 0.0}
+
+# Источник расхода: вопросы пользователей или служебная работа бота. Служебный расход не входит
+# в разрез по пользователям и в квоты, а в журнале и отчётах виден по полю source
+USAGE_SOURCE_USER = "user"
+USAGE_SOURCE_SUMMARY = "summary"
+USAGE_SOURCE_PREWARM = "prewarm"
+USAGE_SOURCE_BATCH = "batch"
+USAGE_SOURCE_TITLES = {USAGE_SOURCE_USER: "вопросы пользователей", USAGE_SOURCE_SUMMARY: "резюме диалогов",
+                       USAGE_SOURCE_PREWARM: "прогрев кэша", USAGE_SOURCE_BATCH: "пакетные прогоны"}
+
+# Агрегаты за всё время журнала (после перезапуска восстанавливаются из него): разрез -> ключ -> счётчики
+usage_totals = {"user": {}, "provider": {}, "prompt": {}, "source": {}}
+usage_today = {"date": None, "by_user": {}}  # для дневных квот
+_usage_pending = []  # записи, ещё не сброшенные на диск
+# Размер журнала до первой записи этого процесса: при восстановлении читаем только его,
+# чтобы уже учтённые в памяти записи не посчитались дважды
+_usage_restore = {"bytes": None}
+_usage_restore_lock = threading.Lock()
+
+def _estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> float:
+    price_in, price_cached, price_out = MODEL_PRICING.get(model, (0.0, 0.0, 0.0))
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (uncached * price_in + cached_tokens * price_cached + completion_tokens * price_out) / 1_000_000
+
+def _extract_usage(response_obj) -> tuple:
+    """(prompt, completion, cached) из usage ответа OpenAI/DeepSeek; нули, если usage нет."""
+    usage = getattr(response_obj, "usage", None)
+    if usage is None:
+        return 0, 0, 0
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) if details is not None else 0
+    # DeepSeek сообщает попадания в свой кэш отдельным полем
+    cached_tokens = cached_tokens or getattr(usage, "prompt_cache_hit_tokens", 0) or 0
+    return prompt_tokens, completion_tokens, cached_tokens
+
+def _roll_usage_day() -> dict:
+    today = datetime.now().date().isoformat()
+    if usage_today["date"] != today:
+        usage_today["date"] = today
+        usage_today["by_user"] = {}
+    return usage_today["by_user"]
+
+def _user_tokens_today(user_id: int) -> int:
+    return _roll_usage_day().get(user_id, 0)
+
+def _check_quota(user_id: int) -> None:
+    """Проверка дневной квоты перед обращением к провайдеру."""
+    if USER_DAILY_TOKEN_QUOTA <= 0 or _is_admin(user_id):
+        return
+    if _user_tokens_today(user_id) >= USER_DAILY_TOKEN_QUOTA:
+        raise QuotaExceededError(f"Дневная квота {USER_DAILY_TOKEN_QUOTA} токенов исчерпана")
+
+def _add_usage(totals: dict, rec: dict) -> None:
+    """Прибавить запись журнала к агрегатам totals по всем разрезам."""
+    keys = [("provider", rec["provider"]), ("prompt", rec["prompt_id"]), ("source", rec["source"])]
+    if rec["source"] == USAGE_SOURCE_USER:
+        keys.append(("user", rec["user_id"]))
+    for dimension, key in keys:
+        row = totals[dimension].setdefault(key, _empty_usage())
+        row["calls"] += 1
+        row["prompt_tokens"] += rec["prompt_tokens"]
+        row["completion_tokens"] += rec["completion_tokens"]
+        row["cached_tokens"] += rec["cached_tokens"]
+        row["cost"] += rec["cost"]
+
+def _record_usage(user_id: int, provider: str, model: str, prompt_id: str, response_obj,
+                  cost_factor: float = 1.0, source: str = USAGE_SOURCE_USER) -> None:
+    prompt_tokens, completion_tokens, cached_tokens = _extract_usage(response_obj)
+    cost = _estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens) * cost_factor
+    if source == USAGE_SOURCE_USER:
+        by_user = _roll_usage_day()
+        by_user[user_id] = by_user.get(user_id, 0) + prompt_tokens + completion_tokens
+    rec = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "source": source,
+        "user_id": user_id,
+        "provider": provider,
+        "model": model,
+        "prompt_id": prompt_id,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "cost": round(cost, 6),
+    }
+    _add_usage(usage_totals, rec)
+    _usage_pending.append(rec)
+    if len(_usage_pending) >= USAGE_FLUSH_BATCH:
+        _spawn(_flush_usage())
+
+def _usage_restore_limit() -> int:
+    with _usage_restore_lock:
+        if _usage_restore["bytes"] is None:
+            try:
+                _usage_restore["bytes"] = os.path.getsize(_usage_path())
+            except FileNotFoundError:
+                _usage_restore["bytes"] = 0
+        return _usage_restore["bytes"]
+
+def _write_usage_batch(batch: list) -> None:
+    _usage_restore_limit()
+    with open(_usage_path(), "a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in batch))
+
+async def _flush_usage() -> None:
+    """Сбросить накопленные записи журнала на диск одной пачкой (запись — в потоке)."""
+    if not _usage_pending:
+        return
+    batch = _usage_pending[:]
+    del _usage_pending[:len(batch)]
+    try:
+        await _to_thread(_write_usage_batch, batch)
+    except Exception as e:
+        logger.error(f"Не удалось записать журнал расхода: {e}")
+        _usage_pending[:0] = batch
+
+async def _usage_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        await _flush_usage()
+
+def _read_usage_ledger(day: str, limit: int = None) -> tuple:
+    """Один проход по журналу (первые limit байт): агрегаты по разрезам и расход
+    пользователей за день day. Возвращает (totals, by_user)."""
+    totals = {dimension: {} for dimension in usage_totals}
+    by_user = {}
+    path = _usage_path()
+    if not os.path.exists(path):
+        return totals, by_user
+    read = 0
+    with open(path, "rb") as f:
+        for line in f:
+            read += len(line)
+            if limit is not None and read > limit:
+                break
+            # Порядок полей в строке не гарантирован — разбираем JSON целиком
+            try:
+                raw = json.loads(line)
+                rec = {
+                    "source": raw.get("source", USAGE_SOURCE_USER),  # в старых записях поля нет
+                    "user_id": raw["user_id"], "provider": raw.get("provider"), "prompt_id": raw.get("prompt_id"),
+                    "prompt_tokens": int(raw["prompt_tokens"]), "completion_tokens": int(raw["completion_tokens"]),
+                    "cached_tokens": int(raw.get("cached_tokens") or 0), "cost": float(raw.get("cost") or 0.0),
+                }
+                ts = str(raw.get("ts", ""))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue  # битая или чужая строка (например, оборванная при аварийной остановке)
+            _add_usage(totals, rec)
+            if rec["source"] == USAGE_SOURCE_USER and ts[:10] == day:
+                uid = rec["user_id"]
+                by_user[uid] = by_user.get(uid, 0) + rec["prompt_tokens"] + rec["completion_tokens"]
+    return totals, by_user
+
+def _read_usage_for_day(day: str) -> dict:
+    """Суммарный расход пользователей за день day из журнала на диске."""
+    return _read_usage_ledger(day)[1]
+
+async def _load_usage_ledger() -> None:
+    """После рестарта восстановить из журнала агрегаты для отчётов и сегодняшний расход для квот.
+    Записи этого процесса уже учтены в памяти — читаем журнал только до них."""
+    today = datetime.now().date().isoformat()
+    try:
+        totals, restored = await _to_thread(lambda: _read_usage_ledger(today, _usage_restore_limit()))
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать журнал расхода: {e}")
+        return
+    for dimension, rows in totals.items():
+        current = usage_totals[dimension]
+        for key, row in rows.items():
+            target = current.setdefault(key, _empty_usage())
+            for field, value in row.items():
+                target[field] += value
+    by_user = _roll_usage_day()
+    if usage_today["date"] != today:
+        return
+    for uid, tokens in restored.items():
+        by_user[uid] = by_user.get(uid, 0) + tokens
+
+def _usage_summary() -> dict:
+    rows = usage_totals["provider"].values()
+    return {
+        "calls": sum(r["calls"] for r in rows),
+        "tokens": sum(r["prompt_tokens"] + r["completion_tokens"] for r in rows),
+        "cost": sum(r["cost"] for r in rows),
+    }
+
+def _top_usage(dimension: str, limit: int = 5) -> list:
+    items = usage_totals[dimension].items()
+    return sorted(items, key=lambda kv: kv[1]["cost"], reverse=True)[:limit]
+
+# Семантический кэш (опционально): похожие первые вопросы получают сохранённый ответ.
+# Эмбеддинги локальные — хэшированные основы слов и символьные триграммы, без внешних моделей.
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.9"))  # косинусная близость
+SEMANTIC_CACHE_DIM = 512
+SEMANTIC_CACHE_MAX_PER_SCOPE = 20000  # записей на (модель, промпт); старые вытесняются по кругу
+SEMANTIC_CACHE_MAX_CHARS = 500  # длинные сообщения (логи, файлы) не кэшируем семантически
+SEMANTIC_BRUTE_FORCE_MAX = 4096  # до такого размера области — точный полный перебор
+SEMANTIC_LSH_TABLES = 8  # таблиц SimHash; больше — выше полнота поиска и расход памяти
+SEMANTIC_LSH_BITS = 10  # бит в ключе таблицы; больше — меньше кандидатов
+_SEMANTIC_STOPWORDS = frozenset(
+    "как что почему зачем где когда какой какая какие каким ли в во на для и а с со по из у к о об "
+    "не мне я это можно нужно the a an how to in on of is are what why do does can".split()
+)
+# Необязательный JSON {"основное слово": ["синоним", ...]}: синонимы сводятся к одному признаку
+SEMANTIC_SYNONYMS_PATH = os.environ.get("SEMANTIC_SYNONYMS_PATH", "")
+_semantic_synonyms = {}  # синоним -> основное слово
+_WORD_RE = re.compile(r"\w+")
+_NUMBER_RE = re.compile(r"\d+")
+
+# numpy импортируется только при включённом кэше — на холодный старт он не влияет
+NUMPY_AVAILABLE = None  # None — ещё не проверяли
+np = None
+_numpy_lock = threading.Lock()
+
+def _load_semantic() -> bool:
+    """Импорт numpy и чтение словаря синонимов при первом обращении к семантическому кэшу."""
+    global NUMPY_AVAILABLE, np
+    if NUMPY_AVAILABLE is not None:
+        return NUMPY_AVAILABLE
+    with _numpy_lock:
+        if NUMPY_AVAILABLE is not None:
+            return NUMPY_AVAILABLE
+        try:
+            import numpy as np
+        except Exception:
+            logger.warning("Семантический кэш отключён: numpy не установлен")
+            NUMPY_AVAILABLE = False
+            return False
+        if SEMANTIC_SYNONYMS_PATH:
+            try:
+                with open(SEMANTIC_SYNONYMS_PATH, encoding="utf-8") as f:
+                    for canonical, synonyms in json.load(f).items():
+                        for word in synonyms:
+                            _semantic_synonyms[word.casefold()] = canonical.casefold()
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать словарь синонимов {SEMANTIC_SYNONYMS_PATH}: {e}")
+        NUMPY_AVAILABLE = True
+    return NUMPY_AVAILABLE
+
+def _semantic_embed(text: str):
+    """Хэшированный вектор признаков (signed hashing), нормированный по L2."""
+    slots, weights = [], []
+    for word in _WORD_RE.findall(text.casefold()):
+        if word in _SEMANTIC_STOPWORDS:
+            continue
+        word = _semantic_synonyms.get(word, word)
+        padded = f"<{word}>"
+        features = [(f"w:{word[:6]}", 1.0)]  # грубая основа слова
+        features.extend((padded[i:i + 3], 0.3) for i in range(len(padded) - 2))
+        for feature, weight in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            slots.append(h % SEMANTIC_CACHE_DIM)
+            weights.append(weight if h & 0x80000000 else -weight)
+    vec = np.bincount(slots, weights=weights, minlength=SEMANTIC_CACHE_DIM).astype(np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+_lsh_planes = None
+
+def _semantic_signature(vec) -> list:
+    """SimHash-ключи вектора для каждой из LSH-таблиц."""
+    global _lsh_planes
+    if _lsh_planes is None:
+        rng = np.random.default_rng(20240601)  # фиксированное зерно — ключи стабильны между рестартами
+        _lsh_planes = rng.standard_normal((SEMANTIC_LSH_TABLES * SEMANTIC_LSH_BITS, SEMANTIC_CACHE_DIM)).astype(np.float32)
+    bits = (_lsh_planes @ vec > 0).reshape(SEMANTIC_LSH_TABLES, SEMANTIC_LSH_BITS)
+    return (bits @ (1 << np.arange(SEMANTIC_LSH_BITS))).tolist()
+
+class _SemanticIndex:
+    """Векторы одной области (модель + промпт). Небольшой индекс просматривается целиком,
+    большой — через LSH: несколько таблиц SimHash дают кандидатов, близость считается только для них.
+    """
+
+    def __init__(self):
+        # int8 (вектор × 127): вчетверо меньше памяти, чем float32, и быстрое приведение при поиске
+        self.vectors = np.zeros((256, SEMANTIC_CACHE_DIM), dtype=np.int8)
+        self.answers = []
+        self.numbers = []
+        self.keys = []  # LSH-ключи слота, чтобы убрать его из таблиц при вытеснении
+        self.tables = [{} for _ in range(SEMANTIC_LSH_TABLES)]
+        self.size = 0
+        self.next_slot = 0
+
+    def add(self, vec, numbers: tuple, answer: str) -> None:
+        slot = self.next_slot
+        if slot >= len(self.vectors) and len(self.vectors) < SEMANTIC_CACHE_MAX_PER_SCOPE:
+            grown = np.zeros((min(len(self.vectors) * 2, SEMANTIC_CACHE_MAX_PER_SCOPE), SEMANTIC_CACHE_DIM),
+                             dtype=np.int8)
+            grown[:len(self.vectors)] = self.vectors
+            self.vectors = grown
+        keys = _semantic_signature(vec)
+        if slot < len(self.answers):
+            for table, key in zip(self.tables, self.keys[slot]):
+                table[key].remove(slot)
+            self.answers[slot] = answer
+            self.numbers[slot] = numbers
+            self.keys[slot] = keys
+        else:
+            self.answers.append(answer)
+            self.numbers.append(numbers)
+            self.keys.append(keys)
+        for table, key in zip(self.tables, keys):
+            table.setdefault(key, []).append(slot)
+        self.vectors[slot] = np.round(vec * 127)
+        self.size = max(self.size, slot + 1)
+        self.next_slot = (slot + 1) % SEMANTIC_CACHE_MAX_PER_SCOPE
+
+    def lookup(self, vec, numbers: tuple, threshold: float):
+        if not self.size:
+            return None
+        if self.size <= SEMANTIC_BRUTE_FORCE_MAX:
+            candidates = None
+            rows = self.vectors[:self.size]
+        else:
+            buckets = [table.get(key) for table, key in zip(self.tables, _semantic_signature(vec))]
+            buckets = [b for b in buckets if b]
+            if not buckets:
+                return None
+            # Повторы кандидатов из разных таблиц не мешают argmax — unique не нужен
+            candidates = np.concatenate(buckets)
+            rows = self.vectors[candidates]
+        sims = (rows.astype(np.float32) @ vec) / 127.0
+        best = int(np.argmax(sims))
+        idx = best if candidates is None else int(candidates[best])
+        # Числа (порты, версии, коды ошибок) должны совпадать точно: «порт 22» ≠ «порт 80»
+        if sims[best] >= threshold and self.numbers[idx] == numbers:
+            return self.answers[idx]
+        return None
+
+semantic_cache = {}  # (модель, id промпта, хэш промпта) -> _SemanticIndex
+semantic_cache_stats = {"hits": 0, "misses": 0}
+
+def _semantic_scope(user_id: int, model: str, messages: list):
+    """Область семантического кэша или None, если запрос не подходит (не первый вопрос, длинный текст)."""
+    if not SEMANTIC_CACHE_ENABLED or len(messages) != 2 or not _load_semantic():
+        return None
+    if messages[0]["role"] != "system" or messages[1]["role"] != "user":
+        return None
+    if len(messages[1]["content"]) > SEMANTIC_CACHE_MAX_CHARS:
+        return None
+    prompt_hash = hashlib.sha1(messages[0]["content"].encode("utf-8")).hexdigest()[:16]
+    return (model, USER_SELECTED_PROMPT.get(user_id, "default"), prompt_hash)
+
+def _semantic_get(scope, question: str):
+    index = semantic_cache.get(scope)
+    answer = None
+    if index is not None:
+        answer = index.lookup(_semantic_embed(question), tuple(_NUMBER_RE.findall(question)),
+                              SEMANTIC_CACHE_THRESHOLD)
+    semantic_cache_stats["hits" if answer is not None else "misses"] += 1
+    return answer
+
+def _semantic_put(scope, question: str, answer: str) -> None:
+    index = semantic_cache.get(scope)
+    if index is None:
+        index = semantic_cache[scope] = _SemanticIndex()
+    index.add(_semantic_embed(question), tuple(_NUMBER_RE.findall(question)), answer)
+
+# Дедлайны, отмена и хеджирование запросов к провайдерам
+PROVIDER_DEADLINE = float(os.environ.get("PROVIDER_DEADLINE", "120"))  # сек на один ответ целиком
+PROVIDER_READ_TIMEOUT = 30.0  # сек тишины в соединении до обрыва (таймаут HTTP-клиента)
+PROVIDER_HEDGE_ENABLED = os.environ.get("PROVIDER_HEDGE", "0") == "1"
+PROVIDER_HEDGE_DEFAULT_DELAY = 5.0  # сек до первого токена, пока статистики мало
+PROVIDER_HEDGE_MIN_SAMPLES = 20
+PROVIDER_LATENCY_WINDOW = 200  # последних замеров на провайдера для p95
+PROVIDER_THREADS = int(os.environ.get("PROVIDER_THREADS", "32"))  # потоков под ответы провайдеров
+_provider_executor = None
+STREAM_OPTIONS_PROVIDERS = ("OPEN_AI", "DEEP_SEEK")  # точно принимают stream_options={"include_usage": True}
+_no_stream_options = set()  # (провайдер, модель), отклонившие stream_options
+
+class RequestCancelledError(RuntimeError):
+    """Запрос устарел: пользователь сбросил контекст или задал новый вопрос."""
+
+def _is_cancelled_error(err: Exception) -> bool:
+    return isinstance(err, RequestCancelledError)
+
+def _is_timeout_error(err: Exception) -> bool:
+    return isinstance(err, (asyncio.TimeoutError, TimeoutError)) or "timed out" in str(err).lower()
+
+def _is_bad_request_error(err: Exception) -> bool:
+    # openai.BadRequestError (HTTP 400) — тоже без импорта openai
+    return any(c.__name__ == "BadRequestError" for c in type(err).__mro__)
+
+def _is_connection_error(err: Exception) -> bool:
+    # openai.APIConnectionError и наследник APITimeoutError — без импорта openai (он загружается лениво)
+    return isinstance(err, ConnectionError) or any(c.__name__ == "APIConnectionError" for c in type(err).__mro__)
+
+class _RequestHandle:
+    """Флаг отмены и дедлайн запроса. Отмена родителя (вопроса пользователя)
+    отменяет все вложенные вызовы провайдера; поток проверяет флаг между чанками ответа."""
+
+    def __init__(self, parent: "_RequestHandle" = None, timeout: float = None):
+        self.parent = parent
+        self.cancelled = threading.Event()
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.children = set()
+        self.task = None  # ожидание потока-исполнителя, будится при отмене
+        self.question = None  # текст вопроса — для уведомления, если ответ прервёт перезапуск
+        if parent is not None:
+            parent.children.add(self)
+
+    def is_cancelled(self) -> bool:
+        handle = self
+        while handle is not None:
+            if handle.cancelled.is_set():
+                return True
+            handle = handle.parent
+        return False
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        for child in list(self.children):
+            child.cancel()
+
+    def release(self) -> None:
+        if self.parent is not None:
+            self.parent.children.discard(self)
+
+_current_request = contextvars.ContextVar("current_request", default=None)
+_user_requests = _PerBot("user_requests")  # user_id -> _RequestHandle текущего вопроса
+request_stats = {"cancelled": 0, "timeouts": 0, "hedged": 0, "hedge_wins": 0, "local": 0, "local_fallbacks": 0}
+_provider_ttft = {}  # провайдер -> deque задержек до первого токена, сек
+
+def _begin_user_request(user_id: int, question: str = None):
+    """Новый вопрос делает прежний запрос пользователя устаревшим. Возвращает (handle, token)."""
+    _cancel_user_request(user_id)
+    handle = _user_requests[user_id] = _RequestHandle()
+    handle.question = question
+    return handle, _current_request.set(handle)
+
+def _finish_user_request(user_id: int, handle: _RequestHandle, token) -> None:
+    _current_request.reset(token)
+    if _user_requests.get(user_id) is handle:
+        del _user_requests[user_id]
+
+def _cancel_user_request(user_id: int) -> bool:
+    handle = _user_requests.pop(user_id, None)
+    if handle is None:
+        return False
+    handle.cancel()
+    return True
+
+def _hedge_delay(provider: str) -> float:
+    """p95 задержки до первого токена у провайдера."""
+    samples = _provider_ttft.get(provider)
+    if not samples or len(samples) < PROVIDER_HEDGE_MIN_SAMPLES:
+        return PROVIDER_HEDGE_DEFAULT_DELAY
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+def _hedge_backup(provider: str):
+    """Другой настроенный провайдер (provider, client, model) или None."""
+    if not PROVIDER_HEDGE_ENABLED:
+        return None
+    backup = "DEEP_SEEK" if provider == "OPEN_AI" else "OPEN_AI"
+    if backup == "DEEP_SEEK" and not _deepseek_configured():
+        return None
+    try:
+        client, model, supported = _provider_client_and_model(backup)
+    except Exception:
+        return None
+    return (backup, client, model) if client and supported else None
+
+def _get_provider_executor():
+    """Отдельный пул: потоковый ответ держит поток до конца генерации, и зависший провайдер
+    не должен занимать потоки общего пула (чтение промптов, разбор логов)."""
+    global _provider_executor
+    if _provider_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _provider_executor = ThreadPoolExecutor(max_workers=PROVIDER_THREADS, thread_name_prefix="provider")
+    return _provider_executor
+
+def _estimated_usage(request: dict, parts: list) -> SimpleNamespace:
+    """Оценка токенов, когда провайдер не прислал usage (прерванный ответ, сервер без stream_options)."""
+    return SimpleNamespace(usage=SimpleNamespace(
+        prompt_tokens=sum(_estimate_tokens(str(m.get("content", ""))) for m in request["messages"]),
+        completion_tokens=_estimate_tokens("".join(parts)),
+    ))
+
+def _open_stream(provider: str, client, request: dict, timeout: float):
+    """stream_options поддерживают OpenAI и DeepSeek; старые vLLM и llama.cpp отвечают на него 400.
+    Для таких пар (провайдер, модель) повторяем без него и дальше не передаём."""
+    key = (provider, request["model"])
+    if key not in _no_stream_options:
+        try:
+            return client.chat.completions.create(stream=True, stream_options={"include_usage": True},
+                                                  timeout=timeout, **request)
+        except Exception as e:
+            # У известных провайдеров повторяем только если 400 именно из-за stream_options (vision-модели)
+            if not _is_bad_request_error(e) or (provider in STREAM_OPTIONS_PROVIDERS
+                                                and "stream_options" not in str(e)):
+                raise
+            logger.warning(f"{provider} {request['model']} не принимает stream_options, usage будет оценён: {e}")
+            _no_stream_options.add(key)
+    return client.chat.completions.create(stream=True, timeout=timeout, **request)
+
+def _stream_completion(handle: _RequestHandle, provider: str, client, request: dict,
+                       submitted: float, on_first, on_abort):
+    """Читает потоковый ответ в потоке-исполнителе. При отмене или дедлайне закрывает
+    соединение — провайдер прекращает генерацию, и недополученные токены не оплачиваются."""
+    if handle.is_cancelled():  # отменили, пока ждали свободный поток
+        raise RequestCancelledError("Запрос отменён")
+    timeout = PROVIDER_READ_TIMEOUT if handle.deadline is None else \
+        max(1.0, min(PROVIDER_READ_TIMEOUT, handle.deadline - time.monotonic()))
+    stream = _open_stream(provider, client, request, timeout)
+    parts, usage, first = [], None, True
+    try:
+        for chunk in stream:
+            if first:
+                first = False
+                # От постановки в очередь, как и отсчёт хеджа: ожидание свободного потока тоже задержка
+                _provider_ttft.setdefault(provider, deque(maxlen=PROVIDER_LATENCY_WINDOW)).append(
+                    time.monotonic() - submitted)
+                on_first()
+            if handle.is_cancelled() or handle.expired():
+                # Промпт уже обработан — учитываем его и полученную часть ответа по оценке
+                on_abort(_estimated_usage(request, parts))
+                if handle.is_cancelled():
+                    raise RequestCancelledError("Запрос отменён")
+                raise TimeoutError(f"Провайдер не ответил за {PROVIDER_DEADLINE:.0f} с")
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+    finally:
+        stream.close()
+    if usage is None:
+        usage = _estimated_usage(request, parts).usage
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(parts)))],
+                           usage=usage, model=request["model"])
+
+async def _provider_call(user_id: int, provider: str, client, model: str, messages: list,
+                         started: asyncio.Future = None, prompt_id: str = None,
+                         source: str = USAGE_SOURCE_USER, **kwargs):
+    """Один запрос к провайдеру с дедлайном и отменой вместе с текущим вопросом пользователя.
+    Токены учитываются и у прерванных запросов. started получает имя провайдера с первым токеном."""
+    loop = asyncio.get_running_loop()
+    prompt_id = prompt_id or USER_SELECTED_PROMPT.get(user_id, "default")
+    handle = _RequestHandle(_current_request.get(), PROVIDER_DEADLINE)
+    if handle.is_cancelled():
+        handle.release()
+        raise RequestCancelledError("Запрос отменён")
+
+    def on_first():
+        if started is not None:
+            loop.call_soon_threadsafe(_settle, started, provider)
+
+    def on_abort(partial):
+        loop.call_soon_threadsafe(lambda: _record_usage(user_id, provider, model, prompt_id, partial,
+                                                         source=source))
+
+    request = dict(kwargs, model=model, messages=messages)
+    handle.task = loop.run_in_executor(_get_provider_executor(), _stream_completion, handle, provider, client,
+                                       request, time.monotonic(), on_first, on_abort)
+    try:
+        # Поток проверяет дедлайн только между чанками — до первого чанка ждём здесь
+        response_obj = await asyncio.wait_for(asyncio.shield(handle.task), PROVIDER_DEADLINE)
+    except asyncio.CancelledError:
+        if handle.is_cancelled():
+            request_stats["cancelled"] += 1
+            raise RequestCancelledError("Запрос отменён") from None
+        handle.cancel()  # отменили ожидающего (проигравший хедж, остановка бота)
+        raise
+    except Exception as e:
+        if _is_cancelled_error(e):
+            request_stats["cancelled"] += 1
+        elif _is_timeout_error(e):
+            handle.cancel()
+            request_stats["timeouts"] += 1
+        raise
+    finally:
+        handle.release()
+    if handle.is_cancelled():
+        # Ответ пришёл одновременно с /reset или новым вопросом — он уже не нужен
+        _record_usage(user_id, provider, model, prompt_id, response_obj, source=source)
+        request_stats["cancelled"] += 1
+        raise RequestCancelledError("Запрос отменён")
+    _record_usage(user_id, provider, model, prompt_id, response_obj, source=source)
+    return response_obj
+
+async def _hedged_provider_call(user_id: int, provider: str, client, model: str, messages: list, **kwargs):
+    """Если первый токен не пришёл за p95 задержки, дублирует запрос к другому провайдеру.
+    Побеждает тот, кто первым начал отвечать; второй запрос отменяется."""
+    backup = _hedge_backup(provider)
+    if backup is None:
+        return await _provider_call(user_id, provider, client, model, messages, **kwargs)
+    first = asyncio.get_running_loop().create_future()
+    primary = asyncio.ensure_future(_provider_call(user_id, provider, client, model, messages, first, **kwargs))
+    racers = {provider: primary}
+    try:
+        await asyncio.wait({primary, first}, timeout=_hedge_delay(provider), return_when=asyncio.FIRST_COMPLETED)
+        if primary.done() or first.done():
+            return await primary
+        request_stats["hedged"] += 1
+        backup_provider, backup_client, backup_model = backup
+        logger.info(f"Хедж-запрос к {backup_provider}: {provider} молчит дольше p95")
+        racers[backup_provider] = asyncio.ensure_future(
+            _provider_call(user_id, backup_provider, backup_client, backup_model, messages, first, **kwargs))
+        pending, error = set(racers.values()), None
+        while pending:
+            await asyncio.wait(pending | ({first} if not first.done() else set()),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if first.done():
+                winner = racers[first.result()]
+                if winner is not primary:
+                    request_stats["hedge_wins"] += 1
+                return await winner
+            for task in [t for t in pending if t.done()]:
+                pending.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in racers.values():
+            if not task.done():
+                task.cancel()
+
+async def get_cached_ai_response_for_user(user_id: int, messages: list) -> str:
+    global _local_down_until, _local_inflight
+    provider = _route_provider(user_id, messages)
+    client, model, supported = _provider_client_and_model(provider)
+    # Ключ — модель + хэш (role, content) всех сообщений
+    cache_key = _cache_key(model, messages)
+    if cache_key in ai_response_cache:
+        return ai_response_cache[cache_key]
+    semantic_scope = _semantic_scope(user_id, model, messages)
+    if semantic_scope is not None:
+        answer = _semantic_get(semantic_scope, messages[1]["content"])
+        if answer is not None:
+            return answer
+    answer = _prewarm_get(provider, model, messages)
+    if answer is not None:
+        return answer
+    if not supported:
+        raise RuntimeError("Выбранный провайдер не поддерживает чат-модели")
+    _check_quota(user_id)
+    local_slot = provider == "LOCAL"
+    if local_slot:
+        _local_inflight += 1
+    try:
+        response_obj = await _hedged_provider_call(user_id, provider, client, model, messages, temperature=0.7)
+    except Exception as e:
+        # Автовыбор не должен оставлять без ответа, если локальный сервер лёг
+        if not local_slot or _user_provider_choice(user_id) != "AUTO" or not _is_connection_error(e):
+            raise
+        logger.warning(f"Локальная модель недоступна, вопрос {user_id} передан OpenAI: {e}")
+        _local_down_until = time.monotonic() + LOCAL_RETRY_AFTER
+        request_stats["local_fallbacks"] += 1
+        response_obj = None
+    finally:
+        if local_slot:
+            _local_inflight -= 1
+    if response_obj is None:
+        provider = "OPEN_AI"
+        client, model, supported = _provider_client_and_model(provider)
+        cache_key = (model, cache_key[1])
+        semantic_scope = _semantic_scope(user_id, model, messages)
+        response_obj = await _hedged_provider_call(user_id, provider, client, model, messages, temperature=0.7)
+    if provider == "LOCAL":
+        request_stats["local"] += 1
+    response = response_obj.choices[0].message.content
+    ai_response_cache[cache_key] = response
+    if semantic_scope is not None:
+        _semantic_put(semantic_scope, messages[1]["content"], response)
+    return response
+
+# Хранение контекста диалогов
+user_contexts = _PerBot("contexts")
+
+# История замолчавших пользователей лежит сжатой и распаковывается при следующем сообщении
+HISTORY_COLD_SECONDS = int(os.environ.get("HISTORY_COLD_SECONDS", "600"))
+HISTORY_COLD_CHECK_INTERVAL = 120
+_cold_contexts = _PerBot("cold_contexts")  # user_id -> сжатый marshal списка реплик
+
+def _user_history(user_id: int, create: bool = False):
+    """Контекст пользователя, при необходимости размороженный; None, если его нет и create не задан."""
+    history = user_contexts.get(user_id)
+    if history is None:
+        blob = _cold_contexts.pop(user_id, None)
+        if blob is not None:
+            history = user_contexts[user_id] = marshal.loads(_unpack_bytes(blob))
+        elif create:
+            history = user_contexts[user_id] = []
+    return history
+
+def _freeze_idle_histories(now: float = None) -> int:
+    """Сжимает историю пользователей, молчащих дольше HISTORY_COLD_SECONDS."""
+    cutoff = (now or time.time()) - HISTORY_COLD_SECONDS
+    frozen = 0
+    for uid in list(user_contexts):
+        if uid in _user_requests or bot_stats.last_active.get(uid, 0) > cutoff:
+            continue
+        history = user_contexts.pop(uid)
+        if history:
+            _cold_contexts[uid] = _pack_bytes(marshal.dumps(history))
+            frozen += 1
+    return frozen
+
+async def _cold_history_loop() -> None:
+    # Словарь обучается после загрузки снимка: сжатые в нём данные ссылаются на словари по id
+    await _bot().snapshot_ready.wait()
+    while True:
+        await asyncio.sleep(HISTORY_COLD_CHECK_INTERVAL)
+        try:
+            await _maybe_train_text_dict()
+            frozen = _freeze_idle_histories()
+            if frozen:
+                logger.debug(f"Сжата история {frozen} неактивных пользователей")
+        except Exception as e:
+            logger.error(f"Ошибка сжатия истории: {e}")
+
+# Сжатие старых реплик в резюме: выполняется в фоне, когда пользователь замолчал
+CONTEXT_SUMMARY_ENABLED = os.environ.get("CONTEXT_SUMMARY", "1") == "1"
+SUMMARY_IDLE_SECONDS = 30.0  # пауза пользователя, после которой сворачиваем вытесненные реплики
+SUMMARY_MAX_PENDING = 8  # столько несвёрнутых реплик — сворачиваем, не дожидаясь паузы
+SUMMARY_TURN_CHARS = 2000  # реплика обрезается до стольких символов перед сжатием
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_USER_ID = 0  # служебный расход; в журнале помечается source="summary" и не входит в квоту
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты ведёшь краткое резюме диалога пользователя с ассистентом-сисадмином. Сохраняй факты, нужные "
+    "для продолжения разговора: дистрибутив и версии, конфигурацию, уже выполненные команды и их "
+    "результат, принятые решения, открытые вопросы. Пиши сжато, списком, не более 200 слов."
+)
+user_summaries = _PerBot("summaries")  # user_id -> {"text": резюме, "pending": вытесненные и ещё не свёрнутые реплики}
+_summary_tasks = _PerBot("summary_tasks")  # user_id -> отложенная задача сжатия
+
+def _trim_history(user_id: int) -> None:
+    """Оставляет в контексте HISTORY_LENGTH реплик; вытесненные ждут сжатия в резюме."""
+    history = _user_history(user_id) or []
+    if len(history) <= HISTORY_LENGTH:
+        return
+    if CONTEXT_SUMMARY_ENABLED:
+        state = user_summaries.setdefault(user_id, {"text": "", "pending": []})
+        state["pending"].extend(history[:-HISTORY_LENGTH])
+    user_contexts[user_id] = history[-HISTORY_LENGTH:]
+
+def _history_messages(user_id: int) -> list:
+    """Резюме и ещё не свёрнутые реплики перед текущим контекстом — ничего не теряется, пока сжатие в пути."""
+    state = user_summaries.get(user_id)
+    messages = []
+    if state:
+        if state["text"]:
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущего диалога:\n{state['text']}"})
+        messages.extend(state["pending"])
+    return messages + (_user_history(user_id) or [])
+
+def _schedule_summary(user_id: int) -> None:
+    """Откладывает сжатие до паузы пользователя; каждое новое сообщение сдвигает срок."""
+    state = user_summaries.get(user_id)
+    if not state or not state["pending"]:
+        return
+    task = _summary_tasks.get(user_id)
+    if task is not None and not task.done():
+        if getattr(task, "summary_running", False):
+            return  # уже сжимаем; новые реплики подхватит следующий запуск
+        task.cancel()
+    delay = 0.0 if len(state["pending"]) >= SUMMARY_MAX_PENDING else SUMMARY_IDLE_SECONDS
+    _summary_tasks[user_id] = _spawn(_summarize_later(user_id, state, delay))
+
+def _invalidate_summary(user_id: int) -> None:
+    user_summaries.pop(user_id, None)
+    task = _summary_tasks.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
+async def _summarize_later(user_id: int, state: dict, delay: float) -> None:
+    await asyncio.sleep(delay)
+    asyncio.current_task().summary_running = True
+    _current_request.set(None)  # не наследуем отмену от вопроса, запланировавшего сжатие
+    turns = state["pending"][:]
+    lines = []
+    for msg in turns:
+        who = "Пользователь" if msg["role"] == "user" else "Ассистент"
+        lines.append(f"{who}: {msg['content'][:SUMMARY_TURN_CHARS]}")
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Текущее резюме:\n{state['text'] or '(пусто)'}\n\n"
+                                    f"Новые реплики:\n" + "\n".join(lines) + "\n\nВерни обновлённое резюме."},
+    ]
+    try:
+        client, model, supported = _get_client_and_model(user_id)
+        if not supported:
+            return
+        response_obj = await _provider_call(SUMMARY_USER_ID, _get_user_ai_provider(user_id), client, model,
+                                            messages, prompt_id="summary", source=USAGE_SOURCE_SUMMARY,
+                                            temperature=0.2, max_tokens=SUMMARY_MAX_TOKENS)
+    except Exception as e:
+        # Реплики остаются в pending и уходят в запрос как есть; попробуем при следующей паузе.
+        # Если провайдер долго недоступен, старейшие отбрасываются, как раньше
+        logger.warning(f"Не удалось сжать историю {user_id}: {e}")
+        del state["pending"][:-SUMMARY_MAX_PENDING * 2]
+        return
+    finally:
+        if _summary_tasks.get(user_id) is asyncio.current_task():
+            del _summary_tasks[user_id]
+    if user_summaries.get(user_id) is not state:
+        return  # /reset во время сжатия
+    state["text"] = (response_obj.choices[0].message.content or "").strip()
+    # За время сжатия могли добавиться новые реплики — они остаются в pending
+    del state["pending"][:len(turns)]
+    logger.info(f"История {user_id}: свёрнуто {len(turns)} реплик, резюме {len(state['text'])} символов")
+    if state["pending"]:
+        _schedule_summary(user_id)
+
+# Статистика бота
+STATS_HLL_PRECISION = 11  # 2048 регистров на скетч, ошибка ~2.3%
+STATS_DAYS_KEPT = 30  # дневные скетчи для DAU/WAU/MAU
+LAST_ACTIVE_MAX_USERS = 100_000  # ограничение индекса последней активности
+LAST_ACTIVE_TTL_DAYS = 90  # пользователи, молчащие дольше, выпадают из индекса (рассылка идёт по broadcast_audience)
+
+class _HyperLogLog:
+    """Приближённый подсчёт различных пользователей в фиксированной памяти."""
 
+    def __init__(self, precision: int = STATS_HLL_PRECISION, registers: bytearray = None):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.m)
 
+    def add(self, item) -> None:
+        h = int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "big")
+        idx = h >> (64 - self.p)
+        rest = (h << self.p) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.p + 1 if rest == 0 else 64 - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
 
+    def merge(self, other: "_HyperLogLog") -> "_HyperLogLog":
+        return _HyperLogLog(self.p, bytearray(map(max, self.registers, other.registers)))
 
-# А системный промт передавайте в messages через _get_user_system_prompt
+    def count(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # линейный счёт для малых значений
+        return int(round(estimate))
 
+class _RingCounter:
+    """Кольцевой буфер счётчиков по временным корзинам фиксированной ширины."""
 
-# Кэш для ответов (асинхронный, по tuple сообщений и провайдеру)
-ai_response_cache = {}
+    def __init__(self, slots: int, width_seconds: int):
+        self.slots = slots
+        self.width = width_seconds
+        self.counts = [0] * slots
+        self.epochs = [-1] * slots
 
-async def get_cached_ai_response_for_user(user_id: int, messages: list) -> str:
-    client, model, supported = _get_client_and_model(user_id, vision=False)
-    # Ключ — провайдер+модель + tuple из (role, content) для каждого сообщения
-    cache_key = (model, tuple((msg['role'], msg['content']) for msg in messages))
-    if cache_key in ai_response_cache:
-        return ai_response_cache[cache_key]
-    if not supported:
-        raise RuntimeError("Выбранный провайдер не поддерживает чат-модели")
-    response_obj = await _to_thread(
-        client.chat.completions.create,
-        model=model,
-        messages=messages,
-        temperature=0.7
-    )
-    response = response_obj.choices[0].message.content
-    ai_response_cache[cache_key] = response
-    return response
+    def add(self, ts: float, n: int = 1) -> None:
+        epoch = int(ts // self.width)
+        slot = epoch % self.slots
+        if self.epochs[slot] != epoch:
+            self.epochs[slot] = epoch
+            self.counts[slot] = 0
+        self.counts[slot] += n
 
-# Хранение контекста диалогов
-user_contexts = {}
+    def series(self, now: float = None) -> list:
+        """Счётчики от самой старой корзины к текущей."""
+        current = int((now or time.time()) // self.width)
+        out = []
+        for epoch in range(current - self.slots + 1, current + 1):
+            slot = epoch % self.slots
+            out.append(self.counts[slot] if self.epochs[slot] == epoch else 0)
+        return out
 
-# Статистика бота
-bot_stats = {
-    "total_messages": 0,
-    "active_users": set(),
-    "last_active": {}
-}
+    def total(self, now: float = None) -> int:
+        return sum(self.series(now))
+
+class StatsEngine:
+    """Статистика с ограниченной памятью и O(1) чтением для админ-панели."""
+
+    def __init__(self):
+        self.total_messages = 0
+        self.per_minute = _RingCounter(60, 60)
+        self.per_hour = _RingCounter(24, 3600)
+        self.per_day = _RingCounter(STATS_DAYS_KEPT, 86400)
+        self.all_users = _HyperLogLog()
+        self.daily_users = {}  # порядковый номер дня -> _HyperLogLog
+        self._merged_cache = {}  # (день, окно) -> скетч прошлых дней окна
+        self.last_active = OrderedDict()  # user_id -> ts, по возрастанию ts
+
+    def record(self, user_id: int, ts: float = None) -> None:
+        ts = ts or time.time()
+        self.total_messages += 1
+        self.per_minute.add(ts)
+        self.per_hour.add(ts)
+        self.per_day.add(ts)
+        self.all_users.add(user_id)
+        day = datetime.fromtimestamp(ts).toordinal()
+        sketch = self.daily_users.get(day)
+        if sketch is None:
+            sketch = self.daily_users[day] = _HyperLogLog()
+            for old_day in [d for d in self.daily_users if d <= day - STATS_DAYS_KEPT]:
+                del self.daily_users[old_day]
+            self._merged_cache.clear()
+        sketch.add(user_id)
+        self.last_active[user_id] = ts
+        self.last_active.move_to_end(user_id)
+        self._evict_inactive(ts)
+
+    def _evict_inactive(self, now: float) -> None:
+        cutoff = now - LAST_ACTIVE_TTL_DAYS * 86400
+        while self.last_active:
+            uid, ts = next(iter(self.last_active.items()))
+            if ts >= cutoff and len(self.last_active) <= LAST_ACTIVE_MAX_USERS:
+                break
+            self.last_active.popitem(last=False)
+
+    def distinct_users(self, days: int) -> int:
+        """Приближённое число различных пользователей за последние days дней (включая сегодня)."""
+        today = datetime.now().toordinal()
+        key = (today, days)
+        past = self._merged_cache.get(key)
+        if past is None:
+            past = _HyperLogLog()
+            for day in range(today - days + 1, today):
+                if day in self.daily_users:
+                    past = past.merge(self.daily_users[day])
+            self._merged_cache[key] = past
+        current = self.daily_users.get(today)
+        return (past.merge(current) if current else past).count()
+
+    def unique_users(self) -> int:
+        return self.all_users.count()
+
+    def last_active_at(self) -> str:
+        if not self.last_active:
+            return "нет данных"
+        ts = next(reversed(self.last_active.values()))
+        return datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+    def active_user_ids(self) -> list:
+        return list(self.last_active)
+
+    def to_state(self) -> dict:
+        """Только встроенные типы — для снимка состояния."""
+        return {
+            "total_messages": self.total_messages,
+            "rings": [(r.counts, r.epochs) for r in (self.per_minute, self.per_hour, self.per_day)],
+            "all_users": bytes(self.all_users.registers),
+            "daily_users": {day: bytes(s.registers) for day, s in self.daily_users.items()},
+            "last_active": list(self.last_active.items()),
+        }
+
+    def load_state(self, state: dict) -> None:
+        self.total_messages = state["total_messages"]
+        for ring, (counts, epochs) in zip((self.per_minute, self.per_hour, self.per_day), state["rings"]):
+            if len(counts) == ring.slots:
+                ring.counts, ring.epochs = list(counts), list(epochs)
+        self.all_users = _HyperLogLog(registers=bytearray(state["all_users"]))
+        self.daily_users = {day: _HyperLogLog(registers=bytearray(r)) for day, r in state["daily_users"].items()}
+        self._merged_cache.clear()
+        self.last_active = OrderedDict(state["last_active"])
+
+bot_stats = StatsEngine()
+# Все, кто писал боту: получатели рассылки. Индекс последней активности ограничен и для неё не годится;
+# при нескольких ботах у каждого свои получатели, а bot_stats — общий
+broadcast_audience = _PerBot("audience")
 
 def update_stats(user_id: int):
     """Обновляем статистику"""
-    bot_stats["total_messages"] += 1
-    bot_stats["active_users"].add(user_id)
-    bot_stats["last_active"][user_id] = datetime.now().isoformat()
+    bot_stats.record(user_id)
+    _bot().audience.add(user_id)
+
+# Частота первых вопросов по промптам и прогрев кэша ответов в часы затишья
+PREWARM_ENABLED = os.environ.get("CACHE_PREWARM", "0") == "1"  # прогрев тратит токены — только явно
+PREWARM_HOURS = os.environ.get("PREWARM_HOURS", "3-6")  # локальные часы затишья, «с-по» (можно 23-5)
+PREWARM_TOKEN_BUDGET = int(os.environ.get("PREWARM_TOKEN_BUDGET", "200000"))  # токенов на один прогон
+PREWARM_PROVIDERS = os.environ.get("PREWARM_PROVIDERS", "OPEN_AI").split(",")
+PREWARM_TOP_K = 20  # горячих вопросов на промпт
+PREWARM_MIN_COUNT = 3  # вопросы, заданные реже, не прогреваем
+PREWARM_MAX_AGE = 3 * 86400  # сек: прогретый ответ старше — пересчитываем
+PREWARM_MAX_CHARS = 300  # длинные вопросы не бывают частыми — их не считаем
+PREWARM_CHECK_INTERVAL = 600  # сек между проверками часов затишья
+PREWARM_USER_ID = 0  # служебный расход; в журнале помечается source="prewarm"
+QUESTION_SKETCH_WIDTH = 4096
+QUESTION_SKETCH_DEPTH = 4  # ошибка оценки ≤ e/ширина от всех вопросов с вероятностью 1 - e^-глубина
+_QUESTION_PUNCT_RE = re.compile(r"[^\w\s]+")
+
+def _normalize_question(text: str) -> str:
+    """Регистр, ё/е, пунктуация и пробелы не различают вопросы; числа (порты, версии) — различают."""
+    return " ".join(_QUESTION_PUNCT_RE.sub(" ", text.casefold().replace("ё", "е")).split())
+
+class _CountMinSketch:
+    """Оценка частот в фиксированной памяти; с консервативным обновлением завышает меньше обычного."""
+
+    def __init__(self, width: int = QUESTION_SKETCH_WIDTH, depth: int = QUESTION_SKETCH_DEPTH, table: list = None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else [0] * (width * depth)
+
+    def _cells(self, item: str) -> list:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item: str) -> int:
+        """Учесть вхождение; возвращает новую оценку частоты."""
+        cells = self._cells(item)
+        estimate = min(self.table[c] for c in cells) + 1
+        for c in cells:
+            if self.table[c] < estimate:
+                self.table[c] = estimate
+        return estimate
+
+    def estimate(self, item: str) -> int:
+        return min(self.table[c] for c in self._cells(item))
+
+    def decay(self) -> None:
+        """Старение: половина веса прошлых периодов, чтобы новые частые вопросы вытесняли старые."""
+        self.table = [v >> 1 for v in self.table]
+
+class QuestionTracker:
+    """Частые первые вопросы: один count-min sketch на все промпты и top-K по каждому промпту."""
+
+    def __init__(self, top_k: int = PREWARM_TOP_K):
+        self.top_k = top_k
+        self.sketch = _CountMinSketch()
+        self.top = {}  # prompt_id -> {нормализованный вопрос: [оценка, последняя формулировка]}
+
+    def record(self, prompt_id: str, question: str) -> None:
+        norm = _normalize_question(question)
+        if not norm:
+            return
+        count = self.sketch.add(f"{prompt_id}\x00{norm}")
+        top = self.top.setdefault(prompt_id, {})
+        entry = top.get(norm)
+        if entry is not None:
+            entry[0], entry[1] = count, question
+        elif len(top) < self.top_k:
+            top[norm] = [count, question]
+        else:
+            weakest = min(top, key=lambda k: top[k][0])
+            if count > top[weakest][0]:
+                del top[weakest]
+                top[norm] = [count, question]
+
+    def hottest(self, min_count: int = 1) -> list:
+        """[(оценка, prompt_id, норм. вопрос, формулировка)] по убыванию частоты."""
+        rows = [(count, pid, norm, question) for pid, top in self.top.items()
+                for norm, (count, question) in top.items() if count >= min_count]
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return rows
+
+    def decay(self) -> None:
+        self.sketch.decay()
+        for pid in list(self.top):
+            top = {norm: [count >> 1, q] for norm, (count, q) in self.top[pid].items() if count >> 1}
+            if top:
+                self.top[pid] = top
+            else:
+                del self.top[pid]
+
+    def to_state(self) -> dict:
+        return {"table": self.sketch.table, "width": self.sketch.width, "depth": self.sketch.depth,
+                "top": self.top}
+
+    def load_state(self, state: dict) -> None:
+        if (state["width"], state["depth"]) == (self.sketch.width, self.sketch.depth):
+            self.sketch.table = list(state["table"])
+            self.top = {pid: {norm: list(entry) for norm, entry in top.items()} for pid, top in state["top"].items()}
+
+# Частоты вопросов и прогретые ответы — у каждого бота свои: id промптов у ботов совпадают
+question_tracker = _PerBot("question_tracker")
+_prewarmed = _PerBot("prewarmed")  # (модель, хэш промпта, норм. вопрос) -> (ответ, время расчёта)
+prewarm_stats = {"hits": 0, "answers": 0, "tokens": 0, "last_run": None}
+
+def _prompt_hash(system_prompt: str) -> str:
+    return hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+def _track_question(user_id: int, question: str) -> None:
+    """Учитывает первый вопрос диалога; пользовательские промпты не прогреваются."""
+    pid = USER_SELECTED_PROMPT.get(user_id, "default")
+    if not PREWARM_ENABLED or len(question) > PREWARM_MAX_CHARS or (pid != "default" and pid not in PROMPT_BY_ID):
+        return
+    question_tracker.record(pid, question)
+
+def _prewarm_get(provider: str, model: str, messages: list):
+    """Прогретый ответ на первый вопрос диалога или None. Для локальной модели годится и ответ OpenAI."""
+    if not _prewarmed or len(messages) != 2 or not isinstance(messages[1]["content"], str):
+        return None
+    key = (_prompt_hash(messages[0]["content"]), _normalize_question(messages[1]["content"]))
+    models = [model]
+    if provider == "LOCAL":
+        models.append(_provider_client_and_model("OPEN_AI")[1])
+    for m in models:
+        entry = _prewarmed.get((m,) + key)
+        if entry is not None:
+            prewarm_stats["hits"] += 1
+            return entry[0]
+    return None
+
+def _in_prewarm_hours(now: datetime = None) -> bool:
+    start, _, end = PREWARM_HOURS.partition("-")
+    start, end = int(start), int(end or start)
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+async def _prewarm_once() -> dict:
+    """Пересчитывает ответы на самые частые вопросы, пока не исчерпан бюджет токенов.
+    Возвращает сводку прогона."""
+    _current_request.set(None)  # прогрев не отменяется вопросами пользователей
+    spent = computed = failed = 0
+    hot = question_tracker.hottest(PREWARM_MIN_COUNT)
+    wanted, stale = set(), []
+    for _, pid, norm, question in hot:
+        system_prompt = PROMPT_BY_ID[pid]["content"] if pid in PROMPT_BY_ID else default_system_prompt
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": question}]
+        for provider in PREWARM_PROVIDERS:
+            if not _provider_configured(provider):
+                continue
+            client, model, supported = _provider_client_and_model(provider)
+            key = (model, _prompt_hash(system_prompt), norm)
+            wanted.add(key)
+            entry = _prewarmed.get(key)
+            if supported and (entry is None or time.time() - entry[1] >= PREWARM_MAX_AGE):
+                stale.append((key, pid, provider, client, model, messages))
+    # Самые частые вопросы идут первыми; исчерпан бюджет — прогон окончен
+    for key, pid, provider, client, model, messages in stale:
+        if spent >= PREWARM_TOKEN_BUDGET:
+            break
+        try:
+            response_obj = await _provider_call(PREWARM_USER_ID, provider, client, model, messages,
+                                                prompt_id=pid, source=USAGE_SOURCE_PREWARM, temperature=0.7)
+        except Exception as e:
+            failed += 1
+            logger.warning(f"Прогрев: не удалось получить ответ ({provider}): {e}")
+            continue
+        prompt_tokens, completion_tokens, _ = _extract_usage(response_obj)
+        spent += prompt_tokens + completion_tokens
+        answer = response_obj.choices[0].message.content
+        _prewarmed[key] = (answer, time.time())
+        ai_response_cache[_cache_key(model, messages)] = answer
+        computed += 1
+    # Вопросы, выпавшие из top-K, больше не держим
+    for key in [k for k in _prewarmed if k not in wanted]:
+        del _prewarmed[key]
+    question_tracker.decay()
+    prewarm_stats["answers"] = len(_prewarmed)
+    prewarm_stats["tokens"] += spent
+    prewarm_stats["last_run"] = datetime.now().isoformat(timespec="seconds")
+    summary = {"hot": len(hot), "computed": computed, "failed": failed, "tokens": spent, "cached": len(_prewarmed)}
+    logger.info(f"Прогрев кэша: {summary}")
+    return summary
+
+async def _prewarm_loop() -> None:
+    """Раз в сутки, в часы затишья, прогревает кэш по частым вопросам."""
+    last_day = None
+    while True:
+        await asyncio.sleep(PREWARM_CHECK_INTERVAL)
+        today = datetime.now().date()
+        if last_day == today or not _in_prewarm_hours():
+            continue
+        last_day = today
+        try:
+            await _prewarm_once()
+        except Exception as e:
+            logger.error(f"Прогрев кэша не удался: {e}")
 
 # Обработчик команды /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _cancel_prompt_search(context)
     try:
         user = update.effective_user
         welcome_message = (
@@ -479,6 +2582,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Я умный бот с искусственным интеллектом. Можете:\n"
             "- Задавать вопросы\n"
             "- Отправлять изображения для анализа\n"
+            "- Присылать логи и конфиги файлом для разбора\n"
             "- Вести диалог с контекстом\n\n"
             "Просто напишите или отправьте что-нибудь!"
         )
@@ -490,15 +2594,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ],
             resize_keyboard=True
         )
-        await update.message.reply_text(welcome_message, reply_markup=reply_kb)
+        await _queued_reply_text(update.message, welcome_message, reply_markup=reply_kb)
         update_stats(user.id)
         logger.info(f"/start от пользователя {user.id}")
     except Exception as e:
         logger.error(f"Ошибка в start: {e}")
         if update and hasattr(update, 'message'):
-            await update.message.reply_text("Ошибка при запуске. Попробуйте позже.")
+            await _queued_reply_text(update.message, "Ошибка при запуске. Попробуйте позже.")
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _cancel_prompt_search(context)
     reply_kb = ReplyKeyboardMarkup(
         [
             [KeyboardButton("💬 Задать вопрос"), KeyboardButton("🧠 Выбрать промпт")],
@@ -507,17 +2612,18 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ],
         resize_keyboard=True
     )
-    await update.message.reply_text("Главное меню:", reply_markup=reply_kb)
+    await _queued_reply_text(update.message, "Главное меню:", reply_markup=reply_kb)
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await _queued_reply_text(
+        update.message,
         "🤖 Доступные команды:\n\n"
         "💬 Основные:\n"
         "/start — приветствие и главное меню\n"
         "/menu — показать меню\n"
         "/help — показать эту справку\n\n"
         "🧠 Промпты и AI:\n"
-        "/prompt — выбрать системный промпт\n"
+        "/prompt [текст] — выбрать системный промпт (с поиском по названию)\n"
         "/ai — выбрать AI провайдера (OpenAI / DeepSeek)\n\n"
         "💬 Взаимодействие:\n"
         "/question — задать вопрос (аналог кнопки)\n"
@@ -528,62 +2634,190 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "⚙️ Администрирование:\n"
         "/reset — очистить контекст диалога\n"
         "/reload_prompts — перезагрузить список промптов (админ)\n"
-        "/admin — админ-панель\n\n"
+        "/admin — админ-панель\n"
+        "/profile [cpu|tasks|mem] [сек] — профилирование (админ)\n\n"
         "📋 Также доступны кнопки в главном меню!"
     )
 
 async def reset_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    _cancel_prompt_search(context)
+    # Ответ на старый вопрос больше не нужен — обрываем генерацию, чтобы не платить за неё
+    cancelled = _cancel_user_request(user_id)
     user_contexts[user_id] = []
-    await update.message.reply_text("Контекст диалога очищен.")
+    _cold_contexts.pop(user_id, None)
+    _invalidate_summary(user_id)
+    await _queued_reply_text(update.message, "Контекст диалога очищен." + (" Текущий запрос отменён." if cancelled else ""))
 
 async def my_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        if not REPORTLAB_AVAILABLE:
-            await update.message.reply_text("reportlab не установлен. Установите: pip install reportlab")
+        if not _load_reportlab():
+            await _queued_reply_text(update.message, "reportlab не установлен. Установите: pip install reportlab")
             return
         file_path = _generate_user_report_pdf(user_id)
-        with open(file_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=os.path.basename(file_path))
+        await _queued_reply_document(update.message, file_path)
     except Exception as e:
         logger.error(f"Ошибка генерации пользовательского отчёта: {e}")
-        await update.message.reply_text("Не удалось создать PDF отчет.")
+        await _queued_reply_text(update.message, "Не удалось создать PDF отчет.")
 
 async def admin_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS:
-        await update.message.reply_text("Доступ запрещен.")
+    if not _is_admin(update.effective_user.id):
+        await _queued_reply_text(update.message, "Доступ запрещен.")
         return
     try:
-        if not REPORTLAB_AVAILABLE:
-            await update.message.reply_text("reportlab не установлен. Установите: pip install reportlab")
+        if not _load_reportlab():
+            await _queued_reply_text(update.message, "reportlab не установлен. Установите: pip install reportlab")
             return
         file_path = _generate_admin_report_pdf()
-        with open(file_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=os.path.basename(file_path))
+        await _queued_reply_document(update.message, file_path)
     except Exception as e:
         logger.error(f"Ошибка генерации админского отчёта: {e}")
-        await update.message.reply_text("Не удалось создать PDF отчет.")
+        await _queued_reply_text(update.message, "Не удалось создать PDF отчет.")
+
+# Профилирование (админ): сэмплирующий профайлер, стеки asyncio-задач, tracemalloc
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.01  # 100 Гц — накладные расходы пренебрежимо малы
+PROFILE_TOP_ALLOCATIONS = 30
+_profile_running = False
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name.replace(";", ":")
+
+def _sample_stacks(seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL) -> Counter:
+    """Периодически снимает стеки всех потоков (event loop и воркеры _to_thread).
+    Возвращает счётчик свёрнутых стеков "поток;корень;...;лист" -> число сэмплов.
+    """
+    own_ident = threading.get_ident()
+    samples = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}").replace(";", ":"))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+def _write_folded_profile(samples: Counter) -> str:
+    """Сохраняет сэмплы в формате folded stacks (flamegraph.pl, speedscope, inferno)."""
+    file_path = os.path.join(_ensure_reports_dir(), f"profile_{datetime.now():%Y%m%d_%H%M%S}.folded")
+    with open(file_path, "w", encoding="utf-8") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    return file_path
+
+def _dump_asyncio_tasks() -> str:
+    """Стеки всех asyncio-задач текущего цикла событий в текстовый файл."""
+    file_path = os.path.join(_ensure_reports_dir(), f"tasks_{datetime.now():%Y%m%d_%H%M%S}.txt")
+    tasks = asyncio.all_tasks()
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(f"Задач: {len(tasks)}\n\n")
+        for task in tasks:
+            f.write(f"=== {task.get_name()}\n")
+            task.print_stack(file=f)
+            f.write("\n")
+    return file_path
+
+async def _trace_allocations(seconds: float) -> str:
+    """Включает tracemalloc на заданное время и сохраняет топ аллокаций по строкам."""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(10)
+    try:
+        await asyncio.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    file_path = os.path.join(_ensure_reports_dir(), f"alloc_{datetime.now():%Y%m%d_%H%M%S}.txt")
+    with open(file_path, "w", encoding="utf-8") as f:
+        stats = snapshot.statistics("lineno")
+        total = sum(stat.size for stat in stats)
+        f.write(f"Всего отслежено: {total / 1024:.1f} KiB\n\n")
+        for idx, stat in enumerate(stats[:PROFILE_TOP_ALLOCATIONS], 1):
+            frame = stat.traceback[0]
+            f.write(f"#{idx}: {frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB, {stat.count} блоков\n")
+    return file_path
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /profile [cpu|tasks|mem] [секунды] (только админ)"""
+    global _profile_running
+    if not _is_admin(update.effective_user.id):
+        await _queued_reply_text(update.message, "Доступ запрещен.")
+        return
+    args = list(context.args or [])
+    mode = args.pop(0).lower() if args and not args[0].isdigit() else "cpu"
+    seconds = PROFILE_DEFAULT_SECONDS
+    if args and args[0].isdigit():
+        seconds = min(max(int(args[0]), 1), PROFILE_MAX_SECONDS)
+    if mode not in ("cpu", "tasks", "mem"):
+        await _queued_reply_text(update.message, "Использование: /profile [cpu|tasks|mem] [секунды]")
+        return
+    if _profile_running and mode != "tasks":
+        await _queued_reply_text(update.message, "Профилирование уже запущено.")
+        return
+    try:
+        if mode == "tasks":
+            file_path = _dump_asyncio_tasks()
+        else:
+            _profile_running = True
+            await _queued_reply_text(update.message, f"Профилирование ({mode}) на {seconds} с...")
+            if mode == "cpu":
+                samples = await _to_thread(_sample_stacks, seconds)
+                file_path = _write_folded_profile(samples)
+            else:
+                file_path = await _trace_allocations(seconds)
+        await _queued_reply_document(update.message, file_path)
+    except Exception as e:
+        logger.error(f"Ошибка профилирования: {e}")
+        await _queued_reply_text(update.message, "Не удалось выполнить профилирование.")
+    finally:
+        if mode != "tasks":
+            _profile_running = False
 
 async def question_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /question - аналог кнопки '💬 Задать вопрос'"""
-    await update.message.reply_text("Напишите свой вопрос сообщением ниже.")
+    _cancel_prompt_search(context)
+    await _queued_reply_text(update.message, "Напишите свой вопрос сообщением ниже.")
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /stats - аналог кнопки '📊 Статистика'"""
+    used_today = _user_tokens_today(update.effective_user.id)
+    quota = f" из {USER_DAILY_TOKEN_QUOTA}" if USER_DAILY_TOKEN_QUOTA > 0 else ""
     stats_text = (
         f"📊 Статистика бота:\n"
-        f"• Всего сообщений: {bot_stats['total_messages']}\n"
-        f"• Уникальных пользователей: {len(bot_stats['active_users'])}"
+        f"• Всего сообщений: {bot_stats.total_messages}\n"
+        f"• Уникальных пользователей: ~{bot_stats.unique_users()}\n"
+        f"• Ваши токены за сегодня: {used_today}{quota}"
     )
-    await update.message.reply_text(stats_text)
+    await _queued_reply_text(update.message, stats_text)
+
+_MENU_BUTTONS = {"💬 Задать вопрос", "🧠 Выбрать промпт", "📊 Статистика", "🧹 Сброс контекста",
+                 "🤖 Выбрать AI", "📄 Мой отчет"}
 
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
+    if text == "/" or text in _MENU_BUTTONS:
+        _cancel_prompt_search(context)
     
     # Обработка ввода одиночного "/"
     if text == "/":
-        await update.message.reply_text(
+        await _queued_reply_text(
+            update.message,
             "🤖 Введите команду:\n"
             "/start - приветствие и меню\n"
             "/help - показать все команды\n"
@@ -607,69 +2841,118 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     # иначе — пропускаем дальше к обычной обработке текста
     return await handle_text(update, context)
 
+async def _reply_provider_error(update: Update, e: Exception, fallback_text: str) -> None:
+    """Сообщение пользователю об ошибке провайдера; общее для текста, изображений и файлов."""
+    if _is_cancelled_error(e):
+        logger.info(f"Запрос {update.effective_user.id} отменён: вопрос устарел")
+    elif _is_quota_error(e):
+        await _queued_reply_text(
+            update.message,
+            f"Дневная квота токенов ({USER_DAILY_TOKEN_QUOTA}) исчерпана. Попробуйте завтра."
+        )
+    elif _is_timeout_error(e):
+        logger.error(f"Provider timeout: {e}")
+        await _queued_reply_text(update.message, "Провайдер не ответил вовремя. Попробуйте ещё раз.")
+    elif _is_connection_error(e):
+        logger.error(f"Provider connection error: {e}")
+        await _queued_reply_text(update.message, "Нет соединения с провайдером. Попробуйте позже или смените провайдера через /ai.")
+    elif _is_auth_error(e):
+        logger.error(f"Provider auth error: {e}")
+        await _queued_reply_text(
+            update.message,
+            "Ошибка авторизации у провайдера (401). Обновите ключ в secrets или смените провайдера через /ai."
+        )
+    elif _is_insufficient_balance_error(e):
+        logger.error(f"Provider insufficient balance: {e}")
+        await _queued_reply_text(
+            update.message,
+            "У провайдера недостаточно средств/кредита. Пополните баланс или выберите другого провайдера через /ai."
+        )
+    elif _is_region_block_error(e):
+        logger.error(f"OpenAI region restriction: {e}")
+        await _queued_reply_text(
+            update.message,
+            "Доступ к OpenAI ограничен в вашем регионе. Перенесите запуск бота в поддерживаемый регион или используйте Azure OpenAI."
+        )
+    else:
+        logger.error(f"{fallback_text}: {e}")
+        await _queued_reply_text(update.message, fallback_text)
+
 # Обработчик текстовых сообщений с контекстом
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     user_message = update.message.text
     
+    # Ожидается строка поиска для меню промптов (если пользователь не ушёл из меню и не замолчал)
+    search_deadline = context.user_data.pop("prompt_search_pending", None)
+    if search_deadline is not None and time.monotonic() < search_deadline:
+        query_text = user_message.strip()
+        context.user_data["prompt_search"] = query_text
+        reply_markup, text = _build_prompt_keyboard(user_id, query_text)
+        await _queued_reply_text(update.message, text, reply_markup=reply_markup)
+        return
+
     # Админский режим добавления промпта (title/content)
     if context.user_data.get("prompt_admin_action") == "add_title":
-        if user_id not in ADMIN_IDS:
-            await update.message.reply_text("Доступ запрещен.")
+        if not _is_admin(user_id):
+            await _queued_reply_text(update.message, "Доступ запрещен.")
             context.user_data.pop("prompt_admin_action", None)
             return
         context.user_data["new_prompt_title"] = user_message.strip()
         context.user_data["prompt_admin_action"] = "add_content"
-        await update.message.reply_text("Теперь отправьте текст промпта (content):")
+        await _queued_reply_text(update.message, "Теперь отправьте текст промпта (content):")
         return
     if context.user_data.get("prompt_admin_action") == "add_content":
-        if user_id not in ADMIN_IDS:
-            await update.message.reply_text("Доступ запрещен.")
+        if not _is_admin(user_id):
+            await _queued_reply_text(update.message, "Доступ запрещен.")
             context.user_data.pop("prompt_admin_action", None)
             context.user_data.pop("new_prompt_title", None)
             return
         title = context.user_data.get("new_prompt_title", "Новый промпт").strip()
         content = user_message
         # Сохраняем в список и файл
-        new_id_base = re.sub(r"[^a-zA-Z0-9_]", "_", title) or "prompt"
-        new_id = new_id_base
-        suffix = 1
-        existing_ids = {p["id"] for p in PROMPTS}
-        while new_id in existing_ids:
-            suffix += 1
-            new_id = f"{new_id_base}_{suffix}"
-        PROMPTS.append({"id": new_id, "title": title, "content": content})
-        global PROMPT_BY_ID
-        PROMPT_BY_ID = {p["id"]: p for p in PROMPTS}
-        _save_prompts()
-        await update.message.reply_text(f"Промпт добавлен: {title}")
+        _add_prompt(title, content)
+        await _save_prompts()
+        await _queued_reply_text(update.message, f"Промпт добавлен: {title}")
         context.user_data.pop("prompt_admin_action", None)
         context.user_data.pop("new_prompt_title", None)
         return
 
     update_stats(user_id)
     
+    # Вставленный лог фильтруем локально, как загруженный файл
+    if user_message.count("\n") >= DOC_PASTE_MIN_LINES:
+        # Фильтрация длинной вставки — в пуле потоков, чтобы не задерживать другие апдейты
+        condensed, kind, _ = await _to_thread(_condense_lines, user_message.splitlines())
+        if kind not in ("generic", "config") and len(condensed) < len(user_message):
+            user_message = condensed
+    
     # Получаем или создаем контекст пользователя
-    if user_id not in user_contexts:
-        user_contexts[user_id] = []
+    _user_history(user_id, create=True)
     
-    # Добавляем новое сообщение в контекст (ограничиваем длину)
+    # Добавляем новое сообщение в контекст (старые реплики уходят на сжатие в резюме)
     user_contexts[user_id].append({"role": "user", "content": user_message})
-    user_contexts[user_id] = user_contexts[user_id][-HISTORY_LENGTH:]
+    _trim_history(user_id)
     
     # Формируем messages с учётом выбранного промпта и провайдера
     system_prompt_text = _get_user_system_prompt(user_id, context)
-    messages = [{"role": "system", "content": system_prompt_text}] + user_contexts[user_id]
+    messages = [{"role": "system", "content": system_prompt_text}] + _history_messages(user_id)
+    if len(messages) == 2:
+        _track_question(user_id, user_message)
     
+    # Новый вопрос отменяет ещё не отвеченный предыдущий
+    request, request_token = _begin_user_request(user_id, update.message.text)
     try:
-        logger.info(f"Processing message from {user_id}: {user_message}")
+        logger.info("Сообщение пользователя", extra={"user_id": user_id, "chars": len(user_message),
+                                                     "text": user_message, "sample": "user_message"})
         
         # Получаем ответ (из кэша или API), учитывая выбранного провайдера
         ai_response = await get_cached_ai_response_for_user(user_id, messages)
         
         # Добавляем ответ в контекст
-        user_contexts[user_id].append({"role": "assistant", "content": ai_response})
+        _user_history(user_id, create=True).append({"role": "assistant", "content": ai_response})
+        _schedule_summary(user_id)
         
         # Кнопка для сохранения ответа в PDF
         reply_markup = InlineKeyboardMarkup(
@@ -679,32 +2962,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chunks = _split_text_for_telegram(ai_response)
         if chunks:
             # Первая часть с кнопкой PDF
-            await update.message.reply_text(chunks[0], reply_markup=reply_markup)
+            await _queued_reply_text(update.message, chunks[0], reply_markup=reply_markup)
             # Остальные части без кнопки
             for chunk in chunks[1:]:
-                await update.message.reply_text(chunk)
+                await _queued_reply_text(update.message, chunk)
         
     except Exception as e:
-        if _is_auth_error(e):
-            logger.error(f"Provider auth error: {e}")
-            await update.message.reply_text(
-                "Ошибка авторизации у провайдера (401). Обновите ключ в secrets или смените провайдера через /ai."
-            )
-        elif _is_insufficient_balance_error(e):
-            logger.error(f"Provider insufficient balance: {e}")
-            await update.message.reply_text(
-                "У провайдера недостаточно средств/кредита. Пополните баланс или выберите другого провайдера через /ai."
-            )
-        elif _is_region_block_error(e):
-            logger.error(f"OpenAI region restriction: {e}")
-            await update.message.reply_text(
-                "Доступ к OpenAI ограничен в вашем регионе. Варианты:\n"
-                "- Запустите бота на хосте в поддерживаемом регионе\n"
-                "- Используйте Azure OpenAI (потребуется другой клиент/ключ)"
-            )
-        else:
-            logger.error(f"Error processing message: {e}")
-            await update.message.reply_text("Извините, произошла ошибка. Попробуйте позже.")
+        await _reply_provider_error(update, e, "Извините, произошла ошибка. Попробуйте позже.")
+    finally:
+        _finish_user_request(user_id, request, request_token)
 
 async def analyze_image_with_openai(image_path: str) -> str:
     # Используем OpenAI Vision (gpt-4-vision-preview)
@@ -713,7 +2979,7 @@ async def analyze_image_with_openai(image_path: str) -> str:
         # Выбор промпта учитывается в handle_image ниже посредством user_id.
         content_bytes = img_file.read()
         response = await _to_thread(
-            ai_client.chat.completions.create,
+            _get_openai_client().chat.completions.create,
             model="gpt-4-vision-preview",
             messages=[
                 {"role": "system", "content": default_system_prompt},
@@ -727,9 +2993,10 @@ async def analyze_image_with_openai(image_path: str) -> str:
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not update.message.photo:
-        await update.message.reply_text("Фото не найдено.")
+        await _queued_reply_text(update.message, "Фото не найдено.")
         return
     photo = update.message.photo[-1]  # Берем самое высокое качество
+    request, request_token = _begin_user_request(user.id, "[изображение]")
     try:
         # Убедимся, что директория temp_images существует
         os.makedirs("temp_images", exist_ok=True)
@@ -745,10 +3012,10 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         client, model, supported = _get_client_and_model(user.id, vision=True)
         if not supported:
             raise RuntimeError("Выбранный провайдер не поддерживает анализ изображений")
-        response_obj = await _to_thread(
-            client.chat.completions.create,
-            model=model,
-            messages=[
+        _check_quota(user.id)
+        response_obj = await _provider_call(
+            user.id, _get_user_ai_provider(user.id), client, model,
+            [
                 {"role": "system", "content": user_prompt},
                 {"role": "user", "content": "Что на этом изображении?", "image": content_bytes}
             ],
@@ -757,31 +3024,311 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         response = response_obj.choices[0].message.content
         # Удаляем временный файл
         os.remove(image_path)
-        await update.message.reply_text(response)
+        await _queued_reply_text(update.message, response)
     except Exception as e:
-        if _is_auth_error(e):
-            logger.error(f"Provider auth error: {e}")
-            await update.message.reply_text(
-                "Ошибка авторизации у провайдера (401). Обновите ключ в secrets или смените провайдера через /ai."
-            )
-        elif _is_insufficient_balance_error(e):
-            logger.error(f"Provider insufficient balance: {e}")
-            await update.message.reply_text(
-                "У провайдера недостаточно средств/кредита. Пополните баланс или выберите другого провайдера через /ai."
-            )
-        elif _is_region_block_error(e):
-            logger.error(f"OpenAI region restriction: {e}")
-            await update.message.reply_text(
-                "Доступ к OpenAI ограничен в вашем регионе. Перенесите запуск бота в поддерживаемый регион или используйте Azure OpenAI."
-            )
+        await _reply_provider_error(update, e, "Не удалось обработать изображение.")
+    finally:
+        _finish_user_request(user.id, request, request_token)
+
+# Анализ загруженных логов и конфигов: потоковая локальная фильтрация + map-reduce через модель
+DOC_MAX_BYTES = 20 * 1024 * 1024  # лимит Bot API на скачивание файлов ботом
+DOC_DETECT_LINES = 200  # по стольким первым строкам определяется тип файла
+DOC_CONTEXT_BEFORE = 3  # строк контекста до строки с ошибкой
+DOC_CONTEXT_AFTER = 3  # и после
+DOC_MAX_WINDOWS = 60  # сколько окон ошибок отправлять модели
+DOC_WINDOWS_PER_PATTERN = 2  # окон на один шаблон ошибки, остальные только считаем
+DOC_MAX_PATTERNS = 10000  # предел словаря шаблонов строк (память)
+DOC_MAX_FLOWS = 10000  # предел словаря потоков iptables
+DOC_SNIFF_BYTES = 8192  # по стольким первым байтам отличаем текст от двоичного файла
+DOC_MAX_BAD_CHARS = 0.01  # доля невалидного UTF-8, после которой файл считается двоичным
+DOC_TOP_PATTERNS = 25
+DOC_MAX_LINE_CHARS = 500
+DOC_CHUNK_CHARS = 12000  # размер фрагмента для map-фазы
+DOC_MAX_CHUNKS = 8  # ограничение стоимости map-фазы
+DOC_MAP_CONCURRENCY = 3  # одновременных запросов к провайдеру в map-фазе
+DOC_PASTE_MIN_LINES = 30  # вставленный текст длиннее — фильтруем как лог
+CONFIG_EXTENSIONS = (".conf", ".cfg", ".ini", ".yaml", ".yml", ".toml", ".json", ".xml", ".service", ".rules")
+
+_LOG_TYPE_PATTERNS = [
+    ("iptables", re.compile(r"\bIN=\S*\s+OUT=\S*.*\bSRC=\S+\s+DST=\S+")),
+    ("nginx_access", re.compile(r'^\S+ \S+ \S+ \[[^\]]+\] "[A-Z]+ \S+ [^"]*" \d{3} ')),
+    ("nginx_error", re.compile(r"^\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[(?:emerg|alert|crit|error|warn|notice|info|debug)\]")),
+    ("netflow", re.compile(r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d+\s+[\d.]+\s+\w+\s+\S+:\d+\s+->")),
+    ("syslog", re.compile(r"^(?:[A-Z][a-z]{2}\s+\d{1,2} \d\d:\d\d:\d\d|\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\S*) \S+ [^:\s]+:")),
+]
+# Применяется к строке в нижнем регистре и только к новым шаблонам (результат кэшируется)
+_LOG_ALERT_RE = re.compile(
+    r"error|\berr\b|fail|fatal|crit|panic|emerg|alert|denied|refused|timed? ?out|segfault|"
+    r"\boom\b|killed|warn|ошибк|сбой"
+)
+_NGINX_STATUS_RE = re.compile(r'" (\d{3}) ')
+_IPTABLES_FIELDS_RE = re.compile(r"\b(SRC|DST|PROTO|DPT)=(\S+)")
+# Для дедупликации достаточно заменить числа и hex: время, IP, PID и порты сворачиваются сами
+_NORMALIZE_RE = re.compile(r"0x[0-9a-fA-F]+|[0-9a-fA-F]{12,}|\d+")
+
+def _normalize_log_line(line: str) -> str:
+    return _NORMALIZE_RE.sub("#", line)
+
+def _detect_file_type(lines: list, filename: str = "") -> str:
+    name = (filename or "").lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    votes = Counter()
+    sample = [l for l in lines if l.strip()][:DOC_DETECT_LINES]
+    for line in sample:
+        for kind, pattern in _LOG_TYPE_PATTERNS:
+            if pattern.search(line):
+                votes[kind] += 1
+                break
+    if votes:
+        kind, count = votes.most_common(1)[0]
+        if count * 3 >= len(sample):
+            return kind
+    if name.endswith(CONFIG_EXTENSIONS):
+        return "config"
+    return "generic"
+
+class BinaryFileError(ValueError):
+    """Присланный файл не текстовый (архив, картинка, PDF)."""
+
+class _LogCondenser:
+    """Потоковый фильтр: дедупликация повторов, окна вокруг ошибок, сводки по типу файла.
+    Память ограничена независимо от размера входа: словари шаблонов и потоков не растут
+    дальше DOC_MAX_PATTERNS/DOC_MAX_FLOWS, остальное считается общим счётчиком.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.lines = 0
+        self.patterns = Counter()
+        self.examples = {}
+        self.alert_by_key = {}
+        self.other_lines = 0
+        self.before = deque(maxlen=DOC_CONTEXT_BEFORE)
+        self.windows = []  # [номер строки, шаблон, [строки]]
+        self.open_window = None
+        self.after_left = 0
+        self.alert_lines = 0
+        self.alert_patterns = Counter()
+        self.statuses = Counter()
+        self.flows = Counter()
+        self.other_flows = 0
+        self.config_lines = []
+        self.config_chars = 0
+
+    def feed(self, raw: str) -> None:
+        self.lines += 1
+        line = raw.rstrip("\r\n")
+        if len(line) > DOC_MAX_LINE_CHARS:
+            line = line[:DOC_MAX_LINE_CHARS] + "…"
+        if self.kind == "config":
+            self._feed_config(line)
+            return
+        if not line.strip():
+            return
+        key = _normalize_log_line(line)
+        status = None
+        if self.kind == "nginx_access":
+            m = _NGINX_STATUS_RE.search(line)
+            if m:
+                status = m.group(1)
+                self.statuses[status] += 1
+                key = f"{status} {key}"
+        if key in self.patterns:
+            self.patterns[key] += 1
+            alert = self.alert_by_key[key]
         else:
-            logger.error(f"Error processing image: {e}")
-            await update.message.reply_text("Не удалось обработать изображение.")
+            alert = status.startswith("5") if status else bool(_LOG_ALERT_RE.search(line.lower()))
+            if len(self.patterns) < DOC_MAX_PATTERNS:
+                self.patterns[key] = 1
+                self.examples[key] = line
+                self.alert_by_key[key] = alert
+            else:
+                self.other_lines += 1
+        if self.kind == "iptables":
+            fields = dict(_IPTABLES_FIELDS_RE.findall(line))
+            flow = (fields.get("SRC"), fields.get("DST"), fields.get("PROTO"), fields.get("DPT"))
+            if flow in self.flows or len(self.flows) < DOC_MAX_FLOWS:
+                self.flows[flow] += 1
+            else:
+                self.other_flows += 1
+        if alert:
+            self.alert_lines += 1
+            if key not in self.patterns:
+                key = None  # редкие шаблоны сверх предела — одной общей записью
+            self.alert_patterns[key] += 1
+        if self.after_left > 0:
+            # Строка попадает в хвост уже открытого окна
+            self.open_window[2].append(line)
+            self.after_left -= 1
+        elif (alert and self.alert_patterns[key] <= DOC_WINDOWS_PER_PATTERN
+                and len(self.windows) < DOC_MAX_WINDOWS):
+            self.open_window = [self.lines, key, list(self.before) + [line]]
+            self.windows.append(self.open_window)
+            self.after_left = DOC_CONTEXT_AFTER
+        self.before.append(line)
+
+    def _feed_config(self, line: str) -> None:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(("#", ";", "//")):
+            return
+        if self.config_chars < DOC_CHUNK_CHARS * DOC_MAX_CHUNKS:
+            self.config_lines.append(line)
+            self.config_chars += len(line) + 1
+
+    def result(self) -> str:
+        if self.kind == "config":
+            truncated = "" if self.config_chars < DOC_CHUNK_CHARS * DOC_MAX_CHUNKS else " (обрезано)"
+            header = f"Тип файла: config; строк: {self.lines}; без комментариев и пустых строк{truncated}"
+            return header + "\n" + "\n".join(self.config_lines)
+        out = [f"Тип файла: {self.kind}; строк: {self.lines}; уникальных шаблонов: {len(self.patterns)}; "
+               f"строк с ошибками/предупреждениями: {self.alert_lines}"]
+        if self.statuses:
+            out.append("== Статусы HTTP: " + ", ".join(f"{code}×{n}" for code, n in sorted(self.statuses.items())))
+        if self.flows:
+            out.append("== Частые потоки iptables (SRC -> DST PROTO DPT):")
+            for (src, dst, proto, dpt), n in self.flows.most_common(15):
+                out.append(f"  {n}× {src} -> {dst} {proto} {dpt or '-'}")
+            if self.other_flows:
+                out.append(f"  ...и ещё {self.other_flows} пакетов в редких потоках")
+        out.append("== Частые шаблоны строк (число повторов × пример):")
+        for key, n in self.patterns.most_common(DOC_TOP_PATTERNS):
+            out.append(f"  {n}× {self.examples[key]}")
+        if self.other_lines:
+            out.append(f"  ...и ещё {self.other_lines} строк с редкими шаблонами")
+        if self.windows:
+            out.append(f"== Окна вокруг ошибок/предупреждений ({len(self.windows)} из {self.alert_lines}):")
+            for lineno, key, lines in self.windows:
+                repeats = "редкий шаблон" if key is None else f"повторов шаблона: {self.alert_patterns[key]}"
+                out.append(f"--- строка {lineno} ({repeats})")
+                out.extend(lines)
+        return "\n".join(out)
+
+def _condense_lines(lines, filename: str = "") -> tuple:
+    """Отфильтровать итерируемый поток строк. Возвращает (сжатый текст, тип, число строк)."""
+    lines = iter(lines)
+    head = list(itertools.islice(lines, DOC_DETECT_LINES))
+    kind = _detect_file_type(head, filename)
+    condenser = _LogCondenser(kind)
+    for line in itertools.chain(head, lines):
+        condenser.feed(line)
+    return condenser.result(), kind, condenser.lines
+
+def _bounded_lines(f):
+    """Строки файла, каждая не длиннее DOC_MAX_LINE_CHARS + 1 символа: хвост длинной строки
+    (минифицированный JSON, файл без переводов строк) пропускается, не попадая в память."""
+    while True:
+        line = f.readline(DOC_MAX_LINE_CHARS + 1)
+        if not line:
+            return
+        if len(line) > DOC_MAX_LINE_CHARS and not line.endswith("\n"):
+            while True:
+                rest = f.readline(DOC_MAX_LINE_CHARS + 1)
+                if not rest or rest.endswith("\n"):
+                    break
+        yield line
+
+def _is_binary_sample(sample: bytes) -> bool:
+    if b"\0" in sample:
+        return True
+    text = sample.decode("utf-8", errors="replace")
+    return text.count("\ufffd") > max(1, len(text) * DOC_MAX_BAD_CHARS)
+
+def _condense_file(path: str, filename: str = "") -> tuple:
+    """Читает файл построчно (в т.ч. .gz), не загружая его целиком. Двоичные файлы отклоняются."""
+    opener = gzip.open if (filename or path).lower().endswith(".gz") else open
+    with opener(path, "rb") as f:
+        if _is_binary_sample(f.read(DOC_SNIFF_BYTES)):
+            raise BinaryFileError(filename or path)
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        return _condense_lines(_bounded_lines(f), filename)
+
+async def _analyze_condensed(user_id: int, context: ContextTypes.DEFAULT_TYPE, condensed: str,
+                             question: str, label: str) -> str:
+    """Map-reduce по фрагментам сжатого текста с ограниченным параллелизмом."""
+    system_prompt_text = _get_user_system_prompt(user_id, context)
+    question = question or "Проанализируй файл: найди проблемы, их причины и предложи исправления."
+    chunks = _split_text_for_telegram(condensed, DOC_CHUNK_CHARS)
+    dropped = max(len(chunks) - DOC_MAX_CHUNKS, 0)
+    chunks = chunks[:DOC_MAX_CHUNKS]
+    if len(chunks) == 1:
+        messages = [
+            {"role": "system", "content": system_prompt_text},
+            {"role": "user", "content": f"{question}\n\n{label} (локально отфильтрован: повторы свёрнуты, "
+                                        f"оставлены окна вокруг ошибок):\n{chunks[0]}"},
+        ]
+        return await get_cached_ai_response_for_user(user_id, messages)
+    sem = asyncio.Semaphore(DOC_MAP_CONCURRENCY)
+
+    async def map_chunk(idx: int, chunk: str) -> str:
+        messages = [
+            {"role": "system", "content": system_prompt_text},
+            {"role": "user", "content": f"Фрагмент {idx + 1}/{len(chunks)} из {label}. Кратко перечисли "
+                                        f"найденные проблемы и важные детали, без рекомендаций:\n{chunk}"},
+        ]
+        async with sem:
+            return await get_cached_ai_response_for_user(user_id, messages)
+
+    partials = await asyncio.gather(*(map_chunk(i, c) for i, c in enumerate(chunks)))
+    note = f"\n(ещё {dropped} фрагментов не анализировались из-за ограничения объёма)" if dropped else ""
+    summary = "\n\n".join(f"[Фрагмент {i + 1}]\n{p}" for i, p in enumerate(partials))
+    messages = [
+        {"role": "system", "content": system_prompt_text},
+        {"role": "user", "content": f"{question}\n\nНиже — разборы фрагментов {label}.{note}\n"
+                                    f"Сведи их в единый ответ:\n{summary}"},
+    ]
+    return await get_cached_ai_response_for_user(user_id, messages)
+
+# Обработчик документов (логи, конфиги)
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    doc = update.message.document
+    if not doc:
+        await _queued_reply_text(update.message, "Файл не найден.")
+        return
+    if doc.file_size and doc.file_size > DOC_MAX_BYTES:
+        await _queued_reply_text(update.message, "Файл слишком большой: Telegram позволяет боту скачивать файлы до 20 МБ.")
+        return
+    update_stats(user.id)
+    file_name = doc.file_name or "file"
+    os.makedirs("temp_docs", exist_ok=True)
+    file_path = os.path.join("temp_docs", f"{user.id}_{doc.file_unique_id}")
+    request, request_token = _begin_user_request(user.id, f"[файл {file_name}] {update.message.caption or ''}".strip())
+    try:
+        tg_file = await doc.get_file()
+        await tg_file.download_to_drive(file_path)
+        condensed, kind, total_lines = await _to_thread(_condense_file, file_path, file_name)
+        await _queued_reply_text(
+            update.message,
+            f"Файл {file_name}: {kind}, {total_lines} строк → {len(condensed)} символов после фильтрации. Анализирую..."
+        )
+        question = (update.message.caption or "").strip()
+        ai_response = await _analyze_condensed(user.id, context, condensed, question, f"файла {file_name} ({kind})")
+        history = _user_history(user.id, create=True)
+        history.append({"role": "user", "content": f"[Файл {file_name}: {kind}, {total_lines} строк] {question}".strip()})
+        history.append({"role": "assistant", "content": ai_response})
+        _trim_history(user.id)
+        _schedule_summary(user.id)
+        reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Сохранить ответ в PDF", callback_data="save_pdf")]]
+        )
+        chunks = _split_text_for_telegram(ai_response)
+        await _queued_reply_text(update.message, chunks[0], reply_markup=reply_markup)
+        for chunk in chunks[1:]:
+            await _queued_reply_text(update.message, chunk)
+    except BinaryFileError:
+        await _queued_reply_text(update.message, "Это не текстовый файл. Пришлите лог или конфиг (можно в .gz).")
+    except Exception as e:
+        await _reply_provider_error(update, e, "Не удалось обработать файл.")
+    finally:
+        _finish_user_request(user.id, request, request_token)
+        with suppress(FileNotFoundError):
+            os.remove(file_path)
 
 # Админ-панель
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS:
-        await update.message.reply_text("Доступ запрещен.")
+    if not _is_admin(update.effective_user.id):
+        await _queued_reply_text(update.message, "Доступ запрещен.")
         return ConversationHandler.END
     
     keyboard = [
@@ -791,7 +3338,8 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
+    await _queued_reply_text(
+        update.message,
         "Админ-панель:",
         reply_markup=reply_markup
     )
@@ -801,62 +3349,210 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def view_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    usage = _usage_summary()
+    semantic_line = ""
+    if SEMANTIC_CACHE_ENABLED:
+        lookups = semantic_cache_stats["hits"] + semantic_cache_stats["misses"]
+        semantic_line = (f"• Семантический кэш: {sum(i.size for i in semantic_cache.values())} записей, "
+                         f"попаданий {semantic_cache_stats['hits']} из {lookups}\n")
+    prewarm_line = ""
+    if PREWARM_ENABLED:
+        prewarm_line = (f"• Прогрев кэша: {prewarm_stats['answers']} ответов, попаданий {prewarm_stats['hits']}, "
+                        f"последний прогон: {prewarm_stats['last_run'] or 'не было'}\n")
+    local_line = ""
+    if _local_configured():
+        local_line = (f"• Локальная модель: {request_stats['local']} ответов, "
+                      f"передано OpenAI при недоступности: {request_stats['local_fallbacks']}\n")
+    packed, cache_bytes = ai_response_cache.memory()
+    compress_line = (f"• Кэш ответов: {len(ai_response_cache)} записей ({packed} сжато), {cache_bytes // 1024} КБ; "
+                     f"сжатых историй: {len(_cold_contexts)}, {sum(map(len, _cold_contexts.values())) // 1024} КБ\n")
+    hedge_line = ""
+    if PROVIDER_HEDGE_ENABLED:
+        hedge_line = (f"• Хедж-запросов: {request_stats['hedged']}, "
+                      f"выиграл запасной провайдер: {request_stats['hedge_wins']}\n")
     
     stats_text = (
         f"📊 Статистика бота:\n"
-        f"• Всего сообщений: {bot_stats['total_messages']}\n"
-        f"• Уникальных пользователей: {len(bot_stats['active_users'])}\n"
-        f"• Последняя активность: {max(bot_stats['last_active'].values(), default='нет данных')}"
+        f"• Всего сообщений: {bot_stats.total_messages}\n"
+        f"• Уникальных пользователей: ~{bot_stats.unique_users()}\n"
+        f"• DAU / WAU / MAU: ~{bot_stats.distinct_users(1)} / ~{bot_stats.distinct_users(7)} / "
+        f"~{bot_stats.distinct_users(30)}\n"
+        f"• Сообщений за час / сутки: {bot_stats.per_minute.total()} / {bot_stats.per_hour.total()}\n"
+        f"• Последняя активность: {bot_stats.last_active_at()}\n"
+        f"• Старт: {_startup_report() or 'нет данных'}\n"
+        f"{semantic_line}"
+        f"{prewarm_line}"
+        f"{local_line}"
+        f"{compress_line}"
+        f"{hedge_line}"
+        f"• Запросов к провайдерам: {usage['calls']}, токенов: {usage['tokens']}\n"
+        f"• Отменено / таймаутов: {request_stats['cancelled']} / {request_stats['timeouts']}\n"
+        f"• Оценка расходов: ${usage['cost']:.4f}"
     )
     
-    await query.edit_message_text(stats_text)
+    await _queued_edit_text(query, stats_text)
     return ADMIN_MENU
 
 # Выбор промпта — команда и обработчики
-async def prompt_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    try:
-        # Собираем клавиатуру из списка промптов
-        keyboard = []
-        for p in PROMPTS:
-            title = p["title"]
-            pid = p["id"]
-            prefix = "✅ " if USER_SELECTED_PROMPT.get(user_id) == pid else ""
-            keyboard.append([InlineKeyboardButton(f"{prefix}{title}", callback_data=f"set_prompt:{pid}")])
+# Постраничное меню промптов: страницы клавиатуры строятся один раз на версию набора
+PROMPTS_PAGE_SIZE = 8
+PROMPT_SEARCH_CACHE_SIZE = 64  # сколько результатов поиска держать в кэше
+PROMPT_SEARCH_TIMEOUT = 120  # сек: столько после кнопки «Поиск» следующий текст считается строкой поиска
+_prompt_kb_cache = _PerBot("prompt_kb_cache")
+
+def _prompt_list_entry(query: str = "") -> dict:
+    """Отфильтрованный по заголовку список промптов и кэш его страниц (LRU по запросу)."""
+    version = _bot().prompts_version
+    if _prompt_kb_cache["version"] != version:
+        _prompt_kb_cache["version"] = version
+        _prompt_kb_cache["lists"].clear()
+    lists = _prompt_kb_cache["lists"]
+    key = query.casefold().strip()
+    entry = lists.get(key)
+    if entry is None:
+        items = [p for p in PROMPTS if key in p["title"].casefold()] if key else list(PROMPTS)
+        entry = {
+            "items": items,
+            "position": {p["id"]: idx for idx, p in enumerate(items)},
+            "pages": {},
+        }
+        lists[key] = entry
+        while len(lists) > PROMPT_SEARCH_CACHE_SIZE:
+            lists.popitem(last=False)
+    else:
+        lists.move_to_end(key)
+    return entry
+
+def _prompt_page_count(entry: dict) -> int:
+    return max(1, -(-len(entry["items"]) // PROMPTS_PAGE_SIZE))
+
+def _prompt_page_rows(entry: dict, mode: str, page: int) -> dict:
+    """Готовые строки кнопок страницы. mode: "select" — выбор, "delete" — удаление (админ)."""
+    cached = entry["pages"].get((mode, page))
+    if cached is not None:
+        return cached
+    chunk = entry["items"][page * PROMPTS_PAGE_SIZE:(page + 1) * PROMPTS_PAGE_SIZE]
+    if mode == "delete":
+        rows = [[InlineKeyboardButton(f"Удалить: {p['title']}", callback_data=f"prompt_admin:del:{p['id']}")]
+                for p in chunk]
+        nav_prefix = "prompt_admin:delpage:"
+    else:
+        rows = [[InlineKeyboardButton(p["title"], callback_data=f"set_prompt:{p['id']}")] for p in chunk]
+        nav_prefix = "prompt_page:"
+    total = _prompt_page_count(entry)
+    nav = []
+    if total > 1:
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀", callback_data=f"{nav_prefix}{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data="prompt_page:noop"))
+        if page < total - 1:
+            nav.append(InlineKeyboardButton("▶", callback_data=f"{nav_prefix}{page + 1}"))
+    cached = {"rows": rows, "nav": nav, "chunk": chunk}
+    entry["pages"][(mode, page)] = cached
+    return cached
+
+def _build_prompt_keyboard(user_id: int, query: str = "", page: int = None, mode: str = "select") -> tuple:
+    """Клавиатура страницы меню промптов. Возвращает (разметка, текст сообщения).
+    Если страница не задана — открывается страница с текущим промптом пользователя.
+    """
+    entry = _prompt_list_entry(query)
+    total = _prompt_page_count(entry)
+    selected = USER_SELECTED_PROMPT.get(user_id)
+    if page is None:
+        page = entry["position"].get(selected, 0) // PROMPTS_PAGE_SIZE if mode == "select" else 0
+    page = min(max(page, 0), total - 1)
+    cached = _prompt_page_rows(entry, mode, page)
+    keyboard = list(cached["rows"])
+    # Единственная персональная деталь — отметка выбранного промпта
+    if mode == "select" and selected in entry["position"]:
+        idx = entry["position"][selected] - page * PROMPTS_PAGE_SIZE
+        if 0 <= idx < len(keyboard):
+            p = cached["chunk"][idx]
+            keyboard[idx] = [InlineKeyboardButton(f"✅ {p['title']}", callback_data=f"set_prompt:{p['id']}")]
+    if cached["nav"]:
+        keyboard.append(cached["nav"])
+    if mode == "select":
+        search_row = [InlineKeyboardButton("🔍 Поиск", callback_data="prompt_page:search")]
+        if query:
+            search_row.append(InlineKeyboardButton("✖ Сбросить поиск", callback_data="prompt_page:clear"))
+        keyboard.append(search_row)
         # Если админ — добавим кнопки управления
-        if user_id in ADMIN_IDS:
+        if _is_admin(user_id):
             keyboard.append([
                 InlineKeyboardButton("➕ Добавить", callback_data="prompt_admin:add"),
                 InlineKeyboardButton("➖ Удалить", callback_data="prompt_admin:del")
             ])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Выберите промпт:", reply_markup=reply_markup)
+        text = f"Промпты по запросу «{query}»:" if query else "Выберите промпт:"
+        if not entry["items"]:
+            text = f"По запросу «{query}» ничего не найдено."
+    else:
+        text = "Выберите промпт для удаления:"
+    return InlineKeyboardMarkup(keyboard), text
+
+def _cancel_prompt_search(context) -> None:
+    """Пользователь ушёл из меню промптов — следующий текст снова обычный вопрос."""
+    context.user_data.pop("prompt_search_pending", None)
+
+async def prompt_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    _cancel_prompt_search(context)
+    try:
+        # /prompt <текст> — поиск по заголовку
+        query = " ".join(getattr(context, "args", None) or []).strip()
+        context.user_data["prompt_search"] = query
+        reply_markup, text = _build_prompt_keyboard(user_id, query)
+        await _queued_reply_text(update.message, text, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка формирования меню промптов: {e}")
-        await update.message.reply_text("Не удалось загрузить список промптов.")
+        await _queued_reply_text(update.message, "Не удалось загрузить список промптов.")
+
+async def prompt_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание, поиск и сброс поиска в меню промптов"""
+    query = update.callback_query
+    await query.answer()
+    try:
+        action = query.data.split(":", 1)[1]
+        if action == "noop":
+            return
+        if action == "search":
+            context.user_data["prompt_search_pending"] = time.monotonic() + PROMPT_SEARCH_TIMEOUT
+            await _queued_edit_text(query, "Отправьте часть названия промпта для поиска:")
+            return
+        _cancel_prompt_search(context)
+        if action == "clear":
+            context.user_data["prompt_search"] = ""
+            page = None
+        else:
+            page = int(action)
+        reply_markup, text = _build_prompt_keyboard(
+            query.from_user.id, context.user_data.get("prompt_search", ""), page
+        )
+        await _queued_edit_text(query, text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка листания промптов: {e}")
+        await _queued_edit_text(query, "Не удалось загрузить список промптов.")
 
 async def ai_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    _cancel_prompt_search(context)
     try:
         keyboard = []
-        current = _get_user_ai_provider(user_id)
-        # OpenAI всегда доступен
-        prefix_oa = "✅ " if current == "OPEN_AI" else ""
-        keyboard.append([InlineKeyboardButton(f"{prefix_oa}OpenAI", callback_data="set_ai:OPEN_AI")])
-        # DeepSeek — только если настроен ключ
-        if deepseek_client is not None:
-            prefix_ds = "✅ " if current == "DEEP_SEEK" else ""
-            keyboard.append([InlineKeyboardButton(f"{prefix_ds}DeepSeek", callback_data="set_ai:DEEP_SEEK")])
+        current = _user_provider_choice(user_id)
+        # OpenAI всегда доступен, остальные — только если настроены (ключ DeepSeek, LOCAL_LLM_URL)
+        for provider, title in AI_PROVIDER_TITLES.items():
+            if _provider_configured(provider):
+                prefix = "✅ " if current == provider else ""
+                keyboard.append([InlineKeyboardButton(f"{prefix}{title}", callback_data=f"set_ai:{provider}")])
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Выберите AI провайдера:", reply_markup=reply_markup)
+        await _queued_reply_text(update.message, "Выберите AI провайдера:", reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка формирования меню AI: {e}")
-        await update.message.reply_text("Не удалось загрузить список провайдеров.")
+        await _queued_reply_text(update.message, "Не удалось загрузить список провайдеров.")
 
 async def set_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global PROMPTS, PROMPT_BY_ID
     query = update.callback_query
     await query.answer()
+    _cancel_prompt_search(context)
     try:
         data = query.data
         if data.startswith("set_prompt:"):
@@ -865,20 +3561,20 @@ async def set_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             if pid in PROMPT_BY_ID:
                 USER_SELECTED_PROMPT[user_id] = pid
                 title = PROMPT_BY_ID[pid]["title"]
-                await query.edit_message_text(f"Выбран промпт: {title}")
+                await _queued_edit_text(query, f"Выбран промпт: {title}")
             else:
-                await query.edit_message_text("Неизвестный промпт.")
+                await _queued_edit_text(query, "Неизвестный промпт.")
             return
         if data == "prompt_admin:add":
-            if query.from_user.id not in ADMIN_IDS:
-                await query.edit_message_text("Доступ запрещен.")
+            if not _is_admin(query.from_user.id):
+                await _queued_edit_text(query, "Доступ запрещен.")
                 return
             # Предлагаем выбор: добавить в список или использовать как пользовательский промпт
             keyboard = [
                 [InlineKeyboardButton("➕ Добавить в список промптов", callback_data="prompt_admin:add_to_list")],
                 [InlineKeyboardButton("🧠 Использовать как пользовательский промпт", callback_data="prompt_admin:use_custom")]
             ]
-            await query.edit_message_text(
+            await _queued_edit_text(query, 
                 "Выберите действие:\n\n"
                 "➕ Добавить в список - добавит новый промпт в файл promt_list\n"
                 "🧠 Использовать как пользовательский - отключит шаблоны и будет использовать ваш ввод как промпт",
@@ -886,17 +3582,17 @@ async def set_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
         if data == "prompt_admin:add_to_list":
-            if query.from_user.id not in ADMIN_IDS:
-                await query.edit_message_text("Доступ запрещен.")
+            if not _is_admin(query.from_user.id):
+                await _queued_edit_text(query, "Доступ запрещен.")
                 return
-            await query.edit_message_text("Введите заголовок нового промпта (title):")
+            await _queued_edit_text(query, "Введите заголовок нового промпта (title):")
             context.user_data["prompt_admin_action"] = "add_title"
             return
         if data == "prompt_admin:use_custom":
-            if query.from_user.id not in ADMIN_IDS:
-                await query.edit_message_text("Доступ запрещен.")
+            if not _is_admin(query.from_user.id):
+                await _queued_edit_text(query, "Доступ запрещен.")
                 return
-            await query.edit_message_text(
+            await _queued_edit_text(query, 
                 "📝 Режим пользовательского промпта активирован!\n\n"
                 "Теперь все ваши сообщения будут использоваться как системный промпт. "
                 "Шаблоны из файла promt_list отключены.\n\n"
@@ -904,50 +3600,59 @@ async def set_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return CUSTOM_PROMPT
         if data == "prompt_admin:del":
-            if query.from_user.id not in ADMIN_IDS:
-                await query.edit_message_text("Доступ запрещен.")
+            if not _is_admin(query.from_user.id):
+                await _queued_edit_text(query, "Доступ запрещен.")
+                return
+            # Кнопки для удаления существующих (постранично)
+            reply_markup, text = _build_prompt_keyboard(query.from_user.id, mode="delete")
+            await _queued_edit_text(query, text, reply_markup=reply_markup)
+            return
+        if data.startswith("prompt_admin:delpage:"):
+            if not _is_admin(query.from_user.id):
+                await _queued_edit_text(query, "Доступ запрещен.")
                 return
-            # Кнопки для удаления существующих
-            keyboard = []
-            for p in PROMPTS:
-                keyboard.append([InlineKeyboardButton(f"Удалить: {p['title']}", callback_data=f"prompt_admin:del:{p['id']}")])
-            await query.edit_message_text("Выберите промпт для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
+            page = int(data.rsplit(":", 1)[1])
+            reply_markup, text = _build_prompt_keyboard(query.from_user.id, page=page, mode="delete")
+            await _queued_edit_text(query, text, reply_markup=reply_markup)
             return
         if data.startswith("prompt_admin:del:"):
-            if query.from_user.id not in ADMIN_IDS:
-                await query.edit_message_text("Доступ запрещен.")
+            if not _is_admin(query.from_user.id):
+                await _queued_edit_text(query, "Доступ запрещен.")
                 return
             del_id = data.split(":", 2)[2]
             # Удаляем
-            PROMPTS = [p for p in PROMPTS if p["id"] != del_id]
-            PROMPT_BY_ID = {p["id"]: p for p in PROMPTS}
-            _save_prompts()
-            await query.edit_message_text("Промпт удалён.")
+            if _delete_prompt(del_id):
+                await _save_prompts()
+            await _queued_edit_text(query, "Промпт удалён.")
             return
     except Exception as e:
         logger.error(f"Ошибка выбора промпта: {e}")
-        await query.edit_message_text("Не удалось применить промпт.")
+        await _queued_edit_text(query, "Не удалось применить промпт.")
 
 async def set_ai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    _cancel_prompt_search(context)
     try:
         data = query.data
         if not data.startswith("set_ai:"):
             return
         provider = data.split(":", 1)[1]
         user_id = query.from_user.id
-        if provider not in ("OPEN_AI", "DEEP_SEEK"):
-            await query.edit_message_text("Неизвестный провайдер.")
+        if provider not in AI_PROVIDER_TITLES:
+            await _queued_edit_text(query, "Неизвестный провайдер.")
             return
-        if provider == "DEEP_SEEK" and deepseek_client is None:
-            await query.edit_message_text("DeepSeek не настроен. Добавьте ключ DEEPSEEK_API_KEY.")
+        if provider == "DEEP_SEEK" and not _deepseek_configured():
+            await _queued_edit_text(query, "DeepSeek не настроен. Добавьте ключ DEEPSEEK_API_KEY.")
+            return
+        if provider in ("LOCAL", "AUTO") and not _local_configured():
+            await _queued_edit_text(query, "Локальная модель не настроена. Задайте адрес сервера в LOCAL_LLM_URL.")
             return
         USER_AI_PROVIDER[user_id] = provider
-        await query.edit_message_text(f"Выбран AI провайдер: {'OpenAI' if provider=='OPEN_AI' else 'DeepSeek'}")
+        await _queued_edit_text(query, f"Выбран AI провайдер: {AI_PROVIDER_TITLES[provider]}")
     except Exception as e:
         logger.error(f"Ошибка выбора AI: {e}")
-        await query.edit_message_text("Не удалось применить провайдера.")
+        await _queued_edit_text(query, "Не удалось применить провайдера.")
 
 async def handle_custom_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик пользовательского промпта (без шаблонов)"""
@@ -959,7 +3664,8 @@ async def handle_custom_prompt(update: Update, context: ContextTypes.DEFAULT_TYP
     # Сохраняем контент промпта в user_data для использования
     context.user_data["custom_prompt"] = user_message
     
-    await update.message.reply_text(
+    await _queued_reply_text(
+        update.message,
         "✅ Пользовательский промпт установлен!\n\n"
         "Теперь все ваши сообщения будут обрабатываться с использованием этого промпта. "
         "Шаблоны из файла promt_list отключены.\n\n"
@@ -973,14 +3679,14 @@ async def save_pdf_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     try:
-        if not REPORTLAB_AVAILABLE:
-            await query.edit_message_text("reportlab не установлен. Установите: pip install reportlab")
+        if not _load_reportlab():
+            await _queued_edit_text(query, "reportlab не установлен. Установите: pip install reportlab")
             return
         # Берём последний ответ ассистента из контекста
-        ctx = user_contexts.get(user_id, [])
+        ctx = _user_history(user_id) or []
         last_answer = next((m["content"] for m in reversed(ctx) if m.get("role") == "assistant"), None)
         if not last_answer:
-            await query.edit_message_text("Нет ответа для сохранения.")
+            await _queued_edit_text(query, "Нет ответа для сохранения.")
             return
         # Генерируем одноразовый PDF с текстом ответа
         reports_dir = _ensure_reports_dir()
@@ -1020,61 +3726,585 @@ async def save_pdf_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         c.showPage()
         c.save()
         # Отправляем файл
-        with open(file_path, "rb") as f:
-            await query.message.reply_document(document=f, filename=os.path.basename(file_path))
-        await query.edit_message_text("PDF сформирован и отправлен.")
+        await _queued_reply_document(query.message, file_path)
+        await _queued_edit_text(query, "PDF сформирован и отправлен.")
     except Exception as e:
         logger.error(f"Ошибка создания PDF ответа: {e}")
-        await query.edit_message_text("Не удалось сформировать PDF.")
+        await _queued_edit_text(query, "Не удалось сформировать PDF.")
 
 async def reload_prompts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS:
-        await update.message.reply_text("Доступ запрещен.")
+    if not _is_admin(update.effective_user.id):
+        await _queued_reply_text(update.message, "Доступ запрещен.")
         return
-    _load_prompts()
-    await update.message.reply_text(f"Промпты перезагружены. Доступно: {len(PROMPTS)}")
+    try:
+        prompts, stat = await _to_thread(_read_prompts_file)
+    except Exception as e:
+        logger.warning(f"Ошибка загрузки promt_list: {e}")
+        await _queued_reply_text(update.message, f"Не удалось разобрать promt_list: {e}")
+        return
+    _apply_prompts(prompts, stat)
+    total_tokens = sum(p["tokens"] for p in PROMPTS)
+    await _queued_reply_text(update.message, f"Промпты перезагружены. Доступно: {len(PROMPTS)} (~{total_tokens} токенов)")
 
 async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    await query.edit_message_text("Введите сообщение для рассылки:")
+    await _queued_edit_text(query, "Введите сообщение для рассылки:")
     return BROADCAST
 
-async def process_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.message.text
-    users = bot_stats["active_users"]
-    async def send_msg(user_id):
+# Незавершённые рассылки: при перезапуске недоставленные получатели сохраняются в снимок
+_broadcasts = _PerBot("broadcasts")  # {"text", "admin_chat_id", "remaining": set(user_id), "delivered", "total"}
+_broadcast_tasks = _PerBot("broadcast_tasks")
+
+async def _deliver_broadcast(bot, job: dict) -> None:
+    # Очередь соблюдает лимиты Telegram, поэтому большая рассылка идёт минутами — ждём её в фоне
+    async def send_msg(user_id) -> None:
         try:
-            await context.bot.send_message(user_id, f"📢 Рассылка:\n\n{message}")
+            await _send(user_id, lambda: bot.send_message(user_id, f"📢 Рассылка:\n\n{job['text']}"),
+                        SEND_PRIORITY_BULK)
+            job["delivered"] += 1
+        except RequestCancelledError:
+            raise  # бот останавливается: получатель остаётся в снимке
         except Exception as e:
             logger.error(f"Failed to send to {user_id}: {e}")
-    await asyncio.gather(*(send_msg(uid) for uid in users))
-    await update.message.reply_text(f"Рассылка отправлена {len(users)} пользователям.")
+        job["remaining"].discard(user_id)
+
+    task = asyncio.current_task()
+    _broadcast_tasks.add(task)
+    try:
+        # Ждём и уже отправляемые сообщения, чтобы доставленные не ушли повторно после перезапуска
+        results = await asyncio.gather(*(send_msg(uid) for uid in list(job["remaining"])),
+                                       return_exceptions=True)
+    finally:
+        _broadcast_tasks.discard(task)
+    if any(isinstance(r, RequestCancelledError) for r in results):
+        return
+    _broadcasts.remove(job)
+    with suppress(Exception):
+        admin_chat_id = job["admin_chat_id"]
+        await _send(admin_chat_id, lambda: bot.send_message(
+            admin_chat_id, f"Рассылка завершена: доставлено {job['delivered']} из {job['total']}."))
+
+async def process_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    users = list(broadcast_audience)
+    job = {"text": update.message.text, "admin_chat_id": update.message.chat_id,
+           "remaining": set(users), "delivered": 0, "total": len(users)}
+    _broadcasts.append(job)
+    _spawn(_deliver_broadcast(context.bot, job))
+    await _queued_reply_text(update.message, f"Рассылка поставлена в очередь: {len(users)} пользователей.")
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    await query.edit_message_text("Админ-панель закрыта.")
+    await _queued_edit_text(query, "Админ-панель закрыта.")
     return ConversationHandler.END
 
 # Обработчик ошибок
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}")
     if update and hasattr(update, 'message'):
-        await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте еще раз.")
+        await _queued_reply_text(update.message, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
 
-def main():
-    # Создаем папку для временных изображений (на всякий случай)
-    os.makedirs("temp_images", exist_ok=True)
-    
-    # Инициализируем список промптов
-    _load_prompts()
+# Время старта: этап -> миллисекунды от начала импорта main.py
+STARTUP_TIMINGS = {}
+WARMUP_DELAY = 1.0  # секунд после старта до фонового прогрева — сначала начинаем отвечать
+
+def _mark_startup(stage: str) -> None:
+    STARTUP_TIMINGS[stage] = round((time.perf_counter() - _STARTUP_T0) * 1000, 1)
+
+def _startup_report() -> str:
+    return ", ".join(f"{stage}={ms} мс" for stage, ms in STARTUP_TIMINGS.items())
+
+def _warm_up() -> None:
+    """Тяжёлая инициализация: клиенты провайдеров, reportlab, шрифты."""
+    _get_openai_client()
+    _get_deepseek_client()
+    _get_local_client()
+    if _load_reportlab():
+        _register_cyrillic_fonts()
+    if SEMANTIC_CACHE_ENABLED:
+        _load_semantic()
+
+async def _warm_up_in_background() -> None:
+    await asyncio.sleep(WARMUP_DELAY)
+    await _load_usage_ledger()
+    try:
+        await _to_thread(_warm_up)
+    except Exception as e:
+        logger.warning(f"Фоновый прогрев не удался: {e}")
+    _mark_startup("warmup")
+    logger.info(f"Прогрев завершён: {_startup_report()}")
+
+# Плавная остановка и снимок состояния
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "20"))  # сек на завершение текущих запросов
+SNAPSHOT_INTERVAL = 300  # периодический снимок на случай аварийного завершения
+SNAPSHOT_MAGIC = b"TGBS\x01"
+_interrupted_questions = _PerBot("interrupted")  # user_id -> вопрос, ответ на который прервал перезапуск
+
+def _snapshot_state(application: Application) -> dict:
+    """Состояние из встроенных типов: marshal быстрее pickle и не исполняет код при загрузке."""
+    bot = _bot()  # marshal не умеет _PerBot — берём сами словари
+    custom_prompts = {}
+    for uid, data in application.user_data.items():
+        if data.get("custom_prompt"):
+            custom_prompts[uid] = data["custom_prompt"]
+    state = {
+        "saved_at": time.time(),
+        "contexts": bot.contexts,
+        "cold_contexts": bot.cold_contexts,
+        "text_dicts": _text_dicts,
+        "summaries": {uid: {"text": st["text"], "pending": st["pending"]} for uid, st in bot.summaries.items()},
+        "selected_prompts": bot.selected_prompt,
+        "providers": bot.ai_provider,
+        "custom_prompts": custom_prompts,
+        "audience": list(bot.audience),
+        "questions": bot.question_tracker.to_state(),
+        "prewarmed": bot.prewarmed,
+        "broadcasts": [{"text": b["text"], "admin_chat_id": b["admin_chat_id"], "remaining": b["remaining"],
+                        "delivered": b["delivered"], "total": b["total"]} for b in bot.broadcasts],
+        "interrupted": bot.interrupted,
+    }
+    if bot.owns_shared_stats:
+        state["stats"] = bot_stats.to_state()
+    return state
+
+def _write_snapshot_file(path: str, payload: bytes) -> None:
+    _atomic_write(path, SNAPSHOT_MAGIC + zlib.compress(payload, 6))
+
+def _read_snapshot_file(path: str):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("неизвестный формат снимка")
+    return marshal.loads(zlib.decompress(data[len(SNAPSHOT_MAGIC):]))
+
+async def _save_snapshot(application: Application) -> None:
+    # Сериализация — в цикле событий (состояние не меняется посреди дампа), сжатие и запись — в потоке
+    payload = marshal.dumps(_snapshot_state(application))
+    await _to_thread(_write_snapshot_file, _bot().snapshot_path, payload)
+    logger.info(f"Снимок состояния сохранён: {len(user_contexts) + len(_cold_contexts)} диалогов, "
+                f"{len(payload)} байт до сжатия")
+
+def _apply_snapshot(application: Application, state: dict) -> None:
+    user_contexts.update(state["contexts"])
+    if "cold_contexts" in state:  # снимки до появления сжатия истории их не содержат
+        dicts = state["text_dicts"]
+        if all(_text_dicts.get(dict_id, zdict) == zdict for dict_id, zdict in dicts.items()):
+            _text_dicts.update(dicts)
+            _cold_contexts.update(state["cold_contexts"])
+        else:  # снимок другого процесса со своим словарём — разворачиваем историю сразу
+            for uid, blob in state["cold_contexts"].items():
+                user_contexts[uid] = marshal.loads(_unpack_bytes(blob, dicts))
+    user_summaries.update(state["summaries"])
+    USER_SELECTED_PROMPT.update(state["selected_prompts"])
+    USER_AI_PROVIDER.update(state["providers"])
+    for uid, text in state["custom_prompts"].items():
+        application.user_data[uid]["custom_prompt"] = text  # user_data — defaultdict за MappingProxy
+    # Общие метрики восстанавливает один бот — иначе побеждал бы снимок, загруженный последним
+    if "stats" in state and _bot().owns_shared_stats:
+        bot_stats.load_state(state["stats"])
+    # В снимках до появления списка получателей есть только индекс последней активности
+    broadcast_audience.update(state.get("audience") or [uid for uid, _ in state.get("stats", {}).get("last_active", ())])
+    if "questions" in state:  # снимки до появления прогрева их не содержат
+        question_tracker.load_state(state["questions"])
+        _prewarmed.update(state["prewarmed"])
+        prewarm_stats["answers"] = len(_prewarmed)
+    _interrupted_questions.update(state["interrupted"])
+    for job in state["broadcasts"]:
+        job["remaining"] = set(job["remaining"])
+        _broadcasts.append(job)
+
+async def _load_snapshot_in_background(application: Application) -> None:
+    """Снимок читается после старта: бот сразу начинает опрос, первые апдейты ждут загрузки."""
+    try:
+        state = await _to_thread(_read_snapshot_file, _bot().snapshot_path)
+        if state:
+            _apply_snapshot(application, state)
+            logger.info(f"Состояние восстановлено: {len(state['contexts']) + len(state.get('cold_contexts', ()))} диалогов, "
+                        f"{len(state['broadcasts'])} незавершённых рассылок")
+    except Exception as e:
+        # Откладываем файл в сторону, чтобы следующий снимок его не затёр
+        logger.error(f"Не удалось загрузить снимок состояния: {e}")
+        path = _bot().snapshot_path
+        with suppress(OSError):
+            os.replace(path, f"{path}.bad")
+    finally:
+        _bot().snapshot_ready.set()
+        _mark_startup("snapshot")
+    for job in list(_broadcasts):
+        _spawn(_deliver_broadcast(application.bot, job))
+    for uid, question in list(_interrupted_questions.items()):
+        del _interrupted_questions[uid]
+        with suppress(Exception):
+            await _send(uid, lambda uid=uid, q=question: application.bot.send_message(
+                uid, f"⚠️ Бот перезапускался и не успел ответить на ваш запрос: «{q[:200]}». "
+                     "Пожалуйста, отправьте его ещё раз."))
+
+async def _snapshot_loop(application: Application) -> None:
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await _save_snapshot(application)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить снимок состояния: {e}")
+
+async def _gate_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Группа -1: ждём загрузки снимка; во время остановки новые апдейты не обрабатываем."""
+    bot = _bot()
+    if bot.snapshot_ready is not None and not bot.snapshot_ready.is_set():
+        await bot.snapshot_ready.wait()
+    if bot.draining:
+        if update.message and update.effective_user and (update.message.text or update.message.photo
+                                                         or update.message.document):
+            _interrupted_questions[update.effective_user.id] = update.message.text or "[вложение]"
+        raise ApplicationHandlerStop
+
+def _stop_application(application: Application) -> None:
+    bot = _bot()
+    if bot.stop is not None:
+        bot.stop()
+    else:
+        application.stop_running()
+
+def _request_drain(application: Application) -> None:
+    bot = _bot()
+    if bot.draining:
+        logger.warning("Повторный сигнал — останавливаемся, не дожидаясь запросов")
+        _stop_application(application)
+        return
+    bot.draining = True
+    _spawn(_drain(application))
+
+async def _drain(application: Application) -> None:
+    """Перестаём получать апдейты, даём текущим запросам и отправкам DRAIN_TIMEOUT секунд,
+    остальное отменяем с записью в снимок, затем штатная остановка Application."""
+    logger.info(f"Остановка: ждём текущие запросы до {DRAIN_TIMEOUT:.0f} с")
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    with suppress(Exception):
+        if application.updater and application.updater.running:
+            # Неподтверждённые апдейты Telegram доставит после перезапуска
+            await application.updater.stop()
+    dispatcher = _bot().dispatcher
+    while time.monotonic() < deadline:
+        sends = dispatcher.pending(SEND_PRIORITY_INTERACTIVE) if dispatcher is not None else 0
+        if not _user_requests and not sends:
+            break
+        await asyncio.sleep(0.2)
+    for uid, handle in list(_user_requests.items()):
+        if handle.question:
+            _interrupted_questions[uid] = handle.question
+        _cancel_user_request(uid)
+    if dispatcher is not None:
+        # Рассылки не ждём: недоставленные получатели уйдут в снимок и будут дошлены после старта
+        stopping = RequestCancelledError("Бот останавливается")
+        aborted = dispatcher.abort(SEND_PRIORITY_INTERACTIVE, stopping)
+        dispatcher.abort(SEND_PRIORITY_BULK, stopping)
+        if aborted or _interrupted_questions:
+            logger.warning(f"Прервано при остановке: {len(_interrupted_questions)} запросов, {aborted} отправок")
+    _stop_application(application)
+
+def _start_shared_tasks(tasks: dict) -> None:
+    """Задачи процесса, а не бота: при нескольких ботах запускаются один раз."""
+    tasks["usage_flush_task"] = asyncio.create_task(_usage_flush_loop())
+    tasks["warmup_task"] = asyncio.create_task(_warm_up_in_background())
+
+def _start_bot_tasks(application: Application) -> None:
+    _bot().snapshot_ready = asyncio.Event()
+    # Фоновые задачи живут вместе с циклом событий Application
+    application.bot_data["snapshot_load_task"] = asyncio.create_task(_load_snapshot_in_background(application))
+    application.bot_data["snapshot_task"] = asyncio.create_task(_snapshot_loop(application))
+    application.bot_data["prompts_watch_task"] = asyncio.create_task(_prompts_watch_loop())
+    application.bot_data["cold_history_task"] = asyncio.create_task(_cold_history_loop())
+    if PREWARM_ENABLED:
+        application.bot_data["prewarm_task"] = asyncio.create_task(_prewarm_loop())
+
+async def _cancel_tasks(tasks: dict, names: tuple) -> None:
+    for name in names:
+        task = tasks.pop(name, None)
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+async def _post_init(application: Application) -> None:
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):  # Windows: остаётся штатная остановка по Ctrl+C
+            loop.add_signal_handler(sig, _request_drain, application)
+    _start_shared_tasks(application.bot_data)
+    _start_bot_tasks(application)
+    _mark_startup("ready")
+    logger.info(f"Бот готов принимать апдейты: {_startup_report()}")
+
+async def _shutdown_bot(application: Application) -> None:
+    await _cancel_tasks(application.bot_data, ("prompts_watch_task", "snapshot_task", "snapshot_load_task",
+                                               "prewarm_task", "cold_history_task"))
+    bot = _bot()
+    for task in list(_summary_tasks.values()) + list(_broadcast_tasks):
+        task.cancel()
+    if bot.dispatcher is not None:
+        await bot.dispatcher.close()
+    if bot.snapshot_ready is not None and bot.snapshot_ready.is_set():  # иначе затрём не загруженный снимок
+        try:
+            await _save_snapshot(application)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить снимок состояния: {e}")
+
+async def _post_shutdown(application: Application) -> None:
+    await _cancel_tasks(application.bot_data, ("warmup_task", "usage_flush_task"))
+    await _shutdown_bot(application)
+    await _flush_usage()
+
+# Пакетный прогон вопросов по промптам и провайдерам: python main.py batch questions.jsonl
+BATCH_DEFAULT_CONCURRENCY = 4
+BATCH_POLL_INTERVAL = 30.0  # сек между проверками статуса Batch API
+BATCH_API_COST_FACTOR = 0.5  # Batch API OpenAI тарифицируется со скидкой 50%
+BATCH_USER_ID = 0  # служебный расход; в журнале помечается source="batch"
+BATCH_PROVIDERS = ("OPEN_AI", "DEEP_SEEK", "LOCAL")
+PROVIDER_ALIASES = {"openai": "OPEN_AI", "open_ai": "OPEN_AI", "deepseek": "DEEP_SEEK", "deep_seek": "DEEP_SEEK",
+                    "local": "LOCAL"}
+
+def _batch_provider_name(name: str):
+    """Каноническое имя провайдера или None, если такого нет."""
+    provider = PROVIDER_ALIASES.get(name.lower(), name.upper())
+    return provider if provider in BATCH_PROVIDERS else None
+
+def _batch_jobs(path: str, prompt_ids: list, providers: list) -> list:
+    """Задания вопрос × промпт × провайдер. В строке JSONL можно сузить набор полями prompts/providers."""
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            question = row.get("question") or row.get("text")
+            if not question:
+                continue
+            for pid in row.get("prompts") or prompt_ids:
+                if pid != "default" and pid not in PROMPT_BY_ID:
+                    logger.warning(f"Строка {line_no}: неизвестный промпт {pid}, пропускаю")
+                    continue
+                system_prompt = PROMPT_BY_ID[pid]["content"] if pid in PROMPT_BY_ID else default_system_prompt
+                for name in row.get("providers") or providers:
+                    provider = _batch_provider_name(name)
+                    if provider is None:
+                        logger.warning(f"Строка {line_no}: неизвестный провайдер {name}, пропускаю")
+                        continue
+                    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": question}]
+                    job = {"id": row.get("id", line_no), "question": question, "prompt_id": pid,
+                           "provider": provider, "messages": messages}
+                    try:
+                        job["client"], job["model"], _ = _provider_client_and_model(provider)
+                    except RuntimeError as e:
+                        # Провайдер не настроен — задание попадёт в результаты с ошибкой
+                        job["client"], job["model"], job["error"] = None, None, str(e)
+                    job["key"] = hashlib.sha1(json.dumps([job["model"] or provider, messages],
+                                                         ensure_ascii=False).encode("utf-8")).hexdigest()
+                    jobs.append(job)
+    return jobs
+
+def _batch_done_keys(output_path: str) -> set:
+    """Ключи уже успешно выполненных заданий из прошлого прогона (для --resume)."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            with suppress(ValueError):
+                row = json.loads(line)
+                if not row.get("error"):
+                    done.add(row.get("key"))
+    return done
+
+def _batch_result(job: dict, source: str, answer: str = None, response_obj=None,
+                  latency: float = None, error: str = None, cost_factor: float = 1.0) -> dict:
+    prompt_tokens, completion_tokens, cached_tokens = _extract_usage(response_obj)
+    return {
+        "key": job["key"], "id": job["id"], "question": job["question"], "prompt_id": job["prompt_id"],
+        "provider": job["provider"], "model": job["model"], "source": source, "answer": answer, "error": error,
+        "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": cached_tokens,
+        "cost": round(_estimate_cost(job["model"], prompt_tokens, completion_tokens, cached_tokens) * cost_factor, 6),
+    }
+
+async def _batch_live(jobs: list, concurrency: int, emit) -> None:
+    """Прямые запросы с ограничением параллельности. Без хеджирования: провайдер задан явно."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(job):
+        cache_key = _cache_key(job["model"], job["messages"])
+        if cache_key in ai_response_cache:
+            emit(_batch_result(job, "cache", ai_response_cache[cache_key]))
+            return
+        async with sem:
+            t0 = time.monotonic()
+            try:
+                response_obj = await _provider_call(BATCH_USER_ID, job["provider"], job["client"], job["model"],
+                                                    job["messages"], prompt_id=job["prompt_id"],
+                                                    source=USAGE_SOURCE_BATCH, temperature=0.7)
+            except Exception as e:
+                emit(_batch_result(job, "live", latency=time.monotonic() - t0, error=str(e)))
+                return
+        answer = response_obj.choices[0].message.content
+        ai_response_cache[cache_key] = answer
+        emit(_batch_result(job, "live", answer, response_obj, time.monotonic() - t0))
+
+    await asyncio.gather(*(run(job) for job in jobs))
+
+def _openai_batch_submit(client, jobs: list, poll_interval: float):
+    """Отправка через Batch API OpenAI: файл заданий → batch → ожидание → файл результатов."""
+    payload = "\n".join(json.dumps({
+        "custom_id": job["key"], "method": "POST", "url": "/v1/chat/completions",
+        "body": {"model": job["model"], "messages": job["messages"], "temperature": 0.7},
+    }, ensure_ascii=False) for job in jobs).encode("utf-8")
+    input_file = client.files.create(file=("batch.jsonl", payload), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    logger.info(f"Batch {batch.id}: отправлено {len(jobs)} заданий")
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+    rows = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            for line in client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    row = json.loads(line)
+                    rows[row["custom_id"]] = row
+    return batch, rows
+
+async def _batch_via_api(jobs: list, poll_interval: float, emit) -> list:
+    """Задания OpenAI — через Batch API; возвращает те, что нужно выполнить напрямую
+    (другие провайдеры без Batch API и ответы из кэша обрабатываются обычным путём)."""
+    remaining, by_client = [], {}
+    for job in jobs:
+        if job["provider"] == "OPEN_AI":
+            by_client.setdefault(id(job["client"]), []).append(job)
+        else:
+            remaining.append(job)
+    for group in by_client.values():
+        t0 = time.monotonic()
+        batch, rows = await _to_thread(_openai_batch_submit, group[0]["client"], group, poll_interval)
+        elapsed = time.monotonic() - t0
+        for job in group:
+            row = rows.get(job["key"])
+            body = ((row or {}).get("response") or {}).get("body") or {}
+            if not body.get("choices"):
+                error = (row or {}).get("error") or body.get("error") or f"batch {batch.id}: {batch.status}"
+                emit(_batch_result(job, "batch_api", latency=elapsed, error=str(error)))
+                continue
+            usage = body.get("usage") or {}
+            response_obj = SimpleNamespace(usage=SimpleNamespace(
+                prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0),
+                prompt_tokens_details=SimpleNamespace(
+                    cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0))))
+            answer = body["choices"][0]["message"]["content"]
+            _record_usage(BATCH_USER_ID, job["provider"], job["model"], job["prompt_id"], response_obj,
+                          BATCH_API_COST_FACTOR, source=USAGE_SOURCE_BATCH)
+            ai_response_cache[_cache_key(job["model"], job["messages"])] = answer
+            emit(_batch_result(job, "batch_api", answer, response_obj, elapsed, cost_factor=BATCH_API_COST_FACTOR))
+    return remaining
+
+async def run_batch(input_path: str, output_path: str, prompt_ids: list = None, providers: list = None,
+                    concurrency: int = BATCH_DEFAULT_CONCURRENCY, use_batch_api: bool = False,
+                    resume: bool = False, poll_interval: float = BATCH_POLL_INTERVAL) -> dict:
+    """Прогоняет вопросы из JSONL по промптам и провайдерам; результаты дописываются в output_path
+    по мере готовности. Возвращает сводку: задания, ошибки, кэш, токены, стоимость, задержки."""
+    if not PROMPTS:
+        _load_prompts()
+    prompt_ids = prompt_ids or [p["id"] for p in PROMPTS]
+    if providers:
+        for name in providers:
+            if _batch_provider_name(name) is None:
+                logger.warning(f"Неизвестный провайдер {name}, пропускаю")
+    else:
+        providers = [p for p in BATCH_PROVIDERS if _provider_configured(p)]
+    jobs = _batch_jobs(input_path, prompt_ids, providers)
+    skipped = 0
+    if resume:
+        done = _batch_done_keys(output_path)
+        skipped = sum(1 for job in jobs if job["key"] in done)
+        jobs = [job for job in jobs if job["key"] not in done]
+    # Одинаковые задания (повторы вопросов) выполняются один раз, остальные берутся из кэша
+    unique, repeats, seen = [], [], set()
+    for job in jobs:
+        (repeats if job["key"] in seen else unique).append(job)
+        seen.add(job["key"])
+    summary = {"jobs": len(jobs), "skipped": skipped, "errors": 0, "cached": 0, "tokens": 0, "cost": 0.0,
+               "latency_ms": {}}
+    t0 = time.monotonic()
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out:
+        def emit(result: dict) -> None:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            summary["errors"] += 1 if result["error"] else 0
+            summary["cached"] += 1 if result["source"] == "cache" else 0
+            summary["tokens"] += result["prompt_tokens"] + result["completion_tokens"]
+            summary["cost"] += result["cost"]
+            if result["latency_ms"] is not None and result["source"] == "live":
+                summary["latency_ms"].setdefault(result["provider"], []).append(result["latency_ms"])
+
+        for job in [job for job in unique + repeats if job.get("error")]:
+            emit(_batch_result(job, "skipped", error=job["error"]))
+        unique = [job for job in unique if not job.get("error")]
+        repeats = [job for job in repeats if not job.get("error")]
+        if use_batch_api:
+            unique = await _batch_via_api(unique, poll_interval, emit)
+        await _batch_live(unique, concurrency, emit)
+        await _batch_live(repeats, concurrency, emit)
+    await _flush_usage()
+    summary["elapsed_s"] = round(time.monotonic() - t0, 2)
+    summary["cost"] = round(summary["cost"], 6)
+    for provider, values in summary["latency_ms"].items():
+        values.sort()
+        summary["latency_ms"][provider] = {
+            "p50": values[len(values) // 2],
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+    return summary
+
+def batch_main(argv: list) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="main.py batch",
+                                     description="Прогон вопросов из JSONL по промптам и провайдерам")
+    parser.add_argument("input", help="JSONL: {\"question\": ..., \"id\"?, \"prompts\"?: [...], \"providers\"?: [...]}")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl")
+    parser.add_argument("--prompts", help="id промптов через запятую (по умолчанию все из promt_list)")
+    parser.add_argument("--providers", help="OPEN_AI,DEEP_SEEK,LOCAL (по умолчанию все настроенные)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_DEFAULT_CONCURRENCY)
+    parser.add_argument("--batch-api", action="store_true",
+                        help="задания OpenAI отправить через Batch API (дешевле, результат до 24 ч)")
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL)
+    parser.add_argument("--resume", action="store_true", help="дописать в output, пропустив выполненные задания")
+    args = parser.parse_args(argv)
+    _load_secrets(require_bot_token=False)
+    summary = asyncio.run(run_batch(
+        args.input, args.output,
+        prompt_ids=args.prompts.split(",") if args.prompts else None,
+        providers=args.providers.split(",") if args.providers else None,
+        concurrency=args.concurrency, use_batch_api=args.batch_api,
+        resume=args.resume, poll_interval=args.poll_interval,
+    ))
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 1 if summary["errors"] else 0
+
+def _build_application(token: str, post_init=None, post_shutdown=None) -> Application:
+    builder = Application.builder().token(token)
+    if post_init:
+        builder.post_init(post_init)
+    if post_shutdown:
+        builder.post_shutdown(post_shutdown)
+    application = builder.build()
     
-    # Создаем Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Пока загружается снимок или идёт остановка, апдейты задерживаются здесь
+    application.add_handler(TypeHandler(Update, _gate_update), group=-1)
     
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
@@ -1084,6 +4314,8 @@ def main():
     application.add_handler(CommandHandler("myreport", my_report))
     application.add_handler(CommandHandler("report", admin_report))
     application.add_handler(CommandHandler("admin", admin_menu))
+    # block=False: профилирование длится секунды и не должно задерживать другие апдейты
+    application.add_handler(CommandHandler("profile", profile_cmd, block=False))
     application.add_handler(CommandHandler("prompt", prompt_menu))
     application.add_handler(CommandHandler("ai", ai_menu))
     application.add_handler(CommandHandler("reload_prompts", reload_prompts))
@@ -1091,8 +4323,10 @@ def main():
     application.add_handler(CommandHandler("stats", stats_cmd))
     
     # Обработчики сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_image))
+    # block=False: пока ждём провайдера, /reset и новые вопросы обрабатываются и отменяют старый запрос
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons, block=False))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_image, block=False))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document, block=False))
     
     # Обработчик админ-панели
     conv_handler = ConversationHandler(
@@ -1120,15 +4354,119 @@ def main():
     application.add_handler(custom_prompt_handler)
     
     application.add_handler(CallbackQueryHandler(set_prompt_callback, pattern=r"^set_prompt:"))
+    application.add_handler(CallbackQueryHandler(prompt_page_callback, pattern=r"^prompt_page:"))
     application.add_handler(CallbackQueryHandler(save_pdf_callback, pattern=r"^save_pdf$"))
     application.add_handler(CallbackQueryHandler(set_ai_callback, pattern=r"^set_ai:"))
     
     # Обработчик ошибок
     application.add_error_handler(error_handler)
+    return application
+
+# Несколько ботов в одном процессе: Application на каждый токен в общем цикле событий
+_default_bot = _BotState("default", ADMIN_IDS)
+
+def _load_bots_config(path: str) -> list:
+    """Список ботов из JSON: [{"name", "token" | "token_env" | "token_file", "admins", "prompts", "snapshot"}]."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    entries = data.get("bots") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path}: ожидается непустой список ботов")
+    bots, seen = [], set()
+    for idx, entry in enumerate(entries, 1):
+        name = str(entry.get("name") or f"bot{idx}")
+        token = (entry.get("token") or (entry.get("token_env") and os.environ.get(entry["token_env"]))
+                 or (entry.get("token_file") and _read_secret_file(entry["token_file"])))
+        if not token:
+            raise ValueError(f"{path}: у бота {name} нет токена (token, token_env или token_file)")
+        bot = _BotState(name, [int(uid) for uid in entry.get("admins", ADMIN_IDS)],
+                        prompts_path=entry.get("prompts", "promt_list"),
+                        snapshot_path=entry.get("snapshot") or f"bot_state.{name}.snapshot", token=token,
+                        owns_shared_stats=not bots)  # общие метрики — в снимке первого бота
+        # Общий токен или снимок у двух ботов — два опроса одного бота и затирание состояния
+        for kind, value in (("имя", name), ("токен", token), ("снимок", bot.snapshot_path)):
+            if (kind, value) in seen:
+                raise ValueError(f"{path}: у бота {name} повторяется {kind}")
+            seen.add((kind, value))
+        bots.append(bot)
+    return bots
+
+async def _serve_bot(bot: _BotState, shutdown: asyncio.Event) -> None:
+    # Задача бота со своим контекстом: опрос, обработка апдейтов и фоновые задачи наследуют _current_bot
+    _current_bot.set(bot)
+    stopped = asyncio.Event()
+    bot.stop = stopped.set
+    _load_prompts()
+    application = _build_application(bot.token)
+    await application.initialize()
+    try:
+        _start_bot_tasks(application)
+        # Порядок PTB: сначала обработчики (start), потом приём апдейтов; остановка — в обратном порядке
+        await application.start()
+        await application.updater.start_polling()
+        logger.info(f"Бот @{application.bot.username} запущен")
+        await shutdown.wait()
+        _request_drain(application)
+        await stopped.wait()
+    finally:
+        with suppress(Exception):
+            if application.updater.running:
+                await application.updater.stop()
+        with suppress(Exception):
+            if application.running:
+                await application.stop()
+        await application.shutdown()
+        await _shutdown_bot(application)
+
+async def _serve_bots(bots: list) -> None:
+    shared_tasks = {}
+    _start_shared_tasks(shared_tasks)
+    shutdown = asyncio.Event()
+
+    def on_signal() -> None:
+        if shutdown.is_set():
+            logger.warning("Повторный сигнал — останавливаемся, не дожидаясь запросов")
+            for bot in bots:
+                bot.stop()
+        shutdown.set()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, on_signal)
+    try:
+        await asyncio.gather(*(_serve_bot(bot, shutdown) for bot in bots))
+    finally:
+        await _cancel_tasks(shared_tasks, ("warmup_task", "usage_flush_task"))
+        await _flush_usage()
+
+def main():
+    _mark_startup("imports")
+    bots = _load_bots_config(BOTS_CONFIG) if BOTS_CONFIG else None
+    # Секреты проверяем сразу — без токена и ключа запускаться нет смысла
+    _load_secrets(require_bot_token=not bots)
+    
+    # Создаем папку для временных изображений (на всякий случай)
+    os.makedirs("temp_images", exist_ok=True)
+    
+    if bots:
+        logger.info(f"Запуск ботов из {BOTS_CONFIG}: {', '.join(bot.name for bot in bots)}")
+        asyncio.run(_serve_bots(bots))
+        return
+    
+    # Инициализируем список промптов
+    _load_prompts()
+    _mark_startup("prompts")
+    
+    application = _build_application(BOT_TOKEN, _post_init, _post_shutdown)
+    _mark_startup("application")
     
     # Запускаем бота
     logger.info("Bot is starting...")
-    application.run_polling()
+    # SIGTERM/SIGINT обрабатываются в _post_init: сначала дожидаемся текущих запросов
+    application.run_polling(stop_signals=None)
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batch_main(sys.argv[2:]))
     main()
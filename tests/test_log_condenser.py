@@ -0,0 +1,55 @@
+import gzip
+
+import pytest
+
+import main
+
+
+def test_detect_file_type():
+    nginx = '1.2.3.4 - - [10/Oct/2026:13:55:36 +0000] "GET /a HTTP/1.1" 200 12 "-" "curl"'
+    syslog = "Oct 10 13:55:36 host sshd[1]: Accepted publickey"
+    assert main._detect_file_type([nginx] * 10) == "nginx_access"
+    assert main._detect_file_type([syslog] * 10) == "syslog"
+    assert main._detect_file_type(["listen 80;"], "nginx.conf.gz") == "config"
+    assert main._detect_file_type(["hello"]) == "generic"
+
+
+def test_repeats_fold_into_patterns_and_errors_get_windows():
+    lines = [f"Oct 10 13:55:{i % 60:02d} host app[{i}]: request {i} ok" for i in range(1000)]
+    lines[500] = "Oct 10 13:55:00 host app[1]: connection refused"
+    text, kind, total = main._condense_lines(lines)
+    assert (kind, total) == ("syslog", 1000)
+    assert "строк: 1000" in text
+    assert "999× " in text
+    assert "--- строка 501" in text
+    assert "connection refused" in text
+
+
+def test_pattern_and_flow_counters_are_bounded(monkeypatch):
+    monkeypatch.setattr(main, "DOC_MAX_PATTERNS", 5)
+    monkeypatch.setattr(main, "DOC_MAX_FLOWS", 3)
+    condenser = main._LogCondenser("iptables")
+    for i in range(200):
+        condenser.feed(f"IN=eth0 OUT= SRC=10.0.{i}.1 DST=10.1.0.1 PROTO=TCP DPT={i} error-{chr(65 + i % 26)}{i}")
+    assert len(condenser.patterns) <= 5
+    assert len(condenser.flows) == 3
+    assert condenser.other_flows == 197
+    assert set(condenser.alert_patterns) <= set(condenser.patterns) | {None}
+    assert "редких потоках" in condenser.result()
+
+
+def test_binary_file_is_rejected(tmp_path):
+    path = tmp_path / "archive.zip"
+    path.write_bytes(b"PK\x03\x04\x14\x00\x00\x00" + bytes(range(256)) * 10)
+    with pytest.raises(main.BinaryFileError):
+        main._condense_file(str(path), "archive.zip")
+
+
+def test_gzip_and_long_line_are_read_in_bounded_pieces(tmp_path):
+    path = tmp_path / "app.log.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("x" * 100_000 + "\nsecond line\n")
+    text, _, total = main._condense_file(str(path), "app.log.gz")
+    assert total == 2
+    assert "second line" in text
+    assert "x" * (main.DOC_MAX_LINE_CHARS + 2) not in text
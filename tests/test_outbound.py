@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_token_bucket_take_and_refill(clock):
+    bucket = main._TokenBucket(rate=2.0, capacity=3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert bucket.take() == 0.0
+    assert not bucket.is_full()
+    clock[0] += 10
+    assert bucket.is_full()  # не больше ёмкости
+
+
+def test_token_bucket_refund(clock):
+    bucket = main._TokenBucket(rate=1.0, capacity=1)
+    assert bucket.take() == 0.0
+    bucket.refund()
+    assert bucket.is_full()
+    bucket.refund()
+    assert bucket.tokens == 1
+
+
+def test_token_bucket_pause(clock):
+    bucket = main._TokenBucket(rate=30.0, capacity=30)
+    bucket.pause(2.0)
+    assert bucket.take() == pytest.approx(2.0)
+    clock[0] += 1.99
+    assert bucket.take() > 0
+    clock[0] += 0.02
+    assert bucket.take() == 0.0
+
+
+async def _dispatch(jobs: list) -> list:
+    """jobs — [(chat_id, priority, метка)]; возвращает порядок отправки."""
+    sent = []
+    dispatcher = main._OutboundDispatcher()
+
+    def factory(label):
+        async def send():
+            sent.append(label)
+            return label
+        return send
+
+    futures = [dispatcher.submit(chat_id, factory(label), priority) for chat_id, priority, label in jobs]
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*futures), 5)
+    finally:
+        for worker in dispatcher.workers:
+            worker.cancel()
+    assert results == [label for _, _, label in jobs]
+    return sent
+
+
+def test_interactive_overtakes_bulk(monkeypatch):
+    monkeypatch.setattr(main, "SEND_WORKERS", 1)
+    jobs = [(chat_id, main.SEND_PRIORITY_BULK, f"bulk{chat_id}") for chat_id in range(5)]
+    jobs.append((100, main.SEND_PRIORITY_INTERACTIVE, "reply"))
+    sent = asyncio.run(_dispatch(jobs))
+    assert sent[0] == "reply"
+    assert sent[1:] == [f"bulk{chat_id}" for chat_id in range(5)]
+
+
+def test_chat_order_preserved(monkeypatch):
+    monkeypatch.setattr(main, "SEND_WORKERS", 4)
+    jobs = [(1, main.SEND_PRIORITY_INTERACTIVE, f"part{i}") for i in range(main.SEND_PER_CHAT_BURST)]
+    jobs += [(2, main.SEND_PRIORITY_BULK, "other")]
+    sent = asyncio.run(_dispatch(jobs))
+    parts = [label for label in sent if label.startswith("part")]
+    assert parts == [f"part{i}" for i in range(main.SEND_PER_CHAT_BURST)]
+
+
+def test_abort_skips_unsent_bulk(monkeypatch):
+    monkeypatch.setattr(main, "SEND_WORKERS", 1)
+
+    async def scenario():
+        dispatcher = main._OutboundDispatcher()
+        sent = []
+
+        async def send():
+            sent.append("bulk")
+
+        futures = [dispatcher.submit(chat_id, send, main.SEND_PRIORITY_BULK) for chat_id in range(3)]
+        assert dispatcher.pending(main.SEND_PRIORITY_BULK) == 3
+        assert dispatcher.abort(main.SEND_PRIORITY_BULK, RuntimeError("stop")) == 3
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        for worker in dispatcher.workers:
+            worker.cancel()
+        return sent, results
+
+    sent, results = asyncio.run(scenario())
+    assert sent == []
+    assert all(isinstance(r, RuntimeError) for r in results)
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def prompts_file(tmp_path, monkeypatch):
+    path = tmp_path / "promt_list"
+    monkeypatch.setattr(main._bot(), "prompts_path", str(path))
+    main._apply_prompts(main._default_prompts(), None)
+    yield path
+    main._apply_prompts(main._default_prompts(), None)
+
+
+def test_parse_both_formats():
+    as_dict = main._parse_prompts('{"Сеть": "ты сетевик"}')
+    assert [(p["id"], p["title"], p["content"]) for p in as_dict] == [("p1", "Сеть", "ты сетевик")]
+    as_list = main._parse_prompts('[{"id": "x", "title": "T", "content": "c"}, {"content": "d"}]')
+    assert [p["id"] for p in as_list] == ["x", "p2"]
+    assert as_list[0]["tokens"] == main._estimate_tokens("c")
+    with pytest.raises(ValueError):
+        main._parse_prompts("  ")
+
+
+def test_missing_file_gives_default_prompt(prompts_file):
+    prompts, stat = main._read_prompts_file()
+    assert stat is None
+    assert [p["id"] for p in prompts] == ["default"]
+
+
+def test_round_trip(prompts_file):
+    added = main._add_prompt("Firewall rules", "многострочный\nпромпт")
+    assert added["id"] == "Firewall_rules"
+    assert main._add_prompt("Firewall rules", "ещё")["id"] == "Firewall_rules_2"
+    data = [{"id": p["id"], "title": p["title"], "content": p["content"]} for p in main.PROMPTS]
+    stat = main._write_prompts_atomic(data)
+    prompts, read_stat = main._read_prompts_file()
+    assert read_stat == stat
+    assert [(p["id"], p["title"], p["content"], p["hash"]) for p in prompts] == \
+        [(p["id"], p["title"], p["content"], p["hash"]) for p in main.PROMPTS]
+    assert main._delete_prompt("Firewall_rules_2")
+    assert not main._delete_prompt("Firewall_rules_2")
+
+
+def test_reload_only_when_file_changes(prompts_file):
+    prompts_file.write_text('[{"id": "a", "title": "A", "content": "x"}]', encoding="utf-8")
+    assert asyncio.run(main._reload_prompts_if_changed())
+    assert list(main.PROMPT_BY_ID) == ["a"]
+    assert not asyncio.run(main._reload_prompts_if_changed())
+    prompts_file.write_text("[не json", encoding="utf-8")
+    assert not asyncio.run(main._reload_prompts_if_changed())
+    assert list(main.PROMPT_BY_ID) == ["a"]  # битый файл не заменяет текущие промпты
+
+
+def test_concurrent_writes_never_publish_partial_file(prompts_file):
+    payloads = [[{"id": f"p{i}", "title": "t" * 1000, "content": str(i) * 50_000}] for i in range(8)]
+    errors = []
+
+    def write(data):
+        try:
+            for _ in range(5):
+                main._write_prompts_atomic(data)
+        except Exception as e:  # до исправления — FileNotFoundError на общем .tmp
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(data,)) for data in payloads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    prompts, _ = main._read_prompts_file()
+    assert len(prompts) == 1 and prompts[0]["content"] == prompts[0]["id"][1:] * 50_000
+    assert sorted(p.name for p in prompts_file.parent.iterdir()) == ["promt_list"]
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class BadRequestError(Exception):
+    """Имя совпадает с openai.BadRequestError — main распознаёт его по имени класса."""
+
+
+class FakeStream:
+    def __init__(self, words, usage=None):
+        self.chunks = [SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=w))])
+                       for w in words]
+        if usage:
+            self.chunks.append(SimpleNamespace(usage=usage, choices=[]))
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, accepts_stream_options: bool):
+        self.accepts = accepts_stream_options
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if "stream_options" in kwargs:
+            if not self.accepts:
+                raise BadRequestError("400: unrecognized field stream_options")
+            return FakeStream(["при", "вет"], SimpleNamespace(prompt_tokens=3, completion_tokens=2))
+        return FakeStream(["при", "вет"])
+
+
+def _complete(provider, client, model="m"):
+    request = {"model": model, "messages": [{"role": "user", "content": "вопрос " * 20}]}
+    handle = main._RequestHandle()
+    return main._stream_completion(handle, provider, client, request, 0.0, lambda: None, lambda partial: None)
+
+
+def test_server_without_stream_options_is_retried_and_remembered(monkeypatch):
+    monkeypatch.setattr(main, "_no_stream_options", set())
+    client = FakeClient(accepts_stream_options=False)
+    response = _complete("LOCAL", client)
+    assert response.choices[0].message.content == "привет"
+    assert response.usage.prompt_tokens > 0  # usage не пришёл — оценён
+    assert len(client.calls) == 2
+    _complete("LOCAL", client)
+    assert len(client.calls) == 3  # второй раз stream_options уже не отправляется
+
+
+def test_usage_from_provider_is_kept(monkeypatch):
+    monkeypatch.setattr(main, "_no_stream_options", set())
+    response = _complete("OPEN_AI", FakeClient(accepts_stream_options=True))
+    assert (response.usage.prompt_tokens, response.usage.completion_tokens) == (3, 2)
+
+
+def test_other_bad_requests_from_known_providers_are_not_retried(monkeypatch):
+    monkeypatch.setattr(main, "_no_stream_options", set())
+    client = FakeClient(accepts_stream_options=True)
+
+    def reject(**kwargs):
+        client.calls.append(kwargs)
+        raise BadRequestError("400: context_length_exceeded")
+
+    client.create = reject
+    with pytest.raises(BadRequestError):
+        _complete("OPEN_AI", client)
+    assert len(client.calls) == 1
@@ -0,0 +1,70 @@
+import random
+
+import main
+
+
+def test_normalize_question_ignores_case_punctuation_and_yo():
+    assert main._normalize_question("  Как  ЗАПУСТИТЬ ёлку?! ") == main._normalize_question("как запустить елку")
+    # Числа различают вопросы
+    assert main._normalize_question("порт 8080") != main._normalize_question("порт 8081")
+    assert main._normalize_question("?!...") == ""
+
+
+def test_count_min_never_underestimates():
+    rnd = random.Random(1)
+    sketch = main._CountMinSketch(width=256, depth=4)
+    truth = {}
+    for _ in range(5000):
+        item = f"q{rnd.randint(0, 2000)}"
+        truth[item] = truth.get(item, 0) + 1
+        sketch.add(item)
+    for item, count in truth.items():
+        assert sketch.estimate(item) >= count
+
+
+def test_count_min_exact_without_collisions():
+    sketch = main._CountMinSketch()
+    for _ in range(7):
+        sketch.add("a")
+    assert sketch.add("a") == 8
+    assert sketch.estimate("a") == 8
+    assert sketch.estimate("never seen") == 0
+
+
+def test_count_min_decay_halves():
+    sketch = main._CountMinSketch()
+    for _ in range(9):
+        sketch.add("a")
+    sketch.decay()
+    assert sketch.estimate("a") == 4
+
+
+def test_tracker_keeps_top_k_per_prompt():
+    tracker = main.QuestionTracker(top_k=3)
+    for i, times in enumerate([1, 5, 2, 8, 3]):
+        for _ in range(times):
+            tracker.record("p1", f"вопрос {i}")
+    tracker.record("p2", "другой промпт")
+    hottest = tracker.hottest()
+    assert [(count, pid, norm) for count, pid, norm, _ in hottest] == [
+        (8, "p1", "вопрос 3"), (5, "p1", "вопрос 1"), (3, "p1", "вопрос 4"), (1, "p2", "другой промпт")]
+    assert [row[2] for row in tracker.hottest(min_count=4)] == ["вопрос 3", "вопрос 1"]
+
+
+def test_tracker_merges_formulations_and_keeps_last():
+    tracker = main.QuestionTracker()
+    tracker.record("p", "Как настроить nginx?")
+    tracker.record("p", "как настроить NGINX")
+    tracker.record("p", "   ")  # пустой после нормализации — не считается
+    assert tracker.hottest() == [(2, "p", "как настроить nginx", "как настроить NGINX")]
+
+
+def test_tracker_decay_drops_rare_questions():
+    tracker = main.QuestionTracker()
+    for _ in range(4):
+        tracker.record("p", "частый")
+    tracker.record("p", "редкий")
+    tracker.record("q", "единственный")
+    tracker.decay()
+    assert [(count, pid, norm) for count, pid, norm, _ in tracker.hottest()] == [(2, "p", "частый")]
+    assert "q" not in tracker.top
@@ -0,0 +1,41 @@
+import marshal
+import zlib
+
+import pytest
+
+import main
+
+
+STATE = {
+    "saved_at": 1.5,
+    "contexts": {42: [{"role": "user", "content": "привет"}]},
+    "audience": [1, 2, 3],
+    "stats": main.StatsEngine().to_state(),
+}
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    main._write_snapshot_file(path, marshal.dumps(STATE))
+    assert main._read_snapshot_file(path) == STATE
+    # Временные файлы атомарной записи не остаются рядом со снимком
+    assert [p.name for p in tmp_path.iterdir()] == ["snapshot.bin"]
+
+
+def test_missing_file_returns_none(tmp_path):
+    assert main._read_snapshot_file(str(tmp_path / "nope.bin")) is None
+
+
+@pytest.mark.parametrize("header", [b"", b"PK\x03\x04\x00", main.SNAPSHOT_MAGIC[:-1] + b"\x02"])
+def test_rejects_unknown_magic_or_version(tmp_path, header):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(header + zlib.compress(marshal.dumps(STATE)))
+    with pytest.raises(ValueError):
+        main._read_snapshot_file(str(path))
+
+
+def test_rejects_pickle(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(b"\x80\x04\x95" + b"\x00" * 16)
+    with pytest.raises(ValueError):
+        main._read_snapshot_file(str(path))
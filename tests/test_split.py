@@ -0,0 +1,32 @@
+import random
+import re
+
+import pytest
+
+import main
+
+
+def _assert_parts_fit(parts: list, max_len: int) -> None:
+    assert parts
+    for part in parts:
+        assert main._tg_len(part) <= max_len
+
+
+def test_fence_longer_than_part_does_not_hang():
+    text = "intro\n" + "`" * 4000 + "\ncode\n" + "`" * 4000 + "\nend"
+    parts = main._split_text_for_telegram(text)
+    _assert_parts_fit(parts, main.TELEGRAM_SAFE_SLICE_LEN)
+    joined = "".join(parts)
+    assert joined.count("intro") == joined.count("code") == joined.count("end") == 1
+
+
+@pytest.mark.parametrize("max_len", range(2, 24))
+def test_small_max_len_terminates_without_duplicates(max_len):
+    rnd = random.Random(max_len)
+    alphabet = ["a", "b", " ", "\n", "`", "~", "🙂", "я"]
+    for _ in range(300):
+        text = "".join(rnd.choice(alphabet) * rnd.choice([1, 1, 3, 4, 70]) for _ in range(rnd.randint(1, 60)))
+        parts = main._split_text_for_telegram(text, max_len)
+        _assert_parts_fit(parts, max_len)
+        if "`" not in text and "~" not in text:
+            assert re.sub(r"\s", "", "".join(parts)) == re.sub(r"\s", "", text)
@@ -0,0 +1,71 @@
+from datetime import datetime
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("n", [10, 1000, 50_000])
+def test_hll_count_within_error(n):
+    hll = main._HyperLogLog()
+    for uid in range(n):
+        hll.add(uid)
+        hll.add(uid)  # повторы не увеличивают оценку
+    assert abs(hll.count() - n) <= max(2, n * 0.05)
+
+
+def test_hll_merge_counts_union():
+    a, b = main._HyperLogLog(), main._HyperLogLog()
+    for uid in range(0, 6000):
+        a.add(uid)
+    for uid in range(4000, 10_000):
+        b.add(uid)
+    merged = a.merge(b)
+    assert abs(merged.count() - 10_000) <= 500
+    # Слияние не меняет исходные скетчи
+    assert abs(a.count() - 6000) <= 300
+
+
+def test_ring_counter_buckets_and_expiry():
+    ring = main._RingCounter(60, 60)
+    now = 1_000_000 * 60.0
+    ring.add(now)
+    ring.add(now + 5, 2)
+    ring.add(now - 60)
+    assert ring.series(now)[-2:] == [1, 3]
+    assert ring.total(now) == 4
+    # Через час все корзины устарели, хотя слоты не перезаписывались
+    assert ring.total(now + 3600) == 0
+
+
+def test_ring_counter_reused_slot_resets():
+    ring = main._RingCounter(3, 10)
+    ring.add(0.0, 5)
+    ring.add(30.0)  # тот же слот, новая эпоха
+    assert ring.series(30.0) == [0, 0, 1]
+
+
+def test_stats_engine_rings_and_distinct_users():
+    stats = main.StatsEngine()
+    now = datetime.now().timestamp()
+    for uid in range(100):
+        stats.record(uid, now)
+        stats.record(uid, now)
+    assert stats.total_messages == 200
+    assert stats.per_minute.total(now) == 200
+    assert stats.per_hour.total(now) == 200
+    assert abs(stats.unique_users() - 100) <= 5
+    assert abs(stats.distinct_users(1) - 100) <= 5
+
+
+def test_stats_engine_state_round_trip():
+    stats = main.StatsEngine()
+    now = datetime.now().timestamp()
+    for uid in range(50):
+        stats.record(uid, now)
+    restored = main.StatsEngine()
+    restored.load_state(stats.to_state())
+    assert restored.total_messages == 50
+    assert restored.per_minute.total(now) == 50
+    assert restored.unique_users() == stats.unique_users()
+    assert restored.active_user_ids() == stats.active_user_ids()
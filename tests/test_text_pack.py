@@ -0,0 +1,60 @@
+import pytest
+
+import main
+
+_TEMPLATE = ("## Диагностика\n```bash\nss -tlnp | grep :22\nsudo journalctl -u sshd --since today\n```\n"
+             "Проверьте правила iptables и что порт открыт. Ответ 🙂 №{}\n")
+
+
+def answer(n) -> str:
+    return _TEMPLATE.format(n) * 4
+
+
+CODECS = [False] + ([True] if main.ZSTD_AVAILABLE else [])
+
+
+@pytest.fixture(params=CODECS, ids=lambda zstd: "zstd" if zstd else "zlib")
+def codec(request, monkeypatch):
+    monkeypatch.setattr(main, "ZSTD_AVAILABLE", request.param)
+    monkeypatch.setattr(main, "_text_dicts", {})
+    monkeypatch.setattr(main, "_zstd_codecs", {})
+    monkeypatch.setattr(main, "_text_dict_samples", [])
+    return request.param
+
+
+def test_round_trip_without_dict(codec):
+    raw = answer(1).encode("utf-8")
+    blob = main._pack_bytes(raw)
+    assert blob[:2] == bytes((main._TEXT_CODEC_ZSTD if codec else main._TEXT_CODEC_ZLIB, 0))
+    assert len(blob) < len(raw)
+    assert main._unpack_bytes(blob) == raw
+
+
+def test_round_trip_with_dict_and_foreign_dicts(codec):
+    samples = [answer(i).encode("utf-8") for i in range(main.TEXT_DICT_MIN_SAMPLES)]
+    plain = main._pack_bytes(samples[0])
+    main._text_dicts[1] = main._build_text_dict(samples)
+    main._zstd_codecs.clear()
+    with_dict = main._pack_bytes(samples[1])
+    assert with_dict[1] == 1
+    assert main._unpack_bytes(with_dict) == samples[1]
+    assert main._unpack_bytes(plain) == samples[0]  # старые записи без словаря читаются по-прежнему
+    # Словари из снимка другого процесса
+    foreign = dict(main._text_dicts)
+    main._text_dicts.clear()
+    main._zstd_codecs.clear()
+    assert main._unpack_bytes(with_dict, foreign) == samples[1]
+
+
+def test_cache_packs_long_values_and_evicts_least_recently_used(codec):
+    cache = main._PackedTextCache(max_size=3)
+    cache["short"] = "коротко"
+    cache["a"] = answer("a")
+    cache["b"] = answer("b")
+    assert isinstance(cache.data["a"], bytes) and cache.data["short"] == "коротко"
+    assert cache["short"] == "коротко"  # чтение освежает запись
+    cache["c"] = answer("c")
+    assert len(cache) == 3 and "a" not in cache
+    assert cache["b"] == answer("b") and cache.get("a") is None
+    packed, size = cache.memory()
+    assert packed == 2 and size > 0
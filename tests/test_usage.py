@@ -0,0 +1,71 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    path = tmp_path / "usage_ledger.jsonl"
+    monkeypatch.setattr(main, "_usage_path", lambda: str(path))
+    monkeypatch.setattr(main, "usage_totals", {dimension: {} for dimension in main.usage_totals})
+    monkeypatch.setattr(main, "usage_today", {"date": None, "by_user": {}})
+    monkeypatch.setattr(main, "_usage_pending", [])
+    monkeypatch.setattr(main, "_usage_restore", {"bytes": None})
+    return path
+
+
+def _usage(prompt_tokens, completion_tokens):
+    return SimpleNamespace(usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+
+
+def _write(path, rows):
+    with open(path, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write((row if isinstance(row, str) else json.dumps(row, ensure_ascii=False)) + "\n")
+
+
+def test_read_usage_for_day_parses_json_in_any_key_order(ledger):
+    _write(ledger, [
+        {"user_id": 1, "ts": "2026-10-19T10:00:00", "prompt_tokens": 5, "completion_tokens": 5},
+        {"ts": "2026-10-19T11:00:00", "user_id": 1, "prompt_tokens": 1, "completion_tokens": 2},
+        {"ts": "2026-10-18T23:59:59", "user_id": 1, "prompt_tokens": 100, "completion_tokens": 0},
+        {"ts": "2026-10-19T12:00:00", "source": "summary", "user_id": 0, "prompt_tokens": 50, "completion_tokens": 0},
+        '{"ts": "2026-10-19T12:00:00", "user_id": 2, "prompt_to',
+        "[1]",
+    ])
+    assert main._read_usage_for_day("2026-10-19") == {1: 13}
+
+
+def test_quota_counts_only_user_source(ledger, monkeypatch):
+    monkeypatch.setattr(main, "USER_DAILY_TOKEN_QUOTA", 100)
+    main._record_usage(7, "OPEN_AI", "gpt-4-turbo", "default", _usage(40, 40))
+    main._record_usage(7, "OPEN_AI", "gpt-4-turbo", "summary", _usage(500, 0), source=main.USAGE_SOURCE_SUMMARY)
+    main._check_quota(7)
+    main._record_usage(7, "OPEN_AI", "gpt-4-turbo", "default", _usage(10, 10))
+    with pytest.raises(main.QuotaExceededError):
+        main._check_quota(7)
+    assert main.usage_totals["user"][7]["prompt_tokens"] == 50
+    assert main.usage_totals["source"][main.USAGE_SOURCE_SUMMARY]["prompt_tokens"] == 500
+
+
+def test_restart_restores_totals_without_double_counting(ledger):
+    _write(ledger, [
+        {"ts": main.datetime.now().isoformat(), "source": "user", "user_id": 3, "provider": "OPEN_AI",
+         "prompt_id": "default", "prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0, "cost": 0.5},
+        {"ts": "2020-01-01T00:00:00", "source": "prewarm", "user_id": 0, "provider": "OPEN_AI",
+         "prompt_id": "default", "prompt_tokens": 7, "completion_tokens": 0, "cached_tokens": 0, "cost": 0.25},
+    ])
+    # Запись нового процесса попадает на диск раньше, чем журнал прочитан при старте
+    main._record_usage(3, "OPEN_AI", "gpt-4-turbo", "default", _usage(1, 1))
+    asyncio.run(main._flush_usage())
+    asyncio.run(main._load_usage_ledger())
+    assert main.usage_totals["user"][3]["calls"] == 2
+    assert main.usage_totals["user"][3]["prompt_tokens"] == 11
+    assert main.usage_totals["source"]["prewarm"]["calls"] == 1
+    assert 0 not in main.usage_totals["user"]
+    assert main._user_tokens_today(3) == 17
+    assert main._usage_summary()["calls"] == 3